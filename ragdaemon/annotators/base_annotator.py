@@ -5,7 +5,7 @@ from typing import Optional
 from spice import Spice
 
 from ragdaemon.database import Database
-from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.graph import FileChanges, KnowledgeGraph
 from ragdaemon.io import IO
 
 
@@ -28,6 +28,16 @@ class Annotator:
         raise NotImplementedError()
 
     async def annotate(
-        self, graph: KnowledgeGraph, db: Database, refresh: str | bool = False
+        self,
+        graph: KnowledgeGraph,
+        db: Database,
+        refresh: str | bool = False,
+        changes: Optional[FileChanges] = None,
     ) -> KnowledgeGraph:
+        """Add this annotator's data to the graph.
+
+        If `changes` is given, only the listed files (and whatever depends on them)
+        need to be updated; the rest of the graph is already annotated. If None,
+        annotate the whole graph.
+        """
         raise NotImplementedError()
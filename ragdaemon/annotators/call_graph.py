@@ -10,13 +10,14 @@ from tqdm.asyncio import tqdm
 
 from ragdaemon.annotators.base_annotator import Annotator
 from ragdaemon.database import Database
+from ragdaemon.document_store import load_document
 from ragdaemon.errors import RagdaemonError
-from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.graph import FileChanges, KnowledgeGraph
+from ragdaemon.line_ranges import LineRanges
 from ragdaemon.utils import (
     DEFAULT_CODE_EXTENSIONS,
     DEFAULT_COMPLETION_MODEL,
     match_refresh,
-    parse_path_ref,
     semaphore,
 )
 
@@ -160,7 +161,7 @@ class CallGraph(Annotator):
     ):
         """Generate and save call data for a file node to graph"""
         calls = {}
-        document = data["document"]
+        document = load_document(data)
 
         # Insert line numbers
         lines = document.split("\n")
@@ -186,12 +187,12 @@ class CallGraph(Annotator):
         data[self.call_field_id] = calls
 
     async def annotate(
-        self, graph: KnowledgeGraph, db: Database, refresh: str | bool = False
+        self,
+        graph: KnowledgeGraph,
+        db: Database,
+        refresh: str | bool = False,
+        changes: Optional[FileChanges] = None,
     ) -> KnowledgeGraph:
-        # Remove any existing call edges
-        graph.remove_edges_from(
-            [edge for edge in graph.edges(data=True) if edge[-1].get("type") == "call"]
-        )
         # Get the list of nodes expected to have calls data
         files_with_calls = list[tuple[str, dict[str, Any]]]()
         for node, data in graph.nodes(data=True):
@@ -231,44 +232,60 @@ class CallGraph(Annotator):
                 update_db["metadatas"].append(metadatas)
             db.update(**update_db)
 
+        # Edges only need to be rebuilt for files that changed (their chunks were
+        # replaced) or that call into a changed or removed file.
+        if changes is None:
+            files_to_link = files_with_calls
+        else:
+            touched = changes["changed"] | changes["removed"]
+            files_to_link = list[tuple[str, dict[str, Any]]]()
+            for file, data in files_with_calls:
+                calls = data[self.call_field_id]
+                if not isinstance(calls, dict):
+                    calls = json.loads(calls)
+                if (
+                    file in touched
+                    or file in files_just_updated
+                    or any(target.split(":")[0] in touched for target in calls)
+                ):
+                    files_to_link.append((file, data))
+        relinked = {file for file, _ in files_to_link}
+        graph.remove_edges_from(
+            [
+                edge
+                for edge in graph.edges(keys=True, data=True)
+                if edge[-1].get("type") == "call"
+                and (changes is None or edge[0].split(":")[0] in relinked)
+            ]
+        )
+
         # Add call edges to graph. Each call should have only ONE source; if there are
         # chunks, the source is the matching chunk, otherwise it's the file.
-        for file, data in files_with_calls:
+        for file, data in files_to_link:
             calls = data[self.call_field_id]
             if not isinstance(calls, dict):
                 calls = json.loads(calls)
             if not calls:
                 continue
 
-            # Build an index of {line: node} for the file
-            line_index = {}
             chunks = data.get(self.chunk_field_id)
             if chunks is None:
                 raise RagdaemonError(f"File node {file} is missing chunks field.")
             if not isinstance(chunks, list):
                 chunks = json.loads(chunks)
-            if len(chunks) == 0:
-                checksum = data.get("checksum")
-                if checksum is None:
-                    raise RagdaemonError(f"File node {file} is missing checksum field.")
-                document = data["document"]
-                for i in range(1, len(document.split("\n")) + 1):
-                    line_index[i] = file
-            else:
-                for chunk in chunks:
-                    _, lines = parse_path_ref(chunk["ref"])
-                    if lines is None:
-                        raise RagdaemonError(f"Chunk {chunk} is missing line numbers.")
-                    for line in lines:
-                        line_index[line] = chunk["id"]
+            line_index = graph.get_line_index(file) if chunks else None
 
             # Add one edge per source/target pair
             for target, lines in calls.items():
-                sources = set()
-                for line in lines:
-                    if line not in line_index:
-                        raise RagdaemonError(f"Line {line} not found in {file}.")
-                    sources.add(line_index[line])
+                if line_index is None:
+                    sources = {file}
+                else:
+                    sources = set()
+                    for line in lines:
+                        nodes = line_index.query(LineRanges([(line, line)]))
+                        if not nodes:
+                            raise RagdaemonError(f"Line {line} not found in {file}.")
+                        sources |= nodes
                 for source in sources:
                     graph.add_edge(source, target, type="call")
 
@@ -1,5 +1,8 @@
 import asyncio
 import json
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
 from pathlib import Path
 from typing import Optional, Set
@@ -8,32 +11,54 @@ from astroid.exceptions import AstroidSyntaxError
 from tqdm.asyncio import tqdm
 
 from ragdaemon.annotators.base_annotator import Annotator
+from ragdaemon.annotators.chunker.chunk_ast import chunk_document as chunk_ast
+from ragdaemon.annotators.chunker.chunk_ast import get_cpu_count
 from ragdaemon.annotators.chunker.chunk_astroid import chunk_document as chunk_astroid
 from ragdaemon.annotators.chunker.chunk_line import chunk_document as chunk_line
 from ragdaemon.annotators.chunker.chunk_llm import chunk_document as chunk_llm
+from ragdaemon.annotators.chunker.chunk_structural import STRUCTURAL_EXTENSIONS
+from ragdaemon.annotators.chunker.chunk_structural import (
+    chunk_document as chunk_structural,
+)
 from ragdaemon.annotators.chunker.utils import resolve_chunk_parent
 from ragdaemon.database import Database
+from ragdaemon.document_store import document_store, load_document
 from ragdaemon.errors import RagdaemonError
-from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.graph import FileChanges, KnowledgeGraph, get_hierarchy_descendants
+from ragdaemon.tokens import token_counts, truncate
 from ragdaemon.utils import (
     DEFAULT_CODE_EXTENSIONS,
-    get_document,
+    get_chunk_document,
+    get_line_offsets,
     hash_str,
     match_refresh,
-    truncate,
 )
 
 
+# What the python parsers raise for code they can't chunk: SyntaxError, ValueError for
+# null bytes (before python 3.12), RecursionError/MemoryError for very deep nesting
+PARSE_ERRORS = (SyntaxError, ValueError, RecursionError, MemoryError)
+
+
 class Chunker(Annotator):
     name = "chunker"
     chunk_field_id = "chunks"
 
     def __init__(
-        self, *args, files: Optional[Set[str]] = None, use_llm: bool = False, **kwargs
+        self,
+        *args,
+        files: Optional[Set[str]] = None,
+        use_llm: bool = False,
+        max_workers: Optional[int] = None,
+        **kwargs,
     ):
         super().__init__(*args, **kwargs)
 
         self.files = files
+        # Python and structurally-chunked files are parsed in a process pool, created on first use and kept
+        # for later updates. None uses every available core.
+        self.max_workers = get_cpu_count() if max_workers is None else max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
 
         # By default, use either the LLM chunker or a basic line chunker.
         if use_llm and self.spice_client is not None:
@@ -43,11 +68,18 @@ class Chunker(Annotator):
         else:
             default_chunk_fn = chunk_line
 
-        # For python files, try to use astroid. If that fails, fall back to the default chunker.
+        # For python files, use the stdlib ast, then astroid if that can't parse it.
+        # If both fail, fall back to the default chunker.
         async def python_chunk_fn(document: str):
+            try:
+                return await chunk_ast(document, executor=self.get_executor())
+            except PARSE_ERRORS:
+                pass
+            except BrokenProcessPool:
+                self.shutdown_executor()  # e.g. a worker was killed; start a new pool
             try:
                 return await chunk_astroid(document)
-            except AstroidSyntaxError:
+            except (AstroidSyntaxError, *PARSE_ERRORS):
                 if self.verbose > 0:
                     file = document.split("\n")[0]
                     print(
@@ -55,13 +87,47 @@ class Chunker(Annotator):
                     )
                 return await default_chunk_fn(document)
 
+        # For other languages with a structural chunker, fall back to the default
+        # chunker if the file can't be scanned.
+        async def structural_chunk_fn(document: str):
+            try:
+                return await chunk_structural(document, executor=self.get_executor())
+            except RagdaemonError:
+                if self.verbose > 0:
+                    file = document.split("\n")[0]
+                    print(
+                        f"Error chunking {file} structurally; falling back to default chunker."
+                    )
+            except BrokenProcessPool:
+                self.shutdown_executor()
+            return await default_chunk_fn(document)
+
         self.chunk_extensions_map = {}
         for extension in DEFAULT_CODE_EXTENSIONS:
             if extension == ".py":
                 self.chunk_extensions_map[extension] = python_chunk_fn
+            elif extension in STRUCTURAL_EXTENSIONS:
+                self.chunk_extensions_map[extension] = structural_chunk_fn
             else:
                 self.chunk_extensions_map[extension] = default_chunk_fn
 
+    def get_executor(self) -> Optional[ProcessPoolExecutor]:
+        """The process pool for parsing, or None to use a thread on one core."""
+        if self.max_workers <= 1:
+            return None
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            # Shut the pool down with the chunker, or at exit at the latest
+            self._finalizer = weakref.finalize(
+                self, self._executor.shutdown, wait=False, cancel_futures=True
+            )
+        return self._executor
+
+    def shutdown_executor(self):
+        if self._executor is not None:
+            self._finalizer()
+            self._executor = None
+
     def is_complete(self, graph: KnowledgeGraph, db: Database) -> bool:
         for node, data in graph.nodes(data=True):
             if data is None:
@@ -85,7 +151,7 @@ class Chunker(Annotator):
 
     async def get_file_chunk_data(self, node, data):
         """Generate and save chunk data for a file node to graph and db"""
-        document = data["document"]
+        document = load_document(data)
         extension = Path(data["ref"]).suffix
         try:
             chunks = await self.chunk_extensions_map[extension](document)
@@ -96,26 +162,61 @@ class Chunker(Annotator):
         chunks = sorted(chunks, key=lambda x: len(x["id"]))
         data[self.chunk_field_id] = chunks
 
+    def needs_chunks(self, graph: KnowledgeGraph, node: str, data: dict) -> bool:
+        """Whether a file's chunk nodes are missing from the graph."""
+        chunks = data.get(self.chunk_field_id, None)
+        if chunks is None:
+            return True
+        if not isinstance(chunks, list):
+            chunks = json.loads(chunks)
+        return any(chunk["id"] not in graph for chunk in chunks)
+
     async def annotate(
-        self, graph: KnowledgeGraph, db: Database, refresh: str | bool = False
+        self,
+        graph: KnowledgeGraph,
+        db: Database,
+        refresh: str | bool = False,
+        changes: Optional[FileChanges] = None,
     ) -> KnowledgeGraph:
-        # Select file nodes and remove all existing chunk nodes from graph.
+        # Select file nodes and remove their existing chunk nodes from graph. With
+        # `changes`, only files that changed or are missing chunks are re-chunked.
         files_with_chunks = []
         all_nodes = list(graph.nodes(data=True))
         for node, data in all_nodes:
             if data is None:
                 raise RagdaemonError(f"Node {node} has no data.")
-            if data.get("type") == "chunk":
-                graph.remove_node(node)
-            elif data.get("type") == "file":
-                if self.files is not None and node not in self.files:
+            if data.get("type") != "file":
+                continue
+            if self.files is not None and node not in self.files:
+                continue
+            if self.chunk_extensions_map is not None:
+                extension = Path(data["ref"]).suffix
+                if extension not in self.chunk_extensions_map:
                     continue
-                if self.chunk_extensions_map is None:
-                    files_with_chunks.append((node, data))
-                else:
-                    extension = Path(data["ref"]).suffix
-                    if extension in self.chunk_extensions_map:
-                        files_with_chunks.append((node, data))
+            if (
+                changes is not None
+                and node not in changes["changed"]
+                and not match_refresh(refresh, node)
+                and not self.needs_chunks(graph, node, data)
+            ):
+                continue
+            files_with_chunks.append((node, data))
+        if changes is None:
+            stale = {
+                node
+                for node, data in all_nodes
+                if data is not None and data.get("type") == "chunk"
+            }
+        else:
+            stale = set[str]()
+            for node, _ in files_with_chunks:
+                stale |= get_hierarchy_descendants(graph, node)
+            # Chunks of removed files lose their file node, so look them up by id.
+            for node, data in all_nodes:
+                if data is not None and data.get("type") == "chunk":
+                    if node.split(":")[0] not in graph:
+                        stale.add(node)
+        graph.remove_nodes_from(stale)
 
         # Generate/add chunk data for nodes that don't have it
         tasks = []
@@ -156,23 +257,29 @@ class Chunker(Annotator):
             if len(base_chunk) != 1:
                 raise RagdaemonError(f"Node {file} missing base chunk")
             chunks = base_chunk + chunks
+            # Chunk documents are sliced from the file's document (minus its path
+            # header) rather than re-read from disk.
+            text = load_document(data).partition("\n")[2]
+            offsets = get_line_offsets(text)
+            # Parents are always chunks of the same file, so only those are indexed
+            chunk_ids = set[str]()
             # Load chunks into graph
             for chunk in chunks:
                 id, ref = chunk["id"], chunk["ref"]
-                document = get_document(ref, self.io, type="chunk")
+                document = get_chunk_document(ref, text, offsets)
                 checksum = hash_str(document)
                 chunk_data = {
                     "id": id,
                     "ref": ref,
                     "type": "chunk",
-                    "document": document,
                     "checksum": checksum,
                 }
+                document_store.put(checksum, document)
                 graph.add_node(id, **chunk_data)
                 checksums[id] = checksum
 
-                all_nodes = set(graph.nodes)
-                parent = resolve_chunk_parent(id, all_nodes)
+                parent = resolve_chunk_parent(id, chunk_ids)
+                chunk_ids.add(id)
                 if parent is None:
                     if self.verbose > 1:
                         print(f"No parent node found for {id}")
@@ -186,11 +293,13 @@ class Chunker(Annotator):
         add_to_db = {"ids": [], "documents": []}
         for node, checksum in checksums.items():
             if checksum in db_data:
-                data = db_data[checksum]
+                data = token_counts.load(checksum, db_data[checksum])
                 graph.nodes[node].update(data)
             else:
-                document = graph.nodes[node].get("document")
-                document, truncate_ratio = truncate(document, db.embedding_model)
+                document = document_store.get(checksum)
+                document, truncate_ratio = truncate(
+                    document, db.embedding_model, checksum=checksum
+                )
                 if truncate_ratio > 0 and self.verbose > 1:
                     print(f"Truncated {node} by {truncate_ratio:.2%}")
                 add_to_db["ids"].append(checksum)
@@ -1,3 +1,5 @@
+import asyncio
+
 import astroid
 
 from ragdaemon.annotators.chunker.utils import Chunk, RawChunk, resolve_raw_chunks
@@ -5,6 +7,11 @@ from ragdaemon.errors import RagdaemonError
 
 
 async def chunk_document(document: str) -> list[Chunk]:
+    # Parsing is CPU-bound, so keep it off the event loop
+    return await asyncio.to_thread(_chunk_document, document)
+
+
+def _chunk_document(document: str) -> list[Chunk]:
     # Parse the code into an astroid AST
     lines = document.split("\n")
     file_path = lines[0].strip()
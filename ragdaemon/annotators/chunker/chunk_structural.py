@@ -0,0 +1,341 @@
+"""
+Offline structural chunkers for non-python code. Brace languages (C-family, Java, C#,
+Go, JS/TS, PHP) are scanned for `{...}` blocks whose header looks like a function,
+method or type definition; Ruby's `class`/`module`/`def` blocks are matched to their
+`end` by indentation. Both return the same RawChunk hierarchy as chunk_astroid, e.g.
+`path/to/file:Class.method`. They're heuristics, not parsers: if a file can't be
+scanned consistently (unbalanced braces, e.g. from preprocessor branches) they raise
+RagdaemonError so the caller can fall back to another chunker.
+"""
+
+import asyncio
+import re
+from bisect import bisect_right
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Optional
+
+from ragdaemon.annotators.chunker.utils import Chunk, RawChunk, resolve_raw_chunks
+from ragdaemon.errors import RagdaemonError
+from ragdaemon.line_ranges import LineRanges
+from ragdaemon.utils import get_line_offsets, parse_path_ref
+
+
+BRACE_EXTENSIONS = {
+    ".c",
+    ".cpp",
+    ".h",
+    ".hpp",
+    ".cs",
+    ".java",
+    ".go",
+    ".js",
+    ".jsx",
+    ".ts",
+    ".tsx",
+    ".php",
+}
+INDENT_EXTENSIONS = {".rb"}
+STRUCTURAL_EXTENSIONS = BRACE_EXTENSIONS | INDENT_EXTENSIONS
+
+# Lines starting with '#' are preprocessor directives (or comments, for PHP)
+HASH_LINE_EXTENSIONS = {".c", ".cpp", ".h", ".hpp", ".cs", ".php"}
+# Go ends statements at newlines, so a header never spans lines
+NEWLINE_STATEMENT_EXTENSIONS = {".go"}
+
+CONTROL_KEYWORDS = {
+    "if",
+    "else",
+    "elif",
+    "elseif",
+    "for",
+    "foreach",
+    "while",
+    "do",
+    "switch",
+    "select",
+    "case",
+    "default",
+    "try",
+    "catch",
+    "finally",
+    "with",
+    "return",
+    "throw",
+    "new",
+    "await",
+    "yield",
+    "go",
+    "defer",
+    "using",
+    "lock",
+    "fixed",
+    "unsafe",
+    "checked",
+    "unchecked",
+    "synchronized",
+    "typeof",
+    "sizeof",
+}
+NOT_NAMES = CONTROL_KEYWORDS | {
+    "function",
+    "func",
+    "class",
+    "struct",
+    "interface",
+    "enum",
+    "extends",
+    "implements",
+    "async",
+    "static",
+    "const",
+    "operator",
+}
+
+_code_tokens = re.compile(
+    r"//[^\n]*|/\*.*?\*/"  # Comments
+    r'|"(?:\\.|[^"\\\n])*"'  # Strings
+    r"|'(?:\\.|[^'\\\n])*'"
+    r"|`(?:\\.|[^`\\])*`",  # Template literals, Go raw strings
+    re.DOTALL,
+)
+_hash_lines = re.compile(r"^[ \t]*#[^\n]*(?:\\\n[^\n]*)*", re.MULTILINE)
+_annotation = re.compile(r"@[\w$.]+(?:\s*\([^()]*\))?")
+_type_definition = re.compile(
+    r"\b(?:class|interface|struct|enum|namespace|trait|record)\s+"
+    r"(?:class\s+|struct\s+)?([A-Za-z_$][\w$]*)"
+    r"|^\s*type\s+([A-Za-z_]\w*)",
+    re.MULTILINE,
+)
+_go_func = re.compile(r"^\s*func\b\s*(?:\([^()]*\)\s*)?([A-Za-z_]\w*)?")
+# Lines after a signature's `)` that still belong to it
+_signature_continuation = re.compile(r"\s*(?:throws\b|:|=>|->)")
+_last_identifier = re.compile(r"([A-Za-z_$~][\w$]*)\s*(?:<[^()]*>)?\s*$")
+_assignment = re.compile(r"([A-Za-z_$][\w$]*)\s*(?::[^=]*)?(?<![=!<>])=(?![=>])(.*)$")
+_function_expression = re.compile(r"^\s*(?:async\s+)?function\b|=>\s*$")
+
+
+def _mask(code: str, hash_lines: bool) -> str:
+    """Blank out comments and string contents, keeping offsets and newlines."""
+
+    def blank(match: re.Match) -> str:
+        text = match.group()
+        if text[0] in "\"'`":
+            inner = re.sub(r"[^\n]", " ", text[1:-1])
+            return text[0] + inner + text[-1]
+        return re.sub(r"[^\n]", " ", text)
+
+    if hash_lines:
+        code = _hash_lines.sub(blank, code)
+    return _code_tokens.sub(blank, code)
+
+
+def _is_balanced(text: str) -> bool:
+    depth = 0
+    for char in text:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def get_definition(header: str) -> Optional[tuple[str, int]]:
+    """Return (name, offset into header) if a block header defines something.
+
+    `header` is the masked code between the previous statement and a `{`.
+    """
+    header = _annotation.sub(lambda m: " " * len(m.group()), header)
+    # Without semicolons (JS, Go), a new line after the last `)` is a new statement
+    tail_start = header.rfind(")") + 1
+    line_start = header.rfind("\n", tail_start) + 1
+    if line_start > tail_start and header[line_start:].strip():
+        if not _signature_continuation.match(header[line_start:]):
+            definition = get_definition(header[line_start:])
+            if definition is None:
+                return None
+            return definition[0], line_start + definition[1]
+    paren = header.find("(")
+    if paren == -1:
+        # A type, e.g. `public class Foo extends Bar`, `type Foo struct`
+        matches = list(_type_definition.finditer(header))
+        if not matches:
+            return None
+        group = 1 if matches[-1].group(1) else 2
+        name = matches[-1].group(group)
+        if name in NOT_NAMES:
+            return None
+        if group == 1 and "=" in header[matches[-1].end() :]:
+            return None  # An initializer, e.g. `struct point p = {1, 2}`
+        return name, matches[-1].start(group)
+
+    # A function, e.g. `int main(void)`, `func (s *S) Name() error`, `foo = () =>`.
+    # Only the line holding the parameters counts, so statements above it that
+    # weren't terminated (no semicolons) don't get in the way.
+    start = header.rfind("\n", 0, paren) + 1
+    statement = header[start:]
+    words = statement.split()
+    if not words or words[0] in CONTROL_KEYWORDS or not _is_balanced(statement):
+        return None
+    name = None
+    go_func = _go_func.match(statement)
+    if go_func:
+        name = go_func.group(1)  # None for anonymous funcs
+    else:
+        prefix = statement[: statement.find("(")]
+        assignment = _assignment.search(prefix)
+        if assignment:
+            if _function_expression.search(
+                assignment.group(2) + statement[len(prefix) :]
+            ):
+                name = assignment.group(1)
+        else:
+            last_identifier = _last_identifier.search(prefix)
+            if last_identifier:
+                name = last_identifier.group(1)
+    if name is None or name in NOT_NAMES:
+        return None
+    return name, start + len(statement) - len(statement.lstrip())
+
+
+def get_brace_chunks(code: str, extension: str) -> list[RawChunk]:
+    masked = _mask(code, hash_lines=extension in HASH_LINE_EXTENSIONS)
+    newline_statements = extension in NEWLINE_STATEMENT_EXTENSIONS
+    offsets = get_line_offsets(code)
+    chunks = list[RawChunk]()
+    seen = dict[str, int]()  # {id: count}, to tell overloads apart
+    # (id, start line, paren depth, header start) of each open brace
+    stack = list[tuple[Optional[str], int, int, int]]()
+    paren_depth = 0
+    header_start = 0
+    pattern = r"[{}();\n]" if newline_statements else r"[{}();]"
+    for match in re.finditer(pattern, masked):
+        char, position = match.group(), match.start()
+        if char == "(":
+            paren_depth += 1
+        elif char == ")":
+            paren_depth -= 1
+        elif char in ";\n":
+            if paren_depth <= 0:
+                paren_depth = 0
+                header_start = position + 1
+        elif char == "{":
+            definition = None
+            if paren_depth == 0:
+                definition = get_definition(masked[header_start:position])
+            id = None
+            start_line = 0
+            if definition is not None:
+                name, offset = definition
+                parents = [entry[0] for entry in stack if entry[0] is not None]
+                id = f"{parents[-1]}.{name}" if parents else name
+                seen[id] = seen.get(id, 0) + 1
+                if seen[id] > 1:
+                    id = f"{id}_{seen[id]}"
+                start_line = bisect_right(offsets, header_start + offset)
+            stack.append((id, start_line, paren_depth, header_start))
+            paren_depth = 0
+            header_start = position + 1
+        elif char == "}":
+            if not stack:
+                raise RagdaemonError("Unbalanced braces")
+            id, start_line, paren_depth, outer_header_start = stack.pop()
+            if id is not None:
+                end_line = bisect_right(offsets, position)
+                chunks.append(RawChunk(id=id, start_line=start_line, end_line=end_line))
+            # Braces inside parens (object literals, callbacks, destructuring) are
+            # part of the enclosing statement, so its header carries on.
+            header_start = outer_header_start if paren_depth > 0 else position + 1
+    if stack:
+        raise RagdaemonError("Unbalanced braces")
+    return chunks
+
+
+_ruby_definition = re.compile(r"^(\s*)(?:class|module|def)\s+(?:self\.)?([\w:]+[?!=]?)")
+_ruby_end = re.compile(r"^(\s*)end\b")
+# `def foo; end`, `class Error < StandardError; end` or endless `def foo(a) = a`
+_ruby_one_liner = re.compile(r"[;\s]end\s*$|^\s*def\s+[^\s(]+(?:\([^)]*\))?\s*=(?!=)")
+
+
+def get_indent_chunks(code: str) -> list[RawChunk]:
+    """Match Ruby class/module/def lines to the `end` at the same indentation."""
+    chunks = list[RawChunk]()
+    seen = dict[str, int]()
+    stack = list[tuple[str, int, str]]()  # (id, start line, indentation)
+    for i, line in enumerate(code.split("\n"), start=1):
+        definition = _ruby_definition.match(line)
+        if definition:
+            indentation, name = definition.groups()
+            name = name.split("::")[-1]
+            id = f"{stack[-1][0]}.{name}" if stack else name
+            seen[id] = seen.get(id, 0) + 1
+            if seen[id] > 1:
+                id = f"{id}_{seen[id]}"
+            if _ruby_one_liner.search(line):
+                chunks.append(RawChunk(id=id, start_line=i, end_line=i))
+            else:
+                stack.append((id, i, indentation))
+            continue
+        end = _ruby_end.match(line)
+        if end and stack and end.group(1) == stack[-1][2]:
+            id, start_line, _ = stack.pop()
+            chunks.append(RawChunk(id=id, start_line=start_line, end_line=i))
+    if stack:
+        raise RagdaemonError("Unmatched definitions")
+    return chunks
+
+
+def _chunk_document(document: str) -> list[Chunk]:
+    lines = document.split("\n")
+    file_path = lines[0].strip()
+    code = "\n".join(lines[1:])
+    extension = Path(file_path).suffix
+    if extension in BRACE_EXTENSIONS:
+        raw_chunks = get_brace_chunks(code, extension)
+    elif extension in INDENT_EXTENSIONS:
+        raw_chunks = get_indent_chunks(code)
+    else:
+        raise RagdaemonError(f"No structural chunker for {extension}")
+    for chunk in raw_chunks:
+        chunk["id"] = f"{file_path}:{chunk['id']}"
+    return keep_closing_lines(resolve_raw_chunks(document, raw_chunks), raw_chunks)
+
+
+def keep_closing_lines(chunks: list[Chunk], raw_chunks: list[RawChunk]) -> list[Chunk]:
+    """Give each parent back its lines after its last child, e.g. a closing brace.
+
+    resolve_raw_chunks ends a parent at its last child, as python blocks do, which
+    would leave the closing line to the enclosing chunk or BASE.
+    """
+    lines = {c["id"]: parse_path_ref(c["ref"])[1] or LineRanges() for c in chunks}
+    for parent in raw_chunks:
+        children_end = max(
+            (
+                child["end_line"]
+                for child in raw_chunks
+                if child["id"].startswith(parent["id"] + ".")
+            ),
+            default=None,
+        )
+        if children_end is None or parent["end_line"] <= children_end:
+            continue
+        tail = LineRanges([(children_end + 1, parent["end_line"])])
+        for id in lines:
+            lines[id] -= tail
+        lines[parent["id"]] |= tail
+    output = list[Chunk]()
+    for chunk in chunks:
+        file = chunk["id"].split(":")[0]
+        ref = f"{file}:{lines[chunk['id']].to_ref()}" if lines[chunk["id"]] else file
+        output.append(Chunk(id=chunk["id"], ref=ref))
+    return output
+
+
+async def chunk_document(
+    document: str, executor: Optional[Executor] = None
+) -> list[Chunk]:
+    """Chunk a non-python document off the event loop, in executor if given."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, _chunk_document, document)
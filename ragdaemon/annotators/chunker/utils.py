@@ -1,6 +1,6 @@
 from typing import TypedDict
 
-from ragdaemon.utils import lines_set_to_ref
+from ragdaemon.line_ranges import LineRanges
 
 
 class RawChunk(TypedDict):
@@ -15,6 +15,10 @@ class Chunk(TypedDict):
 
 
 def resolve_chunk_parent(id: str, nodes: set[str]) -> str | None:
+    """Return the closest existing parent of a chunk id, e.g. file:a.b -> file:a.
+
+    `nodes` only needs to contain the chunk ids of the same file.
+    """
     file, chunk_str = id.split(":")
     if chunk_str == "BASE":
         return file
@@ -36,24 +40,23 @@ def resolve_chunk_parent(id: str, nodes: set[str]) -> str | None:
 def resolve_raw_chunks(document: str, chunks: list[RawChunk]) -> list[Chunk]:
     """Take a list of {id, start_line, end_line} and return a corrected list of {id, ref}."""
 
-    # Convert to {id: set(lines)} for easier manipulation
-    id_sets = {c["id"]: set(range(c["start_line"], c["end_line"] + 1)) for c in chunks}
+    # Convert to {id: LineRanges} for easier manipulation
+    id_sets = {c["id"]: LineRanges([(c["start_line"], c["end_line"])]) for c in chunks}
 
-    def update_parent_nodes(id: str, _id_sets: dict[str, set[int]]):
+    def update_parent_nodes(id: str, _id_sets: dict[str, LineRanges]):
         parent_lines = _id_sets[id]
         child_chunks = {k: v for k, v in _id_sets.items() if k.startswith(id + ".")}
         if child_chunks:
             # Make sure end_line of each 'parent' chunk covers all children
-            start_line = min(parent_lines)
+            start_line = parent_lines.start
             end_line = start_line
             for child_lines in child_chunks.values():
                 if not child_lines:
                     continue
-                end_line = max(end_line, max(child_lines))
-            parent_lines = set(range(start_line, end_line + 1))
+                end_line = max(end_line, child_lines.end)
+            parent_lines = LineRanges([(start_line, end_line)])
             # Remove child lines from parent lines
-            for child_lines in child_chunks.values():
-                parent_lines -= child_lines
+            parent_lines -= LineRanges().union(*child_chunks.values())
             _id_sets[id] = parent_lines
         return _id_sets
 
@@ -66,17 +69,16 @@ def resolve_raw_chunks(document: str, chunks: list[RawChunk]) -> list[Chunk]:
     output = list[Chunk]()
     if id_sets:
         # Generate a 'BASE chunk' with all lines not already part of a chunk
-        base_chunk_lines = set(range(1, len(file_lines)))
-        for lines in id_sets.values():
-            base_chunk_lines -= lines
-        lines_ref = lines_set_to_ref(base_chunk_lines)
+        base_chunk_lines = LineRanges([(1, len(file_lines) - 1)])
+        base_chunk_lines -= LineRanges().union(*id_sets.values())
+        lines_ref = base_chunk_lines.to_ref()
         ref = f"{file}:{lines_ref}" if lines_ref else file
         base_chunk = Chunk(id=f"{file}:BASE", ref=ref)
         output.append(base_chunk)
 
     # Convert to refs and return
     for id, lines in id_sets.items():
-        lines_ref = lines_set_to_ref(lines)
+        lines_ref = lines.to_ref()
         ref = f"{file}:{lines_ref}" if lines_ref else file
         output.append(Chunk(id=id, ref=ref))
     return output
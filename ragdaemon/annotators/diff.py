@@ -1,60 +1,165 @@
+import codecs
+import hashlib
 import json
 import re
+import tempfile
+from copy import deepcopy
+from io import BytesIO
+from typing import Any, Iterable, Iterator, Optional, TypedDict
 
 from ragdaemon.annotators.base_annotator import Annotator
 from ragdaemon.database import Database
-from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.document_store import document_store
+from ragdaemon.graph import FileChanges, KnowledgeGraph
 from ragdaemon.errors import RagdaemonError
+from ragdaemon.tokens import truncate_stored
 from ragdaemon.utils import (
-    get_document,
+    get_diff_document,
     hash_str,
     parse_diff_id,
-    parse_path_ref,
-    truncate,
 )
 
 
-def get_chunks_from_diff(id: str, diff: str) -> dict[str, str]:
-    # Match files and line numbers
-    file_regex = re.compile(r"^diff --git a/(.+) b/(.+)$")
-    hunk_header_regex = re.compile(r"^@@ -\d+,\d+ \+(\d+),(\d+) @@.*$")
+_file_header = re.compile(r"^diff --git a/(.+) b/(.+)$")
+_hunk_header = re.compile(r"^@@ -\d+,\d+ \+(\d+),(\d+) @@.*$")
+
+
+class DiffHunk(TypedDict):
+    id: str  # e.g. DEFAULT:path/to/file:1-5, with the lines changed in the file
+    ref: str  # e.g. DEFAULT:12-20, with the hunk's lines in the diff
+    start: int  # Byte offsets of the hunk's lines in the diff output
+    end: int
+
 
-    chunks = {}
+def iter_diff_hunks(
+    id: str, lines: Iterable[bytes], first_line: int = 0
+) -> Iterator[DiffHunk]:
+    """Parse git diff output into hunks in a single pass, as it's read.
+
+    Only file and hunk header lines are decoded and matched. Refs count lines from
+    first_line, e.g. 1 to count lines of the diff's document (after its header).
+    """
     file = None
-    i = None
-    chunk_id: str | None = None
-    chunk_ref_start = None
-    for i, line in enumerate(diff.split("\n")):
-        file_match = file_regex.match(line)
-        hunk_header_match = hunk_header_regex.match(line)
-        if (file_match or hunk_header_match) and (
-            file and chunk_id and chunk_ref_start
-        ):
-            chunk_ref_end = i - 1
-            chunk_ref = f"{id}:{chunk_ref_start}-{chunk_ref_end}"
-            chunks[chunk_id] = chunk_ref
-            chunk_id = None
-            chunk_ref_start = None
-        if file_match:
-            file = file_match.group(2)  # Ending file name
-        elif hunk_header_match:
-            chunk_ref_start = i
-            start_line = int(hunk_header_match.group(1))
-            num_lines = int(hunk_header_match.group(2))
-            end_line = start_line + num_lines - 1
-            if end_line > start_line:
-                lines_ref = f":{start_line}-{end_line}"
-            elif end_line == start_line:
-                lines_ref = f":{start_line}"
-            else:
-                lines_ref = ""
-            chunk_id = f"{id}:{file}{lines_ref}"
-    if i and file and chunk_id and chunk_ref_start:
-        chunk_ref_end = i
-        chunk_ref = f"{id}:{chunk_ref_start}-{chunk_ref_end}"
-        chunks[chunk_id] = chunk_ref
+    hunk_id: str | None = None
+    ref_start = start = offset = 0
+    i = first_line - 1
+    ends_with_newline = False
+    for i, line in enumerate(lines, start=first_line):
+        if line.startswith(b"diff --git ") or line.startswith(b"@@ -"):
+            text = line.rstrip(b"\n").decode("utf-8", errors="replace")
+            file_match = _file_header.match(text)
+            hunk_match = None if file_match else _hunk_header.match(text)
+            if (file_match or hunk_match) and file and hunk_id is not None:
+                ref = f"{id}:{ref_start}-{i - 1}"
+                yield DiffHunk(id=hunk_id, ref=ref, start=start, end=offset - 1)
+                hunk_id = None
+            if file_match:
+                file = file_match.group(2)  # Ending file name
+            elif hunk_match:
+                ref_start, start = i, offset
+                start_line = int(hunk_match.group(1))
+                num_lines = int(hunk_match.group(2))
+                end_line = start_line + num_lines - 1
+                if end_line > start_line:
+                    lines_ref = f":{start_line}-{end_line}"
+                elif end_line == start_line:
+                    lines_ref = f":{start_line}"
+                else:
+                    lines_ref = ""
+                hunk_id = f"{id}:{file}{lines_ref}"
+        offset += len(line)
+        ends_with_newline = line.endswith(b"\n")
+    if file and hunk_id is not None:
+        # A trailing newline leaves an empty last line, which the last hunk includes
+        ref_end = i + 1 if ends_with_newline else i
+        yield DiffHunk(
+            id=hunk_id, ref=f"{id}:{ref_start}-{ref_end}", start=start, end=offset
+        )
+
+
+def get_chunks_from_diff(id: str, diff: str) -> dict[str, str]:
+    """Return {hunk id: hunk ref}, with refs counting lines of diff from 0."""
+    lines = BytesIO(diff.encode())
+    return {hunk["id"]: hunk["ref"] for hunk in iter_diff_hunks(id, lines)}
+
+
+class DiffOutput:
+    """The output of one git diff, read once to hash its document and find its hunks.
+
+    The text is spooled to a temporary file past max_size bytes, so hunks can be read
+    back without holding a large diff in memory.
+    """
+
+    def __init__(
+        self,
+        diff_args: str,
+        id: str,
+        lines: Iterable[bytes],
+        max_size: int = 32_000_000,
+    ):
+        # e.g. "git diff HEAD\n"; hunk refs start with id, which may differ from args
+        self.header = get_diff_document(diff_args, "")
+        self.hunk_header = get_diff_document(id, "")
+        self._text = tempfile.SpooledTemporaryFile(max_size=max_size)
+        md5 = hashlib.md5(self.header.encode())
+
+        def read(lines: Iterable[bytes]) -> Iterator[bytes]:
+            for line in lines:
+                md5.update(line)
+                self._text.write(line)
+                yield line
 
-    return chunks
+        # Later hunks with the same id replace earlier ones
+        self.hunks = {
+            hunk["id"]: hunk for hunk in iter_diff_hunks(id, read(lines), first_line=1)
+        }
+        self.checksum = md5.hexdigest()  # Same as hash_str(self.document())
+
+    def _read(self, start: int = 0, end: Optional[int] = None) -> str:
+        self._text.seek(start)
+        data = self._text.read(-1 if end is None else end - start)
+        return data.decode("utf-8", errors="replace")
+
+    def document(self) -> str:
+        return self.header + self._read()
+
+    def iter_document(self, size: int = 1_000_000) -> Iterator[str]:
+        """Yield document() in parts decoded from about size bytes at a time."""
+        yield self.header
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._text.seek(0)
+        while data := self._text.read(size):
+            yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+
+    def hunk_document(self, hunk: DiffHunk) -> str:
+        return self.hunk_header + self._read(hunk["start"], hunk["end"])
+
+    def close(self):
+        self._text.close()
+
+
+class DiffSnapshot(TypedDict):
+    checksum: str  # Of the whole diff's document
+    nodes: dict[str, dict[str, Any]]  # {id: data} of the diff node and its hunks
+
+
+def get_commit_revisions(diff_args: str) -> Optional[tuple[str, list[str]]]:
+    """Split diff args that compare two commits into (separator, revisions).
+
+    Returns None for diffs against the working tree or index (e.g. "", "HEAD",
+    "--cached"), or with any options, since those can change at any time.
+    """
+    tokens = diff_args.split()
+    if not tokens or any(token.startswith("-") for token in tokens):
+        return None
+    if len(tokens) == 1 and ".." in tokens[0]:
+        separator = "..." if "..." in tokens[0] else ".."
+        revisions = [rev or "HEAD" for rev in tokens[0].split(separator, 1)]
+        return separator, revisions
+    if len(tokens) == 2 and not any(".." in token for token in tokens):
+        return " ", tokens
+    return None
 
 
 class Diff(Annotator):
@@ -65,81 +170,181 @@ class Diff(Annotator):
             raise RagdaemonError("diff cannot contain ':'")
         super().__init__(*args, **kwargs)
         self.diff_args = diff
+        self._diff: Optional[DiffOutput] = None  # Fetched by is_complete for annotate
+        # A diff between two commits never changes, so its nodes are kept under the
+        # commits' SHAs; documents are already in the content-addressed store.
+        self._snapshot: Optional[tuple[str, DiffSnapshot]] = None
 
     @property
     def id(self) -> str:
         return "DEFAULT" if not self.diff_args else self.diff_args
 
+    def resolve_commits(self) -> Optional[str]:
+        """Return a key of the SHAs this diff compares, or None if it isn't commits."""
+        commit_revisions = get_commit_revisions(self.diff_args)
+        if commit_revisions is None:
+            return None
+        separator, revisions = commit_revisions
+        shas = self.io.resolve_commits(revisions)
+        return None if shas is None else separator.join(shas)
+
+    def get_snapshot(self, key: Optional[str]) -> Optional[DiffSnapshot]:
+        if key is None or self._snapshot is None or self._snapshot[0] != key:
+            return None
+        return self._snapshot[1]
+
+    def fetch_diff(self) -> DiffOutput:
+        lines = self.io.iter_git_diff(self.diff_args)
+        return DiffOutput(self.diff_args, self.id, lines)
+
     def is_complete(self, graph: KnowledgeGraph, db: Database) -> bool:
         if not self.io.is_git_repo():
             return True
 
-        document = get_document(self.diff_args, self.io, type="diff")
-        checksum = hash_str(document)
-        return self.id in graph and graph.nodes[self.id]["checksum"] == checksum
+        if self._diff is not None:
+            self._diff.close()
+            self._diff = None
+        diff = None
+        snapshot = self.get_snapshot(self.resolve_commits())
+        if snapshot is not None:
+            checksum = snapshot["checksum"]
+        else:
+            diff = self.fetch_diff()
+            checksum = diff.checksum
+        complete = self.id in graph and graph.nodes[self.id]["checksum"] == checksum
+        if complete:
+            # Hunks lose their links when the chunks of a changed file are replaced
+            for chunk_id in graph.nodes[self.id]["chunks"]:
+                _, path, _ = parse_diff_id(chunk_id)
+                if (
+                    path
+                    and path.as_posix() in graph
+                    and not self.get_links(graph, chunk_id)
+                ):
+                    complete = False
+                    break
+        if diff is not None:
+            if complete:
+                diff.close()  # Its spooled temporary file isn't needed
+            else:
+                self._diff = diff  # Kept for the annotate call that follows
+        return complete
+
+    def get_links(self, graph: KnowledgeGraph, chunk_id: str) -> list[str]:
+        return [
+            source
+            for source, _, type in graph.in_edges(chunk_id, data="type")
+            if type == "link"
+        ]
 
-    async def annotate(
-        self, graph: KnowledgeGraph, db: Database, refresh: str | bool = False
-    ) -> KnowledgeGraph:
-        if not self.io.is_git_repo():
-            return graph
+    def link_chunk(self, graph: KnowledgeGraph, chunk_id: str):
+        """Link a diff chunk to all overlapping chunks (if file has chunks) or to the file"""
+        _, path, lines = parse_diff_id(chunk_id)
+        if not path:
+            return
+        path_str = path.as_posix()
+        if path_str not in graph:  # Removed files
+            if self.verbose > 1:
+                print(f"File {path_str} not in graph")
+            return
+        link_to = graph.get_line_index(path_str).query(lines) if lines else set()
+        if len(link_to) == 0:
+            link_to.add(path_str)
+        for node in link_to:
+            graph.add_edge(node, chunk_id, type="link")
 
-        graph_nodes = {
-            node
-            for node, data in graph.nodes(data=True)
-            if data and data.get("type") == "diff"
-        }
-        graph.remove_nodes_from(graph_nodes)
+    def relink(
+        self, graph: KnowledgeGraph, checksum: str, changes: Optional[FileChanges]
+    ) -> bool:
+        """If the graph already has this diff, re-link hunks of changed files only."""
+        if (
+            changes is None
+            or self.id not in graph
+            or graph.nodes[self.id]["checksum"] != checksum
+        ):
+            return False
+        for chunk_id in graph.nodes[self.id]["chunks"]:
+            _, path, _ = parse_diff_id(chunk_id)
+            if path and path.as_posix() in changes["changed"]:
+                graph.remove_edges_from(
+                    (source, chunk_id) for source in self.get_links(graph, chunk_id)
+                )
+                self.link_chunk(graph, chunk_id)
+            elif not self.get_links(graph, chunk_id):
+                self.link_chunk(graph, chunk_id)
+        return True
 
-        checksums = dict[str, str]()
-        document = get_document(self.diff_args, self.io, type="diff")
-        checksum = hash_str(document)
-        chunks = get_chunks_from_diff(id=self.id, diff=document)
-        data = {
+    def take_snapshot(self, diff: DiffOutput) -> DiffSnapshot:
+        """Build the diff's nodes, saving their documents to the document store."""
+        chunks = {hunk_id: hunk["ref"] for hunk_id, hunk in diff.hunks.items()}
+        nodes = dict[str, dict[str, Any]]()
+        nodes[self.id] = {
             "id": self.id,
             "ref": self.diff_args,
             "type": "diff",
-            "document": document,
-            "checksum": checksum,
+            "checksum": diff.checksum,
             "chunks": chunks,
         }
-        graph.add_node(self.id, **data)
-        checksums[self.id] = checksum
-
+        document_store.put_parts(diff.checksum, diff.iter_document())
         for chunk_id, chunk_ref in chunks.items():
-            document = get_document(chunk_ref, self.io, type="diff")
+            document = diff.hunk_document(diff.hunks[chunk_id])
             chunk_checksum = hash_str(document)
-            data = {
+            nodes[chunk_id] = {
                 "id": chunk_id,
                 "ref": chunk_ref,
                 "type": "diff",
-                "document": document,
                 "checksum": chunk_checksum,
             }
-            graph.add_node(chunk_id, **data)
-            graph.add_edge(self.id, chunk_id, type="diff")
-            checksums[chunk_id] = chunk_checksum
+            document_store.put(chunk_checksum, document)
+        return DiffSnapshot(checksum=diff.checksum, nodes=nodes)
 
-            # Link it to all overlapping chunks (if file has chunks) or to the file
-            _, path, lines = parse_diff_id(chunk_id)
-            if not path:
-                continue
-            path_str = path.as_posix()
-            if path_str not in graph:  # Removed files
-                if self.verbose > 1:
-                    print(f"File {path_str} not in graph")
-                continue
-            link_to = set()
-            for node, data in graph.nodes(data=True):
-                if not node.startswith(f"{path_str}:") or data.get("type") != "chunk":
-                    continue
-                _, _lines = parse_path_ref(data["ref"])
-                if lines and _lines and lines.intersection(_lines):
-                    link_to.add(node)
-            if len(link_to) == 0:
-                link_to.add(path_str)
-            for node in link_to:
-                graph.add_edge(node, chunk_id, type="link")
+    async def annotate(
+        self,
+        graph: KnowledgeGraph,
+        db: Database,
+        refresh: str | bool = False,
+        changes: Optional[FileChanges] = None,
+    ) -> KnowledgeGraph:
+        if not self.io.is_git_repo():
+            return graph
+
+        # The whole update uses at most one git diff: none if this compares commits
+        # that were diffed before, else the one fetched by is_complete if it ran (it
+        # doesn't on refresh), else a new one.
+        key = self.resolve_commits()
+        snapshot = None if refresh else self.get_snapshot(key)
+        diff, self._diff = self._diff, None
+        if snapshot is not None:
+            if diff is not None:
+                diff.close()
+            if self.relink(graph, snapshot["checksum"], changes):
+                return graph
+        else:
+            if diff is None:
+                diff = self.fetch_diff()
+            try:
+                if self.relink(graph, diff.checksum, changes):
+                    return graph
+                snapshot = self.take_snapshot(diff)
+            finally:
+                diff.close()
+            if key is not None:
+                self._snapshot = (key, snapshot)
+
+        graph_nodes = {
+            node
+            for node, data in graph.nodes(data=True)
+            if data and data.get("type") == "diff"
+        }
+        graph.remove_nodes_from(graph_nodes)
+
+        checksums = dict[str, str]()
+        for node, data in snapshot["nodes"].items():
+            graph.add_node(node, **deepcopy(data))
+            checksums[node] = data["checksum"]
+            if node != self.id:
+                graph.add_edge(self.id, node, type="diff")
+                self.link_chunk(graph, node)
 
         # Sync with remote DB
         ids = list(set(checksums.values()))
@@ -150,11 +355,11 @@ class Diff(Annotator):
             if checksum in db_data:
                 continue
             data = {}
-            document = graph.nodes[id].get("document")
             chunks = graph.nodes[id].get("chunks")
             if chunks:
                 data["chunks"] = json.dumps(chunks)
-            document, truncate_ratio = truncate(document, db.embedding_model)
+            # Reads no more of a large diff than can be embedded
+            document, truncate_ratio = truncate_stored(checksum, db.embedding_model)
             if self.verbose > 1 and truncate_ratio > 0:
                 print(f"Truncated {id} by {truncate_ratio:.2%}")
             add_to_db["ids"].append(checksum)
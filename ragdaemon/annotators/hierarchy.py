@@ -1,107 +1,268 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 from ragdaemon.annotators.base_annotator import Annotator
 from ragdaemon.database import Database
-from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.document_store import document_store
+from ragdaemon.graph import (
+    FileChanges,
+    KnowledgeGraph,
+    get_file_checksums,
+    get_hierarchy_children,
+    get_hierarchy_descendants,
+)
 from ragdaemon.errors import RagdaemonError
-from ragdaemon.utils import get_document, hash_str, truncate
+from ragdaemon.get_paths import get_path_matcher
+from ragdaemon.scan_index import ScanIndex
+from ragdaemon.tokens import token_counts, truncate
+from ragdaemon.utils import get_document, hash_str, mentat_dir_path
 
 
 class Hierarchy(Annotator):
     name = "hierarchy"
 
-    def __init__(self, *args, ignore_patterns: set[Path] = set(), **kwargs):
+    def __init__(
+        self,
+        *args,
+        ignore_patterns: set[Path] = set(),
+        scan_index_path: Optional[Path | str] = None,
+        max_workers: Optional[int] = None,
+        **kwargs,
+    ):
         # match_path_with_patterns expects type abs_path, even if it's a glob
         self.ignore_patterns = {Path(p).resolve() for p in ignore_patterns}
         super().__init__(*args, **kwargs)
+        # Stored next to the graph json so unchanged files aren't re-read on restart
+        if scan_index_path is None:
+            scan_index_path = (
+                mentat_dir_path
+                / "ragdaemon"
+                / f"ragdaemon-{self.io.cwd.name}-scan.json"
+            )
+        self.scan_index = ScanIndex(Path(scan_index_path), cwd=self.io.cwd.as_posix())
+        # Reads are syscall-bound, so threads overlap them well. None uses the
+        # ThreadPoolExecutor default.
+        self.max_workers = max_workers
+
+    def scan_file(
+        self, path: Path, refresh: bool = False
+    ) -> Optional[tuple[Optional[str], str]]:
+        """Return (document, checksum) for a text file, or None if it isn't one.
+
+        Document is None when the scan index vouches for the file's checksum. Files
+        are read once: the same read checks the encoding and produces the document.
+        """
+        path_str = path.as_posix()
+        try:
+            stat = self.io.stat(path)
+            record = None if refresh else self.scan_index.lookup(path_str, stat)
+            if record is not None:
+                checksum = record["checksum"]
+                return None if checksum is None else (None, checksum)
+            try:
+                document = get_document(path_str, self.io)
+            except RagdaemonError:  # Not a text file
+                self.scan_index.record(path_str, stat, None)
+                return None
+        except FileNotFoundError:  # Deleted since listing
+            return None
+        checksum = hash_str(document)
+        self.scan_index.record(path_str, stat, checksum)
+        return document, checksum
 
     def is_complete(self, graph: KnowledgeGraph, db: Database) -> bool:
         # This is incorporated into annotate instead to avoid redundant reads
         return False
 
     async def annotate(
-        self, graph: KnowledgeGraph, db: Database, refresh: str | bool = False
+        self,
+        graph: KnowledgeGraph,
+        db: Database,
+        refresh: str | bool = False,
+        changes: Optional[FileChanges] = None,
     ) -> KnowledgeGraph:
-        """Build a graph of active files and directories with hierarchy edges."""
+        """Build a graph of active files and directories with hierarchy edges.
+
+        The graph is patched in place: only files whose checksum changed and their
+        parent directories are touched. If `changes` is given (e.g. by the watcher),
+        only those files are scanned, and the rest keep the checksums in the graph;
+        otherwise hierarchy lists and scans the whole tree to find its own changes.
+        """
 
-        # is_complete check
+        # is_complete check. Only files whose stat changed since the last scan are
+        # read and hashed; the rest reuse the checksum from the scan index.
+        scan_started = time.time()
         documents = dict[Path, str]()
         checksums = dict[Path, str]()
-        paths = self.io.get_paths_for_directory(exclude_patterns=self.ignore_patterns)
-        for path in paths:
-            path_str = path.as_posix()
-            documents[path] = get_document(path_str, self.io)
-            checksums[path] = hash_str(documents[path])
+        if changes is not None and not refresh and "files_checksum" in graph.graph:
+            skipped = changes["changed"] | changes["removed"]
+            for id, checksum in get_file_checksums(graph).items():
+                if id not in skipped:
+                    checksums[Path(id)] = checksum
+            exclude = get_path_matcher(self.ignore_patterns)
+            scanned_paths = [
+                Path(id)
+                for id in changes["changed"]
+                if not (exclude and exclude.match((self.io.cwd / id).resolve()))
+            ]
+        else:
+            scanned_paths = list(
+                self.io.get_paths_for_directory(
+                    exclude_patterns=self.ignore_patterns, text_only=False
+                )
+            )
+        paths = set(checksums) | set(scanned_paths)
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(executor, self.scan_file, path, bool(refresh))
+                    for path in scanned_paths
+                )
+            )
+        for path, result in zip(scanned_paths, results):
+            if result is None:
+                paths.discard(path)  # Deleted or not text-encoded
+                continue
+            document, checksums[path] = result
+            if document is not None:
+                documents[path] = document
+        self.scan_index.prune(path.as_posix() for path in paths)
+        self.scan_index.save(scan_started)
         files_checksum = hash_str(
             "".join(f"{path.as_posix()}{checksums[path]}" for path in sorted(checksums))
         )
         if not refresh and files_checksum == graph.graph.get("files_checksum"):
             return graph
 
-        # Initialize a new graph from scratch with same cwd
-        cwd = Path(graph.graph["cwd"])
-        graph = KnowledgeGraph()
-        graph.graph["cwd"] = str(cwd)
+        if refresh:  # Start from scratch with same cwd
+            cwd = graph.graph["cwd"]
+            graph = KnowledgeGraph()
+            graph.graph["cwd"] = cwd
         graph.graph["files_checksum"] = files_checksum
 
-        directories = set()
-        edges = set()
-        for path in paths:
+        # Only files that were added or whose checksum changed are (re)added; the rest
+        # of the graph, including other annotators' data, is left as it is.
+        previous = {
+            Path(id): checksum for id, checksum in get_file_checksums(graph).items()
+        }
+        removed = set(previous) - paths
+        dirty = {path for path in paths if previous.get(path) != checksums[path]}
+
+        # Dirty files skipped by the scan index have to be read after all, unless
+        # their document is already stored (e.g. a change that was reverted).
+        to_read = [
+            path
+            for path in dirty
+            if path not in documents and checksums[path] not in document_store
+        ]
+        if to_read:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(executor, self.scan_file, path, True)
+                        for path in to_read
+                    )
+                )
+            for path, result in zip(to_read, results):
+                if result is None:
+                    paths.discard(path)
+                    dirty.discard(path)
+                    del checksums[path]
+                    if path in previous:
+                        removed.add(path)
+                    continue
+                document, checksums[path] = result
+                documents[path] = document or ""
+                if previous.get(path) == checksums[path]:
+                    dirty.discard(path)
+
+        for path in dirty:
+            if path in documents:
+                document_store.put(checksums[path], documents[path])
+
+        # Remove stale file nodes along with their chunks
+        for path in removed | dirty:
+            path_str = path.as_posix()
+            if path_str in graph:
+                graph.remove_nodes_from(get_hierarchy_descendants(graph, path_str))
+                graph.remove_node(path_str)
+
+        directories = set[str]()
+        for path in removed | dirty:
+            for parent in path.parents:
+                directories.add(parent.as_posix() if parent.parts else "ROOT")
+
+        for path in dirty:
             path_str = path.as_posix()
             data = {
                 "id": path_str,
                 "type": "file",
                 "ref": path_str,
-                "document": documents[path],
                 "checksum": checksums[path],
             }
             graph.add_node(path_str, **data)
-            # Record parents & edges
+            # Link to parents, creating directories as needed
             _last = path
             for parent in path.parents:
-                if len(parent.parts) == 0:
-                    parent = Path("ROOT")
-                directories.add(parent.as_posix())
-                edges.add((parent.as_posix(), _last.as_posix()))
+                parent_str = parent.as_posix() if parent.parts else "ROOT"
+                if not graph.has_edge(parent_str, _last.as_posix()):
+                    graph.add_edge(parent_str, _last.as_posix(), type="hierarchy")
                 _last = parent
 
-        for source, target in edges:
-            for id in (source, target):
-                if id not in graph and id not in directories:
-                    raise RagdaemonError(f"Node {id} not found in graph")
-            graph.add_edge(source, target, type="hierarchy")
-
-        # Fill-in directory data (same process as get_document for dirs, but more efficient)
+        # Fill-in directory data (same process as get_document for dirs, but more
+        # efficient), deepest first so children are up to date.
+        changed_directories = set[str]()
         for dir in sorted(
-            directories, key=lambda x: len(x) if x != "ROOT" else 0, reverse=True
+            directories,
+            key=lambda x: len(Path(x).parts) if x != "ROOT" else 0,
+            reverse=True,
         ):
-            children = sorted(node for node in graph.successors(dir))
+            if dir not in graph:
+                continue
+            children = sorted(get_hierarchy_children(graph, dir))
+            if not children:  # All files removed
+                graph.remove_node(dir)
+                continue
             document = f"{dir}\n" + "\n".join(children)
-            checksum = hash_str("".join(checksums[Path(child)] for child in children))
+            checksum = hash_str(
+                "".join(graph.nodes[child]["checksum"] for child in children)
+            )
+            if graph.nodes[dir].get("checksum") == checksum:
+                continue
             data = {
                 "id": dir,
                 "type": "directory",
                 "ref": dir,
-                "document": document,
                 "checksum": checksum,
             }
-            checksums[Path(dir)] = checksum
+            document_store.put(checksum, document)
+            graph.nodes[dir].clear()
             graph.nodes[dir].update(data)
+            changed_directories.add(dir)
 
         # Sync with remote DB
-        ids = list(set(checksums.values()))
+        updated = {path.as_posix(): checksums[path] for path in dirty}
+        for dir in changed_directories:
+            updated[dir] = graph.nodes[dir]["checksum"]
+        ids = list(set(updated.values()))
         response = db.get(ids=ids, include=["metadatas"])
         db_data = {id: data for id, data in zip(response["ids"], response["metadatas"])}
         add_to_db = {"ids": [], "documents": []}
-        for path, checksum in checksums.items():
+        for id, checksum in updated.items():
             if checksum in db_data:
-                data = db_data[checksum]
-                graph.nodes[path.as_posix()].update(data)
+                data = token_counts.load(checksum, db_data[checksum])
+                graph.nodes[id].update(data)
             else:
-                document = graph.nodes[path.as_posix()]["document"]
-                document, truncate_ratio = truncate(document, db.embedding_model)
+                document = document_store.get(checksum)
+                document, truncate_ratio = truncate(
+                    document, db.embedding_model, checksum=checksum
+                )
                 if self.verbose > 1 and truncate_ratio > 0:
-                    print(f"Truncated {path} by {truncate_ratio:.2%}")
+                    print(f"Truncated {id} by {truncate_ratio:.2%}")
                 add_to_db["ids"].append(checksum)
                 add_to_db["documents"].append(document)
         if len(add_to_db["ids"]) > 0:
@@ -1,9 +1,11 @@
+from typing import Optional
+
 import numpy as np
 from tqdm import tqdm
 
 from ragdaemon.annotators.base_annotator import Annotator
 from ragdaemon.database import Database
-from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.graph import FileChanges, KnowledgeGraph
 from ragdaemon.errors import RagdaemonError
 
 
@@ -103,6 +105,7 @@ class LayoutHierarchy(Annotator):
         graph: KnowledgeGraph,
         db: Database,
         refresh: str | bool = False,
+        changes: Optional[FileChanges] = None,
     ) -> KnowledgeGraph:
         """
         a. Regenerate x/y/z for all nodes
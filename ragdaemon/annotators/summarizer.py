@@ -2,7 +2,7 @@ import asyncio
 from collections import deque
 from typing import List, Optional
 
-from spice import Spice, SpiceMessages
+from spice import SpiceMessages
 from spice.models import TextModel
 from spice.spice import get_model_from_name
 from tqdm.asyncio import tqdm
@@ -10,14 +10,14 @@ from tqdm.asyncio import tqdm
 from ragdaemon.annotators.base_annotator import Annotator
 from ragdaemon.context import ContextBuilder
 from ragdaemon.database import Database
-from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.graph import FileChanges, KnowledgeGraph
 from ragdaemon.errors import RagdaemonError
 from ragdaemon.io import IO
+from ragdaemon.tokens import count_tokens, truncate
 from ragdaemon.utils import (
     DEFAULT_COMPLETION_MODEL,
     match_refresh,
     semaphore,
-    truncate,
 )
 
 
@@ -189,7 +189,7 @@ def get_document_and_context(
         max_tokens = model.context_length * (1 - prompt_buffer)
         document_tokens = round(max_tokens * 0.8)
         document, _ = truncate(document, model=model, tokens=document_tokens)
-        context_tokens = round(max_tokens - Spice().count_tokens(context, model))
+        context_tokens = round(max_tokens - count_tokens(context, model))
         context, _ = truncate(context, model=model, tokens=context_tokens)
 
     return document, context
@@ -294,13 +294,19 @@ class Summarizer(Annotator):
         await self.generate_summary(node, graph, loading_bar, refresh)
 
     async def annotate(
-        self, graph: KnowledgeGraph, db: Database, refresh: str | bool = False
+        self,
+        graph: KnowledgeGraph,
+        db: Database,
+        refresh: str | bool = False,
+        changes: Optional[FileChanges] = None,
     ) -> KnowledgeGraph:
         """Asynchronously generate or fetch summaries and add to graph/db"""
         nodes_to_summarize: set[str] = set()
+        previous_summaries = dict[str, Optional[str]]()
         for node, data in graph.nodes(data=True):
             if data is not None and data.get("type") in self.summarize_nodes:
                 nodes_to_summarize.add(node)
+                previous_summaries[node] = data.get(self.summary_field_id)
 
         if self.verbose > 1:
             loading_bar = tqdm(
@@ -314,6 +320,12 @@ class Summarizer(Annotator):
         update_db = {"ids": [], "metadatas": []}
         for node in nodes_to_summarize:
             data = graph.nodes[node]
+            # Only summaries written in this pass need saving when patching
+            if (
+                changes is not None
+                and data.get(self.summary_field_id) == previous_summaries[node]
+            ):
+                continue
             update_db["ids"].append(data["checksum"])
             metadatas = {self.summary_field_id: data[self.summary_field_id]}
             update_db["metadatas"].append(metadatas)
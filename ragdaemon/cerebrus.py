@@ -2,6 +2,7 @@ import ast
 
 from spice import Spice, SpiceMessages
 
+from ragdaemon.document_store import load_document
 from ragdaemon.graph import KnowledgeGraph
 
 
@@ -61,7 +62,12 @@ async def cerebrus(
                 break
             exec(
                 script,
-                {"print": printer.print, "answer": printer.answer, "graph": graph},
+                {
+                    "print": printer.print,
+                    "answer": printer.answer,
+                    "graph": graph,
+                    "document": lambda node: load_document(graph.nodes[node]),
+                },
             )
         except KeyboardInterrupt:
             raise
@@ -1,14 +1,24 @@
 from __future__ import annotations
 
 import re
-from copy import deepcopy
+from difflib import SequenceMatcher
 from pathlib import Path
 from typing import Any, Dict, Optional, Union
 
 from dict2xml import dict2xml
+from spice.models import Model
+
+from ragdaemon.document_store import load_document
 from ragdaemon.errors import RagdaemonError
 from ragdaemon.graph import KnowledgeGraph
 from ragdaemon.io import IO
+from ragdaemon.line_ranges import LineRanges
+from ragdaemon.tokens import (
+    count_join_tokens,
+    count_tokens,
+    count_tokens_batch,
+    get_model,
+)
 from ragdaemon.utils import get_document, parse_diff_id, parse_path_ref
 
 NestedStrDict = Union[str, Dict[str, "NestedStrDict"]]
@@ -30,12 +40,64 @@ class Comment:
         return output
 
 
+def get_git_command(diff_id: str) -> str:
+    """Return the line render_diffs puts before the diffs of a path."""
+    diff_str, _, _ = parse_diff_id(diff_id)
+    git_command = "--git diff"
+    if diff_str != "DEFAULT":
+        git_command += f" {diff_str}"
+    return f"{git_command}\n"
+
+
 def render_comments(comments: list[Comment]) -> str:
     return "\n".join(comment.render() for comment in comments)
 
 
+Opcode = tuple[str, int, int, int, int]  # difflib opcode: (tag, i1, i2, j1, j2)
+
+
+def get_line_opcodes(old_lines: list[str], new_lines: list[str]) -> list[Opcode]:
+    """Diff two versions of a document's lines, indexed like LineRanges."""
+    return SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+
+
+def remap_lines(lines: LineRanges, opcodes: list[Opcode], n_old: int) -> LineRanges:
+    """Map lines of an old document onto the new one, through the diff between them.
+
+    Unchanged lines move with the diff, a changed block is kept whole if any of its
+    old lines were, and added lines are kept if they land inside a range.
+    """
+    ranges = list[tuple[int, int]]()
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            for start, end in (lines & LineRanges([(i1, i2 - 1)])).ranges:
+                ranges.append((start - i1 + j1, end - i1 + j1))
+        elif tag == "replace":
+            if lines.overlaps(LineRanges([(i1, i2 - 1)])):
+                ranges.append((j1, j2 - 1))
+        elif tag == "insert" and i1 - 1 in lines and (i1 in lines or i1 == n_old):
+            ranges.append((j1, j2 - 1))
+    return LineRanges((max(start, 1), end) for start, end in ranges)
+
+
+def remap_line(line: int, opcodes: list[Opcode], n_new: int) -> int:
+    """Map a line of an old document onto the new one; removed lines map to the
+    line that took their place."""
+    if line == 0:
+        return 0
+    for tag, i1, i2, j1, _ in opcodes:
+        if i1 <= line < i2:
+            line = line - i1 + j1 if tag == "equal" else j1
+            break
+    return max(0, min(line, n_new))
+
+
 class ContextBuilder:
-    """Renders items from a graph into an llm-readable string."""
+    """Renders items from a graph into an llm-readable string.
+
+    Copies are copy-on-write: a copy shares the records of every path until one of
+    the two changes it, and documents are never copied.
+    """
 
     def __init__(self, graph: KnowledgeGraph, io: IO, verbose: int = 0):
         self.graph = graph
@@ -43,34 +105,128 @@ class ContextBuilder:
         self.verbose = verbose
         self.context = dict[
             str, dict[str, Any]
-        ]()  # {path: {lines, tags, document, diff}}
+        ]()  # {path: {lines, tags, document, checksum, diffs, comments}}
+
+    @property
+    def context(self) -> dict[str, dict[str, Any]]:
+        return self._context
+
+    @context.setter
+    def context(self, context: dict[str, dict[str, Any]]):
+        self._context = context
+        self._owned = set(context)  # Paths whose records no copy shares
+        self._shared = False  # Whether a copy shares _context and the caches
+        # {path: {render options: segment}} and {path: {(model, *options): tokens}}
+        self._segments = dict[str, dict[tuple[bool, bool, bool], str]]()
+        self._tokens = dict[str, dict[tuple, int]]()
+        self._file_lines = dict[str, tuple[str, list[str]]]()  # {path: (doc, lines)}
+        # {(path, model): (doc, tokens in rendered lines 1..n, cumulative)}
+        self._line_tokens = dict[tuple[str, str], tuple[str, list[int]]]()
+
+    def _unshare(self):
+        """Take our own {path: ...} dicts before changing what's in them."""
+        if self._shared:
+            self._context = dict(self._context)
+            self._segments = dict(self._segments)
+            self._tokens = dict(self._tokens)
+            self._file_lines = dict(self._file_lines)
+            self._line_tokens = dict(self._line_tokens)
+            self._shared = False
+
+    def _edit(self, path_str: str) -> dict[str, Any]:
+        """Return a path's record to change in place, copying it if it's shared."""
+        self._unshare()
+        self._segments.pop(path_str, None)
+        self._tokens.pop(path_str, None)
+        if path_str not in self._owned:
+            data = self._context[path_str]
+            self._context[path_str] = {
+                **data,
+                "tags": set(data["tags"]),
+                "diffs": set(data["diffs"]),
+                "comments": {
+                    line: list(comments) for line, comments in data["comments"].items()
+                },
+            }
+            self._owned.add(path_str)
+        return self._context[path_str]
+
+    def _remove_path(self, path_str: str):
+        self._unshare()
+        del self._context[path_str]
+        self._owned.discard(path_str)
+        self._segments.pop(path_str, None)
+        self._tokens.pop(path_str, None)
+
+    def _get_file_lines(
+        self, path_str: str, document: Optional[str] = None
+    ) -> list[str]:
+        """Return a path's document split into lines, split once per document."""
+        if document is None:
+            document = self.context[path_str]["document"]
+        cached = self._file_lines.get(path_str)
+        if cached is None or cached[0] is not document:
+            cached = (document, document.split("\n"))
+            self._file_lines[path_str] = cached
+        return cached[1]
+
+    def _get_line_tokens(self, path_str: str, document: str, model: Model) -> list[int]:
+        """Return the cumulative tokens of a document's rendered lines, from line 0."""
+        cached = self._line_tokens.get((path_str, model.name))
+        if cached is None or cached[0] is not document:
+            file_lines = self._get_file_lines(path_str, document)
+            rendered = [f"{i}:{line}\n" for i, line in enumerate(file_lines) if i]
+            cumulative = [0]
+            for tokens in count_tokens_batch(rendered, model):
+                cumulative.append(cumulative[-1] + tokens)
+            cached = (document, cumulative)
+            self._line_tokens[(path_str, model.name)] = cached
+        return cached[1]
+
+    def _share(self, other: ContextBuilder):
+        """Take on other's records and caches, copy-on-write for both of us."""
+        self._context = other._context
+        self._segments = other._segments
+        self._tokens = other._tokens
+        self._file_lines = other._file_lines
+        self._line_tokens = other._line_tokens
+        self._owned, other._owned = set[str](), set[str]()
+        self._shared = other._shared = True
 
     def copy(self):
         duplicate = ContextBuilder(self.graph, self.io, self.verbose)
-        duplicate.context = deepcopy(self.context)
+        duplicate._share(self)
         return duplicate
 
     def __add__(self, other: ContextBuilder) -> ContextBuilder:
         duplicate = self.copy()
         for path_str, data in other.context.items():
             if path_str not in duplicate.context:
-                duplicate.context[path_str] = data
-            else:
-                duplicate.context[path_str]["lines"].update(data["lines"])
-                duplicate.context[path_str]["tags"].update(data["tags"])
-                duplicate.context[path_str]["diffs"].update(data["diffs"])
-                for line, comments in data["comments"].items():
-                    duplicate.context[path_str]["comments"].setdefault(line, []).extend(
-                        comments
-                    )
+                # Share other's record, and what it has cached for it
+                duplicate._unshare()
+                duplicate._context[path_str] = data
+                other._owned.discard(path_str)
+                if path_str in other._segments:
+                    duplicate._segments[path_str] = other._segments[path_str]
+                if path_str in other._tokens:
+                    duplicate._tokens[path_str] = other._tokens[path_str]
+                continue
+            record = duplicate._edit(path_str)
+            record["lines"] |= data["lines"]
+            record["tags"].update(data["tags"])
+            record["diffs"].update(data["diffs"])
+            for line, comments in data["comments"].items():
+                record["comments"].setdefault(line, []).extend(comments)
         return duplicate
 
-    def _add_path(self, path_str: str):
-        """Create a new record in the context for the given path."""
+    def _load_document(self, path_str: str) -> str:
         document = None
         if path_str in self.graph:
-            document = self.graph.nodes[path_str]["document"]
-            if document.endswith("[TRUNCATED]"):
+            try:
+                document = load_document(self.graph.nodes[path_str])
+            except RagdaemonError:  # Missing from the document store
+                document = None
+            if document is not None and document.endswith("[TRUNCATED]"):
                 document = None
         if document is None:  # Truncated or deleted
             try:
@@ -79,14 +235,26 @@ class ContextBuilder:
             except FileNotFoundError:
                 # Or could be deleted but have a diff
                 document = f"{path_str}\n[DELETED]"
+        return document
+
+    def _add_path(self, path_str: str, document: Optional[str] = None):
+        """Create a new record in the context for the given path."""
+        if document is None:
+            document = self._load_document(path_str)
+        node = self.graph.nodes[path_str] if path_str in self.graph else {}
         message = {
-            "lines": set(),
+            "lines": LineRanges(),
             "tags": set(),
             "document": document,
+            "checksum": node.get("checksum"),  # The file's version in the graph
             "diffs": set(),
             "comments": dict[int, list[Comment]](),
         }
-        self.context[path_str] = message
+        self._unshare()
+        self._context[path_str] = message
+        self._owned.add(path_str)
+        self._segments.pop(path_str, None)
+        self._tokens.pop(path_str, None)
 
     def add_id(
         self, node_id: str, tags: list[str] = [], summary_field_id: Optional[str] = None
@@ -103,7 +271,7 @@ class ContextBuilder:
             if summary:
                 path, lines = parse_path_ref(ref)
                 path_str = path.as_posix()
-                line = 0 if not lines else max(0, min(lines) - 1)
+                line = 0 if not lines else max(0, lines.start - 1)
                 self.add_comment(path_str, summary, line, tags=["summary"])
 
     def add_ref(self, path_ref: str, tags: list[str] = []):
@@ -112,11 +280,11 @@ class ContextBuilder:
         path_str = path.as_posix()
         if path_str not in self.context:
             self._add_path(path_str)
-        self.context[path_str]["tags"].update(tags)
+        record = self._edit(path_str)
+        record["tags"].update(tags)
         if not lines:
-            document = self.context[path_str]["document"]
-            lines = list(range(1, len(document.split("\n"))))
-        self.context[path_str]["lines"].update(lines)
+            lines = LineRanges([(1, record["document"].count("\n"))])
+        record["lines"] |= lines
 
     def add_diff(self, id: str):
         """Take a diff id and add to context"""
@@ -126,8 +294,9 @@ class ContextBuilder:
         path_str = path.as_posix()
         if path_str not in self.context:
             self._add_path(path_str)
-        self.context[path_str]["diffs"].add(id)
-        self.context[path_str]["tags"].add("diff")
+        record = self._edit(path_str)
+        record["diffs"].add(id)
+        record["tags"].add("diff")
 
     def add_comment(
         self,
@@ -139,9 +308,10 @@ class ContextBuilder:
         path_str = Path(path_str).as_posix()
         if not self.context.get(path_str):
             self._add_path(path_str)
+        record = self._edit(path_str)
         if not line:
             line = 0  # file-level comment
-        self.context[path_str]["comments"].setdefault(line, []).append(
+        record["comments"].setdefault(line, []).append(
             Comment(
                 content=comment,
                 tags=tags,
@@ -153,13 +323,14 @@ class ContextBuilder:
             if self.verbose > 0:
                 print(f"Warning: no matching message found for {path_str}.")
             return
+        record = self._edit(path_str)
         if tags:
-            for line, comments in self.context[path_str]["comments"].items():
-                self.context[path_str]["comments"][line] = [
+            for line, comments in record["comments"].items():
+                record["comments"][line] = [
                     comment for comment in comments if not set(tags) & set(comment.tags)
                 ]
         else:
-            self.context[path_str]["comments"] = dict[int, list[Comment]]()
+            record["comments"] = dict[int, list[Comment]]()
 
     def remove_ref(self, ref: str, tags: list[str] = []):
         """Remove the given id from the context."""
@@ -169,14 +340,15 @@ class ContextBuilder:
             if self.verbose > 0:
                 print(f"Warning: no matching message found for {path_str}.")
             return
+        record = self._edit(path_str)
         if lines:
-            self.context[path_str]["lines"] -= lines
+            record["lines"] -= lines
         else:
-            self.context[path_str]["lines"] = set()
+            record["lines"] = LineRanges()
         if tags:
-            self.context[path_str]["tags"] -= set(tags)
-        if not self.context[path_str]["lines"] and not self.context[path_str]["diffs"]:
-            del self.context[path_str]
+            record["tags"] -= set(tags)
+        if not record["lines"] and not record["diffs"]:
+            self._remove_path(path_str)
         return ref
 
     def remove_diff(self, id: str):
@@ -189,12 +361,71 @@ class ContextBuilder:
             if self.verbose > 0:
                 print(f"Warning: no matching message found for {path_str}.")
             return
-        self.context[path_str]["diffs"].remove(id)
-        self.context[path_str]["tags"].remove("diff")
-        if not self.context[path_str]["lines"] and not self.context[path_str]["diffs"]:
-            del self.context[path_str]
+        record = self._edit(path_str)
+        record["diffs"].remove(id)
+        record["tags"].remove("diff")
+        if not record["lines"] and not record["diffs"]:
+            self._remove_path(path_str)
         return id
 
+    def reconcile(self, graph: KnowledgeGraph):
+        """Bring the context up to date with a newer version of its graph.
+
+        Files whose checksum hasn't changed are left as they are. Changed files are
+        reloaded, with their lines and comments remapped through a diff of the old
+        and new document; deleted files lose their lines, and diffs no longer in
+        the graph are dropped.
+        """
+        old_graph, self.graph = self.graph, graph
+        for path_str in list(self.context):
+            data = self.context[path_str]
+            node = graph.nodes[path_str] if path_str in graph else {}
+            checksum = node.get("checksum")
+            diffs = {id for id in data["diffs"] if id in graph}
+            diffs_changed = diffs != data["diffs"] or any(
+                id not in old_graph
+                or old_graph.nodes[id].get("checksum")
+                != graph.nodes[id].get("checksum")
+                for id in diffs
+            )
+            if checksum is not None and checksum == data.get("checksum"):
+                if diffs_changed:
+                    self._edit(path_str)["diffs"] = diffs
+                else:
+                    continue
+            else:
+                document = self._load_document(path_str)
+                if document == data["document"] and not diffs_changed:
+                    if checksum != data.get("checksum"):
+                        self._edit(path_str)["checksum"] = checksum
+                    continue
+                if self.verbose > 1:
+                    print(f"Reconciling {path_str} with the new graph")
+                old_document = data["document"]
+                old_lines = self._get_file_lines(path_str, old_document)
+                record = self._edit(path_str)
+                record["document"], record["checksum"] = document, checksum
+                record["diffs"] = diffs
+                if document == f"{path_str}\n[DELETED]":
+                    record["lines"] = LineRanges()
+                    record["comments"] = dict[int, list[Comment]]()
+                elif document != old_document:
+                    new_lines = self._get_file_lines(path_str, document)
+                    opcodes = get_line_opcodes(old_lines, new_lines)
+                    record["lines"] = remap_lines(
+                        record["lines"], opcodes, len(old_lines)
+                    )
+                    comments = dict[int, list[Comment]]()
+                    for line, line_comments in record["comments"].items():
+                        line = remap_line(line, opcodes, len(new_lines) - 1)
+                        comments.setdefault(line, []).extend(line_comments)
+                    record["comments"] = comments
+            record = self.context[path_str]
+            if not record["diffs"]:
+                record["tags"].discard("diff")
+            if not record["lines"] and not record["diffs"]:
+                self._remove_path(path_str)
+
     def render(
         self,
         use_xml: bool = False,
@@ -202,59 +433,240 @@ class ContextBuilder:
         remove_whitespace: bool = False,
     ) -> str:
         """Return a formatted context message for the given nodes."""
-        output = ""
-        for path_str, data in self.context.items():
-            if output:
-                output += "\n"
+        return "\n".join(
+            self.render_path(path_str, use_xml, use_tags, remove_whitespace)
+            for path_str in self.context
+        )
 
-            if use_tags and data["tags"]:
-                tags = f" ({', '.join(sorted(data['tags']))})"
+    def render_path(
+        self,
+        path_str: str,
+        use_xml: bool = False,
+        use_tags: bool = False,
+        remove_whitespace: bool = False,
+    ) -> str:
+        """Return one path's segment of the context message.
+
+        Segments are cached until the path's lines, comments, tags or diffs change.
+        """
+        options = (use_xml, use_tags, remove_whitespace)
+        segments = self._segments.setdefault(path_str, {})
+        if options not in segments:
+            segments[options] = self._render_path(path_str, *options)
+        return segments[options]
+
+    def _render_path(
+        self, path_str: str, use_xml: bool, use_tags: bool, remove_whitespace: bool
+    ) -> str:
+        data = self.context[path_str]
+        if use_tags and data["tags"]:
+            tags = f" ({', '.join(sorted(data['tags']))})"
+        else:
+            tags = ""
+
+        output = list[str]()
+        if use_xml:
+            output.append(f"<{path_str}>{tags}\n")
+        else:
+            output.append(f"{path_str}{tags}\n")
+
+        if 0 in data["comments"]:
+            output.append(render_comments(data["comments"][0]) + "\n")
+        if data["lines"]:
+            file_lines = self._get_file_lines(path_str)
+            if data["lines"].end >= len(file_lines):
+                line = next(line for line in data["lines"] if line >= len(file_lines))
+                raise RagdaemonError(f"Line {line} not found in {path_str}.")
+            last_rendered = 0
+            for start, end in data["lines"].ranges:
+                if start - last_rendered > 1:
+                    output.append("...\n")
+                for line in range(start, end + 1):
+                    output.append(f"{line}:{file_lines[line]}\n")
+                    if line in data["comments"]:
+                        output.append(render_comments(data["comments"][line]) + "\n")
+                last_rendered = end
+            if last_rendered < len(file_lines) - 1:
+                output.append("...\n")
+        segment = "".join(output)
+        if remove_whitespace:
+            # Remove empty ranges
+            segment = re.sub(r"\.\.\.\n(\d+:\n)*(?=\.\.\.\n)", "", segment)
+            # Remove last range if it's empty
+            segment = re.sub(r"\.\.\.\n(\d+:\n)*$", "...\n", segment)
+
+        if data["diffs"]:
+            segment += self.render_diffs(data["diffs"])
+        if use_xml:
+            segment += f"</{path_str}>\n"
+        return segment
+
+    def count_tokens(
+        self,
+        model: Model | str,
+        use_xml: bool = False,
+        use_tags: bool = False,
+        remove_whitespace: bool = False,
+        exact: bool = False,
+    ) -> int:
+        """Return the tokens in render(), or tokenize all of it if exact.
+
+        Each path's segment is counted once until its record changes, and each join
+        between neighbouring segments from the lines either side of it, so adding or
+        removing a ref only re-renders and re-counts that path and its joins. The
+        sum only differs from the exact count if a token spans more than a line
+        either side of a join.
+        """
+        model = get_model(model)
+        if exact:
+            rendered = self.render(use_xml, use_tags, remove_whitespace)
+            return count_tokens_batch([rendered], model)[0] if rendered else 0
+        key = (model.name, use_xml, use_tags, remove_whitespace)
+        total = 0
+        previous = None
+        for path_str in self.context:
+            segment = self.render_path(path_str, use_xml, use_tags, remove_whitespace)
+            tokens = self._tokens.setdefault(path_str, {})
+            if key not in tokens:
+                tokens[key] = count_tokens_batch([segment], model)[0]
+            total += tokens[key]
+            if previous is not None:
+                # The last line of the previous segment and the first of this one
+                tail = previous[previous.rstrip("\n").rfind("\n") + 1 :]
+                head = segment[: segment.find("\n") + 1] or segment
+                total += count_join_tokens(model.name, tail, head)
+            previous = segment
+        return total
+
+    def pack(
+        self,
+        candidates: list[dict[str, Any]],
+        max_tokens: int,
+        model: Model | str,
+        tags: list[str] = [],
+    ) -> list[dict[str, Any]]:
+        """Add the candidates worth the most relevance per token within max_tokens.
+
+        Candidates are search results (nodes with a type, id, ref and distance). The
+        cost of each is estimated from cached per-line token counts, net of what the
+        context and earlier picks already include, and candidates are picked in order
+        of relevance per token, skipping those that no longer fit. Picks are then
+        added once and the whole context counted; if the estimates fell short, the last
+        picks are dropped by estimated cost in one step. Returns the candidates added.
+        """
+        model = get_model(model)
+        base_tokens = self.count_tokens(model, exact=True)
+        ellipsis_tokens, newline_tokens = count_tokens_batch(["...\n", "\n"], model)
+        # Where each path would be with the picks so far
+        lines = {path: data["lines"] for path, data in self.context.items()}
+        diffs = {path: set(data["diffs"]) for path, data in self.context.items()}
+        documents = {path: data["document"] for path, data in self.context.items()}
+
+        def estimate(candidate: dict[str, Any]) -> Optional[tuple[str, int]]:
+            """Return the path a candidate adds to and its marginal cost."""
+            if candidate["type"] == "diff":
+                _, path, _ = parse_diff_id(candidate["id"])
+                if not path:  # e.g. diff 'parent' nodes
+                    return None
+                path_str = path.as_posix()
+                cost = 0
+                path_diffs = diffs.get(path_str, set())
+                if candidate["id"] not in path_diffs:
+                    data = self.graph.nodes[candidate["id"]]
+                    cost = count_tokens(load_document(data), model, data["checksum"])
+                    cost += newline_tokens  # Rendered with a newline after it
+                    if not path_diffs:  # And the path's diffs with a git command
+                        git_command = get_git_command(candidate["id"])
+                        cost += count_tokens_batch([git_command], model)[0]
             else:
-                tags = ""
+                path, ref_lines = parse_path_ref(candidate["ref"])
+                path_str = path.as_posix()
+                if path_str not in documents:
+                    documents[path_str] = self._load_document(path_str)
+                document = documents[path_str]
+                if not ref_lines:
+                    ref_lines = LineRanges([(1, document.count("\n"))])
+                line_tokens = self._get_line_tokens(path_str, document, model)
+                if ref_lines.end >= len(line_tokens):
+                    return None  # Past the end of the file
+                included = lines.get(path_str, LineRanges())
+                cost = sum(
+                    line_tokens[end] - line_tokens[start - 1]
+                    for start, end in (ref_lines - included).ranges
+                )
+                # At most one "..." before each range and one after the last, so
+                # joining ranges saves one
+                ranges_added = len((included | ref_lines).ranges) - len(included.ranges)
+                if not included:
+                    ranges_added += 1
+                cost += ellipsis_tokens * ranges_added
+            if path_str not in lines:
+                # Its header, and the newline between it and the file before
+                cost += count_tokens_batch([f"{path_str}\n"], model)[0] + newline_tokens
+            return path_str, cost
+
+        def density(candidate: dict[str, Any], cost: int) -> float:
+            relevance = max(0.0, 1 - candidate.get("distance", 1))
+            return relevance / max(cost, 1)
 
-            if use_xml:
-                output += f"<{path_str}>{tags}\n"
+        ranked = list[tuple[float, int]]()
+        for i, candidate in enumerate(candidates):
+            estimated = estimate(candidate)
+            if estimated is not None:
+                ranked.append((density(candidate, estimated[1]), i))
+        ranked.sort(key=lambda x: -x[0])  # Stable, so ties keep search order
+
+        picked = list[dict[str, Any]]()
+        costs = list[int]()  # Estimated, of each pick
+        remaining = max_tokens
+        for _, i in ranked:
+            candidate = candidates[i]
+            # Again, since earlier picks may have covered some of its file or lines
+            estimated = estimate(candidate)
+            if estimated is None or estimated[1] > remaining:
+                continue
+            path_str, cost = estimated
+            remaining -= cost
+            picked.append(candidate)
+            costs.append(cost)
+            lines.setdefault(path_str, LineRanges())
+            diffs.setdefault(path_str, set())
+            if candidate["type"] == "diff":
+                diffs[path_str].add(candidate["id"])
             else:
-                output += f"{path_str}{tags}\n"
+                ref_lines = parse_path_ref(candidate["ref"])[1]
+                if not ref_lines:
+                    ref_lines = LineRanges([(1, documents[path_str].count("\n"))])
+                lines[path_str] |= ref_lines
 
-            if 0 in data["comments"]:
-                output += render_comments(data["comments"][0]) + "\n"
-            if data["lines"]:
-                file_lines = data["document"].split("\n")
-                last_rendered = 0
-                for line in sorted(data["lines"]):
-                    if line - last_rendered > 1:
-                        output += "...\n"
-                    if line >= len(file_lines):
-                        raise RagdaemonError(f"Line {line} not found in {path_str}.")
-                    line_content = f"{line}:{file_lines[line]}"
-                    if line in data["comments"]:
-                        line_content += "\n" + render_comments(data["comments"][line])
-                    output += line_content + "\n"
-                    last_rendered = line
-                if last_rendered < len(file_lines) - 1:
-                    output += "...\n"
-            if remove_whitespace:
-                # Remove empty ranges
-                output = re.sub(r"\.\.\.\n(\d+:\n)*(?=\.\.\.\n)", "", output)
-                # Remove last range if it's empty
-                output = re.sub(r"\.\.\.\n(\d+:\n)*$", "...\n", output)
-
-            if data["diffs"]:
-                output += self.render_diffs(data["diffs"])
-            if use_xml:
-                output += f"</{path_str}>\n"
-        return output
+        def add_picks():
+            for candidate in picked:
+                if candidate["type"] == "diff":
+                    self.add_diff(candidate["id"])
+                    continue
+                path_str = parse_path_ref(candidate["ref"])[0].as_posix()
+                if path_str not in self.context:
+                    self._add_path(path_str, documents[path_str])
+                self.add_ref(candidate["ref"], tags=tags)
+
+        original = self.copy()
+        add_picks()
+        over = self.count_tokens(model, exact=True) - base_tokens - max_tokens
+        while picked and over > 0:
+            # Drop the last picks whose estimates cover what's over, then add the
+            # rest back; estimates are conservative, so this rarely runs, and once
+            while picked and over > 0:
+                picked.pop()
+                over -= costs.pop()
+            self._share(original)
+            add_picks()
+            over = self.count_tokens(model, exact=True) - base_tokens - max_tokens
+        return picked
 
     def render_diffs(self, ids: set[str]) -> str:
-        output = ""
-        diff_str, _, _ = parse_diff_id(next(iter(ids)))
-        git_command = "--git diff"
-        if diff_str != "DEFAULT":
-            git_command += f" {diff_str}"
-        output += f"{git_command}\n"
+        output = get_git_command(next(iter(ids)))
         for id in sorted(ids):
-            document = self.graph.nodes[id]["document"]
+            document = load_document(self.graph.nodes[id])
             # TODO: Add line numbers
             without_git_command = "\n".join(document.split("\n")[1:])
             output += without_git_command + "\n"
@@ -269,21 +681,9 @@ class ContextBuilder:
             elif len(data["lines"]) == data["document"].split("\n"):
                 refs[path] = ""
                 continue
-            segments = []
-            current_segment = ""
-            last_line = 0
-            for line in sorted(data["lines"]):
-                if current_segment and line - last_line > 1:
-                    current_segment += f"-{last_line}"
-                    segments.append(current_segment)
-                    current_segment = ""
-                if not current_segment:
-                    current_segment = str(line)
-                last_line = line
-            if current_segment:
-                current_segment += f"-{last_line}"
-                segments.append(current_segment)
-            refs[path] = ",".join(segments)
+            refs[path] = ",".join(
+                f"{start}-{end}" for start, end in data["lines"].ranges
+            )
         return [f"{path}:{ref}" for path, ref in refs.items()]
 
     def to_ids(self) -> list[str]:
@@ -293,18 +693,7 @@ class ContextBuilder:
         this will return all of the chunks ids, not the file id.
         """
         ids = set()
-        targets = []
-        refs = self.to_refs()
-        for ref in refs:
-            path, lines = parse_path_ref(ref)
-            targets.append((path, lines))
-        for node, data in self.graph.nodes(data=True):
-            for path, lines in targets:
-                if node.startswith(path.as_posix()):
-                    _, node_lines = parse_path_ref(data["ref"])
-                    if lines is None and node_lines is None:
-                        ids.add(node)
-                    elif lines is not None and node_lines is not None:
-                        if node_lines.intersection(lines):
-                            ids.add(node)
+        for path, data in self.context.items():
+            if data["lines"]:
+                ids |= self.graph.get_line_index(path).query(data["lines"])
         return list(ids)
@@ -1,6 +1,5 @@
 import asyncio
 import json
-import time
 from pathlib import Path
 from typing import Any, Dict, Iterable, Optional
 
@@ -14,16 +13,29 @@ from ragdaemon.annotators import annotators_map
 from ragdaemon.cerebrus import cerebrus
 from ragdaemon.context import ContextBuilder
 from ragdaemon.database import Database, get_db
+from ragdaemon.document_store import load_document, prune_document_store
 from ragdaemon.errors import RagdaemonError
-from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.graph import (
+    FileChanges,
+    KnowledgeGraph,
+    diff_file_checksums,
+    get_file_checksums,
+)
 from ragdaemon.io import DockerIO, IO, LocalIO
 from ragdaemon.locate import locate
+from ragdaemon.tokens import token_counts
 from ragdaemon.utils import (
     DEFAULT_COMPLETION_MODEL,
     DEFAULT_EMBEDDING_MODEL,
     match_refresh,
     mentat_dir_path,
 )
+from ragdaemon.watcher import (
+    empty_change_set,
+    get_file_changes,
+    get_watcher,
+    merge_changes,
+)
 
 
 def default_annotators():
@@ -108,22 +120,38 @@ class Daemon:
         return self._db
 
     def save(self):
-        """Saves the graph to disk."""
+        """Saves the graph to disk.
+
+        Nodes only hold checksums: their documents are in the shared document store,
+        so the json isn't self-contained. Documents no saved graph uses are pruned
+        from the store about once a day.
+        """
         data = json_graph.node_link_data(self.graph)
         with open(self.graph_path, "w") as f:
             json.dump(data, f, indent=4)
         if self.verbose > 1:
             print(f"Saved updated graph to {self.graph_path}")
+        pruned = prune_document_store(self.graph_path.parent)
+        if self.verbose > 1 and pruned:
+            print(f"Pruned {pruned} unused documents from the document store")
 
-    async def update(self, refresh: str | bool = False):
+    async def update(
+        self, refresh: str | bool = False, changes: Optional[FileChanges] = None
+    ):
         """Iteratively build the knowledge graph
 
         Refresh can be
         - boolean to refresh all annotators/nodes
         - string matching annotator names / node ids, e.g. ("chunker")
         - string with wildcard operators to fuzzy-match annotators/nodes, e.g. ("*diff*")
+
+        Changes, if known (e.g. from the watcher), are the only files hierarchy
+        re-scans, instead of the whole tree.
         """
         _graph = self.graph.copy()
+        # Files changed by earlier annotators (i.e. hierarchy), so later ones only
+        # need to patch the affected part of the graph.
+        before = get_file_checksums(_graph)
         for name, annotator in self.pipeline.items():
             _refresh = (
                 match_refresh(refresh, name)
@@ -131,31 +159,53 @@ class Daemon:
                 else refresh
             )
             if _refresh or not annotator.is_complete(_graph, self.db):
-                _graph = await annotator.annotate(_graph, self.db, refresh=_refresh)
+                _graph = await annotator.annotate(
+                    _graph,
+                    self.db,
+                    refresh=_refresh,
+                    changes=None if _refresh else changes,
+                )
+            changes = diff_file_checksums(before, get_file_checksums(_graph))
         self.graph = _graph
+        token_counts.save(self.db)
         self.save()
 
     async def watch(self, interval=2, debounce=5):
-        """Calls self.update interval debounce seconds after a file is modified."""
-        paths = self.io.get_paths_for_directory()
-        last_updated = 0
+        """Calls self.update debounce seconds after active files stop changing.
+
+        Uses inotify where available (so an idle tree costs nothing) and otherwise
+        polls every interval seconds.
+        """
+        watcher = get_watcher(
+            self.io, interval=interval, debounce=debounce, verbose=self.verbose
+        )
         _update_task = None
-        while True:
-            await asyncio.sleep(interval)
-            paths = self.io.get_paths_for_directory()
-            _last_updated = max(self.io.last_modified(path) for path in paths)
-            if (
-                _last_updated > last_updated
-                and (time.time() - _last_updated) > debounce
-            ):
+        # Changes not in the graph yet: a cancelled update's are passed to the next
+        pending = empty_change_set()
+
+        async def _update(changes: FileChanges):
+            await self.update(changes=changes)
+            pending.update(empty_change_set())
+
+        try:
+            async for changes in watcher.changes():
+                if self.verbose > 1:
+                    print(
+                        f"Detected changes: {len(changes['created'])} created, "
+                        f"{len(changes['modified'])} modified, "
+                        f"{len(changes['deleted'])} deleted, "
+                        f"{len(changes['renamed'])} renamed"
+                    )
                 if _update_task is not None:
                     try:
                         _update_task.cancel()
                         await _update_task
                     except asyncio.CancelledError:
                         pass
-                last_updated = _last_updated
-                _update_task = asyncio.create_task(self.update())
+                merge_changes(pending, changes)
+                _update_task = asyncio.create_task(_update(get_file_changes(pending)))
+        finally:
+            watcher.close()
 
     def search(
         self,
@@ -167,7 +217,7 @@ class Daemon:
         return self.db.query_graph(query, self.graph, n=n, node_types=node_types)
 
     def get_document(self, filename: str) -> str:
-        return self.graph.nodes[filename]["document"]
+        return load_document(self.graph.nodes[filename])
 
     def get_context(
         self,
@@ -180,28 +230,15 @@ class Daemon:
         if context_builder is None:
             context = ContextBuilder(self.graph, self.io, self.verbose)
         else:
-            # TODO: Compare graph hashes, reconcile changes
             context = context_builder
-        include_context_message = context.render()
-        include_tokens = self.spice_client.count_tokens(include_context_message, model)
+            if context.graph is not self.graph:  # Built before the last update
+                context.reconcile(self.graph)
+        include_tokens = context.count_tokens(model)
         if not auto_tokens or include_tokens >= max_tokens:
             return context
 
         auto_tokens = min(auto_tokens, max_tokens - include_tokens)
-        results = self.search(query)
-        for node in results:
-            if node["type"] == "diff":
-                context.add_diff(node["id"])
-            else:
-                context.add_ref(node["ref"], tags=["search-result"])
-            next_context_message = context.render()
-            next_tokens = self.spice_client.count_tokens(next_context_message, model)
-            if (next_tokens - include_tokens) > auto_tokens:
-                if node["type"] == "diff":
-                    context.remove_diff(node["id"])
-                else:
-                    context.remove_ref(node["ref"])
-                break
+        context.pack(self.search(query), auto_tokens, model, tags=["search-result"])
         return context
 
     async def locate(
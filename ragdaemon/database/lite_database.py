@@ -1,7 +1,7 @@
+import math
+from collections import Counter
 from typing import Any, Optional, TypedDict
 
-from rank_bm25 import BM25Okapi
-
 from ragdaemon.database.database import Database
 
 
@@ -9,6 +9,87 @@ def tokenize(document: str) -> list[str]:
     return document.split()
 
 
+class BM25Index:
+    """An inverted index scored like rank_bm25's BM25Okapi.
+
+    Documents are added and removed one at a time, so indexing costs only the
+    documents that changed, and queries only visit documents sharing a term.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.postings = dict[str, dict[str, int]]()  # {term: {id: frequency}}
+        self.doc_lens = dict[str, int]()  # {id: tokens}
+        self.total_len = 0
+        # {df: terms in that many documents}, to average idf without visiting terms
+        self.df_counts = Counter[int]()
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.doc_lens
+
+    def _move_df(self, old_df: int, new_df: int):
+        if old_df:
+            self.df_counts[old_df] -= 1
+            if not self.df_counts[old_df]:
+                del self.df_counts[old_df]
+        if new_df:
+            self.df_counts[new_df] += 1
+
+    def add(self, id: str, tokens: list[str]):
+        """Add a new document; remove a document's old version before re-adding it."""
+        self.doc_lens[id] = len(tokens)
+        self.total_len += len(tokens)
+        for term, frequency in Counter(tokens).items():
+            postings = self.postings.setdefault(term, {})
+            postings[id] = frequency
+            self._move_df(len(postings) - 1, len(postings))
+
+    def remove(self, id: str, tokens: list[str]):
+        """Remove a document, given the tokens it was added with."""
+        if id not in self.doc_lens:
+            return
+        self.total_len -= self.doc_lens.pop(id)
+        for term in set(tokens):
+            postings = self.postings[term]
+            del postings[id]
+            self._move_df(len(postings) + 1, len(postings))
+            if not postings:
+                del self.postings[term]
+
+    def idf(self, df: int) -> float:
+        n_docs = len(self.doc_lens)
+        return math.log(n_docs - df + 0.5) - math.log(df + 0.5)
+
+    def get_scores(self, query: list[str]) -> dict[str, float]:
+        """Return the score of each document with any of the query's terms."""
+        if not self.total_len:
+            return {}
+        avgdl = self.total_len / len(self.doc_lens)
+        k1, b = self.k1, self.b
+        eps = None
+        scores = dict[str, float]()
+        for term in query:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(len(postings))
+            if idf < 0:  # Floored at a fraction of the average idf, like BM25Okapi
+                if eps is None:
+                    idf_sum = sum(self.idf(df) * n for df, n in self.df_counts.items())
+                    eps = self.epsilon * idf_sum / len(self.postings)
+                idf = eps
+            for id, frequency in postings.items():
+                doc_len = self.doc_lens[id]
+                scores[id] = scores.get(id, 0) + idf * (
+                    frequency
+                    * (k1 + 1)
+                    / (frequency + k1 * (1 - b + b * doc_len / avgdl))
+                )
+        return scores
+
+
 class Document(TypedDict):
     checksum: str
     chunks: Optional[list[dict[str, str]]]
@@ -19,12 +100,10 @@ class Document(TypedDict):
 class LiteDB(Database):
     """A fast alternative to Embeddings DB for testing (and anything else)."""
 
-    bm25: BM25Okapi
-    bm25_index: list[str]
-
     def __init__(self, verbose: int = 0):
         self.verbose = verbose
         self.data = dict[str, dict[str, Any]]()  # {id: {metadatas, document}}
+        self.bm25 = BM25Index()
 
     def get(self, ids: list[str], include: Optional[list[str]] = None) -> dict:
         output = {"ids": [], "metadatas": [], "documents": []}
@@ -48,13 +127,15 @@ class LiteDB(Database):
 
     def query(self, query: str, active_checksums: set[str]) -> list[dict]:
         scores = self.bm25.get_scores(tokenize(query))
-        max_score = max(scores)
+        max_score = max(scores.values(), default=0)
+        if len(scores) < len(self.data):
+            max_score = max(max_score, 0)  # Documents without query terms score 0
         if max_score > 0:
             # Normalize to [0, 1]
-            scores = [score / max_score for score in scores]
+            scores = {id: score / max_score for id, score in scores.items()}
         results = [
-            {"checksum": id, "distance": 1 - score}
-            for id, score in zip(self.bm25_index, scores)
+            {"checksum": id, "distance": 1 - scores.get(id, 0)}
+            for id in self.data
             if id in active_checksums
         ]
         results = sorted(results, key=lambda x: x["distance"])
@@ -69,14 +150,13 @@ class LiteDB(Database):
         if metadatas is None:
             metadatas = [{} for _ in range(len(ids))]
         for checksum, metadata, document in zip(ids, metadatas, documents):
-            existing_metadata = self.data.get(checksum, {}).get("metadatas", {})
-            metadata = {**existing_metadata, **metadata}
+            existing = self.data.get(checksum, {})
+            metadata = {**existing.get("metadatas", {}), **metadata}
             self.data[checksum] = {"metadatas": metadata, "document": document}
 
-        # Update BM25
-        ids, documents = [], []
-        for id, data in self.data.items():
-            ids.append(id)
-            documents.append(data["document"])
-        self.bm25 = BM25Okapi([tokenize(document) for document in documents])
-        self.bm25_index = ids
+            # Index only new or changed documents
+            if checksum in self.bm25:
+                if existing["document"] == document:
+                    continue
+                self.bm25.remove(checksum, tokenize(existing["document"]))
+            self.bm25.add(checksum, tokenize(document))
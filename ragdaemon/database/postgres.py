@@ -1,4 +1,5 @@
 import os
+import sys
 from functools import cache
 from typing import Optional
 
@@ -43,6 +44,23 @@ class DocumentMetadata(Base):
     chunks: Mapped[Optional[str]]
     calls: Mapped[Optional[str]]
     summary: Mapped[Optional[str]]
+    tokens: Mapped[Optional[str]]  # {model: tokens}, as json
+
+
+# Columns added to DocumentMetadata after its table was first created, with their types
+ADDED_COLUMNS = {"tokens": "VARCHAR"}
+
+
+def add_missing_columns(session: Session):
+    """Add newer columns to an existing table in place, keeping its rows."""
+    for name, type in ADDED_COLUMNS.items():
+        session.execute(
+            text(
+                f"ALTER TABLE {DocumentMetadata.__tablename__} "
+                f"ADD COLUMN IF NOT EXISTS {name} {type}"
+            )
+        )
+    session.commit()
 
 
 @cache
@@ -87,7 +105,9 @@ def get_database_session_sync() -> sessionmaker[Session]:
 
 
 if __name__ == "__main__":
-    if input(
+    # Upgrades in place by default; --reset drops and recreates the tables
+    reset = "--reset" in sys.argv[1:]
+    if not reset or input(
         "Migrating will clear the database. ALL DATA WILL BE LOST. Proceed (Y/n)? "
     ).lower().strip() in [
         "",
@@ -111,6 +131,9 @@ https://github.com/pgvector/pgvector-python?tab=readme-ov-file#sqlalchemy
 """
                     )
         engine = get_database_engine_sync()
-        Base.metadata.drop_all(engine)
-        Base.metadata.create_all(engine)
+        if reset:
+            Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)  # Only creates missing tables
+        with SessionLocal() as session:
+            add_missing_columns(session)
         print("PGDB migrated successfully.")
@@ -0,0 +1,192 @@
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Any, Iterable, Optional
+
+from ragdaemon.errors import RagdaemonError
+from ragdaemon.utils import mentat_dir_path
+
+# How often stored documents are pruned, and how long unreferenced ones are kept
+PRUNE_INTERVAL = 24 * 60 * 60
+
+
+class DocumentStore:
+    """Node documents on disk, addressed by node checksum, with an LRU cache.
+
+    Graph nodes only carry a checksum; documents are written here once and read back
+    on demand, so neither the graph in memory nor its saved json holds source text.
+    With no path, documents are only kept in memory (and never evicted).
+    """
+
+    def __init__(self, path: Optional[Path] = None, cache_bytes: int = 32_000_000):
+        self.path = path
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict[str, str]()  # {checksum: document}, oldest first
+        self._cached_bytes = 0
+        self._lock = Lock()  # Annotators read from thread pools
+
+    def _blob_path(self, checksum: str) -> Path:
+        assert self.path is not None
+        return self.path / checksum[:2] / checksum[2:]
+
+    def _cache(self, checksum: str, document: str):
+        with self._lock:
+            if checksum in self.cache:
+                self.cache.move_to_end(checksum)
+                return
+            self.cache[checksum] = document
+            self._cached_bytes += len(document)
+            if self.path is None:
+                return  # Memory is the only copy
+            while self._cached_bytes > self.cache_bytes and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+
+    def __contains__(self, checksum: str) -> bool:
+        if checksum in self.cache:
+            return True
+        return self.path is not None and self._blob_path(checksum).exists()
+
+    def _write(self, checksum: str, parts: Iterable[str]):
+        blob_path = self._blob_path(checksum)
+        try:
+            os.utime(blob_path)  # Already stored; mark it as in use for prune
+        except FileNotFoundError:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write-then-rename so a crash never leaves a partial document
+            fd, tmp_path = tempfile.mkstemp(dir=blob_path.parent)
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+                for part in parts:
+                    f.write(part)
+            os.replace(tmp_path, blob_path)
+
+    def put(self, checksum: str, document: str):
+        if self.path is not None and checksum not in self.cache:
+            self._write(checksum, [document])
+        self._cache(checksum, document)
+
+    def put_parts(self, checksum: str, parts: Iterable[str]):
+        """Write a document part by part, for those too large to hold in memory.
+
+        It isn't cached, unless memory is the only copy.
+        """
+        if self.path is None:
+            self._cache(checksum, "".join(parts))
+        else:
+            self._write(checksum, parts)
+
+    def get(self, checksum: str) -> str:
+        with self._lock:
+            document = self.cache.get(checksum)
+            if document is not None:
+                self.cache.move_to_end(checksum)
+                return document
+        if self.path is None:
+            raise RagdaemonError(f"Document {checksum} not found in store")
+        try:
+            with open(self._blob_path(checksum), encoding="utf-8", newline="") as f:
+                document = f.read()
+        except FileNotFoundError:
+            raise RagdaemonError(f"Document {checksum} not found in store")
+        self._cache(checksum, document)
+        return document
+
+    def read(self, checksum: str, size: int) -> tuple[str, bool]:
+        """Return up to size characters of a document, and whether that's all of it.
+
+        Unlike get, a stored document is neither read whole nor cached.
+        """
+        with self._lock:
+            document = self.cache.get(checksum)
+        if document is not None:
+            return document[:size], len(document) <= size
+        if self.path is None:
+            raise RagdaemonError(f"Document {checksum} not found in store")
+        try:
+            with open(self._blob_path(checksum), encoding="utf-8", newline="") as f:
+                prefix = f.read(size)
+                complete = len(prefix) < size or not f.read(1)
+        except FileNotFoundError:
+            raise RagdaemonError(f"Document {checksum} not found in store")
+        return prefix, complete
+
+    def prune(self, keep: set[str], min_age: float = PRUNE_INTERVAL) -> int:
+        """Delete stored documents not in keep; return how many were deleted.
+
+        Documents written or put in the last min_age seconds are kept regardless,
+        since another process may not have saved the graph that uses them yet.
+        """
+        if self.path is None or not self.path.is_dir():
+            return 0
+        cutoff = time.time() - min_age
+        pruned = set[str]()
+        for blob_dir in self.path.iterdir():
+            if not blob_dir.is_dir():
+                continue
+            for blob_path in blob_dir.iterdir():
+                checksum = blob_dir.name + blob_path.name
+                if checksum in keep:
+                    continue
+                try:
+                    if blob_path.stat().st_mtime < cutoff:
+                        blob_path.unlink()
+                        pruned.add(checksum)
+                except FileNotFoundError:
+                    continue
+        with self._lock:
+            for checksum in pruned & set(self.cache):
+                self._cached_bytes -= len(self.cache.pop(checksum))
+        return len(pruned)
+
+
+document_store = DocumentStore(mentat_dir_path / "ragdaemon" / "documents")
+
+
+def get_saved_checksums(graphs_dir: Path) -> set[str]:
+    """Return the checksums of the nodes of every graph saved in graphs_dir."""
+    checksums = set[str]()
+    for graph_path in graphs_dir.glob("ragdaemon-*.json"):
+        try:
+            with open(graph_path) as f:
+                nodes = json.load(f).get("nodes", [])
+        except (OSError, ValueError, AttributeError):
+            continue  # Not a saved graph, or being written
+        checksums.update(node["checksum"] for node in nodes if node.get("checksum"))
+    return checksums
+
+
+def prune_document_store(graphs_dir: Path, interval: float = PRUNE_INTERVAL) -> int:
+    """Delete documents no graph saved in graphs_dir uses, at most once per interval."""
+    if document_store.path is None:
+        return 0
+    marker = document_store.path / "last-pruned"
+    try:
+        if time.time() - marker.stat().st_mtime < interval:
+            return 0
+    except FileNotFoundError:
+        pass
+    document_store.path.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+    return document_store.prune(get_saved_checksums(graphs_dir), min_age=interval)
+
+
+def load_document(data: dict[str, Any]) -> str:
+    """Return a node's document, from the store or, for older graphs, the node."""
+    document = data.get("document")
+    if document is not None:
+        return document
+    checksum = data.get("checksum")
+    if checksum is None:
+        raise RagdaemonError(f"Node {data.get('id')} has no checksum")
+    try:
+        return document_store.get(checksum)
+    except RagdaemonError:
+        raise RagdaemonError(
+            f"Document of node {data.get('id')} is missing from the document store;"
+            " it may have been pruned since the graph was saved. Run Daemon.update"
+            " to restore it."
+        )
@@ -3,27 +3,52 @@ These functions were almost directly copied from mentat/include_files.py in orde
 support non-git projects in Mentat.
 """
 
+import codecs
 import fnmatch
+import locale
 import logging
 import os
+import re
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional, Set
+from threading import Lock
+from typing import Iterable, List, Optional, Set
 
 from ragdaemon.errors import RagdaemonError
 
 
-def is_file_text_encoded(abs_path: Path):
-    """Checks if a file is text encoded."""
+# How much of a file to look at when deciding whether it's text
+TEXT_SNIFF_BYTES = 8192
+
+
+def is_text_sample(sample: bytes | str) -> bool:
+    """Checks if the start of a file looks like text: no NUL bytes, and decodable."""
+    if isinstance(sample, str):
+        return "\x00" not in sample
+    if b"\x00" in sample:
+        return False
+    # Incremental decoder, so a multi-byte character cut off at the end is fine
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
     try:
-        # The ultimate filetype test
-        with open(abs_path, "r") as f:
-            f.read()
+        decoder.decode(sample, final=False)
         return True
     except UnicodeDecodeError:
         return False
 
 
+def is_file_text_encoded(abs_path: Path):
+    """Checks if a file is text encoded by sniffing its first few KB.
+
+    This is advisory: bytes past the sniff aren't checked, so readers still have to
+    handle UnicodeDecodeError (get_document raises RagdaemonError for it).
+    """
+    with open(abs_path, "rb") as f:
+        return is_text_sample(f.read(TEXT_SNIFF_BYTES))
+
+
 def get_git_root_for_path(path: Path, raise_error: bool = True) -> Optional[Path]:
     if os.path.isdir(path):
         dir_path = path
@@ -58,7 +83,67 @@ def get_git_root_for_path(path: Path, raise_error: bool = True) -> Optional[Path
             return
 
 
-def get_non_gitignored_files(root: Path, visited: set[Path] = set()) -> Set[Path]:
+def find_git_root(path: Path) -> Optional[Path]:
+    """Find the enclosing git repo by looking for .git, without spawning git."""
+    path = Path(os.path.realpath(path))
+    if not path.is_dir():
+        path = path.parent
+    for candidate in (path, *path.parents):
+        if (candidate / ".git").exists():
+            return candidate
+    return None
+
+
+def _get_git_dir(git_root: Path) -> Optional[Path]:
+    dot_git = git_root / ".git"
+    if dot_git.is_dir():
+        return dot_git
+    if dot_git.is_file():  # Worktrees and submodules point elsewhere
+        content = dot_git.read_text().strip()
+        if content.startswith("gitdir:"):
+            return (git_root / content[len("gitdir:") :].strip()).resolve()
+    return None
+
+
+def _stat_mtimes(paths: Iterable[Path]) -> dict[str, int]:
+    mtimes = dict[str, int]()
+    for path in paths:
+        try:
+            mtimes[str(path)] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[str(path)] = -1
+    return mtimes
+
+
+"""
+Cache of `git ls-files` output: {directory: (mtimes, paths)}. The listing can only
+change if the index, an exclude file, a .gitignore or one of the directories on the
+way to a listed file changes, so a listing is reused as long as none of their mtimes
+have moved. That makes listing an unchanged tree a handful of stat calls, no
+processes. (New files in a directory that holds *only* ignored files aren't noticed
+until something else changes; the same trade-off git's untracked cache makes.)
+The least recently used listings are evicted past _LS_FILES_CACHE_SIZE directories.
+"""
+_ls_files_cache = dict[Path, tuple[dict[str, int], Set[Path]]]()
+_LS_FILES_CACHE_SIZE = 64
+_ls_files_lock = Lock()  # Repos are listed from a thread pool
+
+# Listings made within this long of a watched mtime aren't cached, since a change in
+# the same timestamp tick would go unnoticed.
+_RACY_MARGIN_NS = 1_000_000_000
+
+
+def _ls_files(root: Path, git_root: Path) -> Set[Path]:
+    """Return non-gitignored paths under root, using the cache when it's fresh."""
+    cached = _ls_files_cache.get(root)
+    if cached is not None:
+        mtimes, paths = cached
+        if _stat_mtimes(Path(p) for p in mtimes) == mtimes:
+            with _ls_files_lock:  # Mark as most recently used
+                _ls_files_cache[root] = _ls_files_cache.pop(root, cached)
+            return paths
+
+    listed_at = time.time_ns()
     paths = set(
         # git returns / separated paths even on windows, convert so we can remove
         # glob_excluded_files, which have windows paths on windows
@@ -77,24 +162,117 @@ def get_non_gitignored_files(root: Path, visited: set[Path] = set()) -> Set[Path
         if Path(root / p).exists()
     )
 
-    file_paths: Set[Path] = set()
+    # Every directory between root and a listed file, since a new sibling of any of
+    # them only changes its parent's mtime
+    directories = {Path(".")}
+    for p in paths:
+        for parent in p.parents:
+            if parent in directories:
+                break
+            directories.add(parent)
+    watched = {root / directory for directory in directories}
+    watched |= {root / p for p in paths if p.name == ".gitignore"}
+    git_dir = _get_git_dir(git_root)
+    if git_dir is not None:
+        watched |= {git_dir / "index", git_dir / "info" / "exclude"}
+    mtimes = _stat_mtimes(watched)
+    with _ls_files_lock:
+        _ls_files_cache.pop(root, None)
+        if max(mtimes.values()) < listed_at - _RACY_MARGIN_NS:
+            _ls_files_cache[root] = (mtimes, paths)
+            while len(_ls_files_cache) > _LS_FILES_CACHE_SIZE:
+                del _ls_files_cache[next(iter(_ls_files_cache))]
+    return paths
+
+
+def get_non_gitignored_files(
+    root: Path, visited: Optional[set[Path]] = None, git_root: Optional[Path] = None
+) -> Set[Path]:
+    """Return paths relative to root of all non-gitignored files in the repo.
+
+    Nested repos and submodules are listed in parallel, one level at a time.
+    """
+    if git_root is None:
+        git_root = find_git_root(root) or root
     # We use visited to make sure we break out of any infinite loops symlinks might cause
+    visited = set() if visited is None else visited
     visited.add(root.resolve())
-    for path in paths:
-        # git ls-files returns directories if the directory is itself a git project;
-        # so we recursively run this function on any directories it returns.
-        if (root / path).is_dir():
-            if (root / path).resolve() in visited:
-                continue
-            file_paths.update(
-                root / path / inner_path
-                for inner_path in get_non_gitignored_files(root / path, visited)
-            )
-        else:
-            file_paths.add(path)
+
+    file_paths: Set[Path] = set()
+    repos = [(root, git_root, Path("."))]  # (directory, repo root, prefix from root)
+    with ThreadPoolExecutor() as executor:
+        while repos:
+            listings = executor.map(lambda repo: _ls_files(*repo[:2]), repos)
+            nested_repos = []
+            for (repo, _, prefix), paths in zip(repos, listings):
+                for path in paths:
+                    # git ls-files returns directories if the directory is itself a
+                    # git project, so we list those in the next round.
+                    if (repo / path).is_dir():
+                        if (repo / path).resolve() in visited:
+                            continue
+                        visited.add((repo / path).resolve())
+                        nested_repos.append((repo / path, repo / path, prefix / path))
+                    else:
+                        file_paths.add(prefix / path)
+            repos = nested_repos
     return file_paths
 
 
+class PathMatcher:
+    """A set of absolute paths/glob patterns compiled for fast matching.
+
+    Plain paths go into a trie of path parts, so a path matches if it or one of its
+    parents is a pattern. Globs are combined into a single regex.
+    """
+
+    _END = ""  # Path parts are never empty, so this marks the end of a pattern
+
+    def __init__(self, patterns: Iterable[Path]):
+        self.trie = dict[str, dict]()
+        globs = list[str]()
+        for pattern in patterns:
+            if not pattern.is_absolute():
+                raise RagdaemonError(f"Pattern {pattern} is not absolute")
+            pattern_str = os.path.normcase(str(pattern))
+            node = self.trie
+            for part in Path(pattern_str).parts:
+                node = node.setdefault(part, {})
+            node[self._END] = {}
+            if any(char in pattern_str for char in "*?["):
+                globs.append(fnmatch.translate(pattern_str))
+        self.regex = re.compile("|".join(globs)) if globs else None
+
+    def __bool__(self) -> bool:
+        return bool(self.trie)
+
+    def match(self, path: Path) -> bool:
+        if not path.is_absolute():
+            raise RagdaemonError(f"Path {path} is not absolute")
+        path_str = os.path.normcase(str(path))
+        # Check if the path is relative to a pattern
+        node = self.trie
+        for part in Path(path_str).parts:
+            child = node.get(part)
+            if child is None:
+                break
+            if self._END in child:
+                return True
+            node = child
+        # Check if a glob pattern matches
+        return self.regex is not None and self.regex.match(path_str) is not None
+
+
+@lru_cache(maxsize=32)
+def _compile_patterns(patterns: frozenset[Path]) -> PathMatcher:
+    return PathMatcher(patterns)
+
+
+def get_path_matcher(patterns: Iterable[Path]) -> PathMatcher:
+    """Return a compiled matcher for the patterns, reused across calls."""
+    return _compile_patterns(frozenset(patterns))
+
+
 def match_path_with_patterns(path: Path, patterns: Set[Path]) -> bool:
     """Check if the given absolute path matches any of the patterns.
 
@@ -105,18 +283,7 @@ def match_path_with_patterns(path: Path, patterns: Set[Path]) -> bool:
     Return:
         A boolean flag indicating if the path matches any of the patterns
     """
-    if not path.is_absolute():
-        raise RagdaemonError(f"Path {path} is not absolute")
-    for pattern in patterns:
-        if not pattern.is_absolute():
-            raise RagdaemonError(f"Pattern {pattern} is not absolute")
-        # Check if the path is relative to the pattern
-        if path.is_relative_to(pattern):
-            return True
-        # Check if the pattern is a glob pattern match
-        if fnmatch.fnmatch(str(path), str(pattern)):
-            return True
-    return False
+    return get_path_matcher(patterns).match(path)
 
 
 def get_paths_for_directory(
@@ -124,6 +291,7 @@ def get_paths_for_directory(
     include_patterns: Set[Path] = set(),
     exclude_patterns: Set[Path] = set(),
     recursive: bool = True,
+    text_only: bool = True,
 ) -> Set[Path]:
     """Get all file paths in a directory.
 
@@ -132,11 +300,15 @@ def get_paths_for_directory(
         `include_patterns` - An iterable of absolute paths/glob patterns to include
         `exclude_patterns` - An iterable of absolute paths/glob patterns to exclude
         `recursive` - A boolean flag to recursive traverse child directories
+        `text_only` - Skip files that don't look text-encoded. Pass False if the
+            caller reads the files anyway and can check the content itself.
 
     Return:
         A set of absolute file paths
     """
     paths: Set[Path] = set()
+    include = get_path_matcher(include_patterns)
+    exclude = get_path_matcher(exclude_patterns)
 
     if not path.exists():
         raise RagdaemonError(f"Path {path} does not exist")
@@ -148,20 +320,22 @@ def get_paths_for_directory(
     for root, dirs, files in os.walk(path, topdown=True):
         root = Path(root)
 
-        if get_git_root_for_path(root, raise_error=False):
+        # Only the starting directory can be inside a repo without being its root;
+        # below that, a repo announces itself with a .git entry.
+        if root == path:
+            git_root = find_git_root(root)
+        else:
+            git_root = root if ".git" in dirs or ".git" in files else None
+        if git_root:
             dirs[:] = list[str]()
-            git_non_gitignored_paths = get_non_gitignored_files(root)
+            git_non_gitignored_paths = get_non_gitignored_files(root, git_root=git_root)
             for git_path in git_non_gitignored_paths:
                 abs_git_path = root / git_path
                 if not recursive and git_path.parent != Path("."):
                     continue
-                if any(include_patterns) and not match_path_with_patterns(
-                    abs_git_path, include_patterns
-                ):
+                if include and not include.match(abs_git_path):
                     continue
-                if any(exclude_patterns) and match_path_with_patterns(
-                    abs_git_path, exclude_patterns
-                ):
+                if exclude and exclude.match(abs_git_path):
                     continue
                 paths.add(abs_git_path)
 
@@ -169,32 +343,24 @@ def get_paths_for_directory(
             filtered_dirs: List[str] = []
             for dir_ in dirs:
                 abs_dir_path = root.joinpath(dir_)
-                if any(include_patterns) and not match_path_with_patterns(
-                    abs_dir_path, include_patterns
-                ):
+                if include and not include.match(abs_dir_path):
                     continue
-                if any(exclude_patterns) and match_path_with_patterns(
-                    abs_dir_path, exclude_patterns
-                ):
+                if exclude and exclude.match(abs_dir_path):
                     continue
                 filtered_dirs.append(dir_)
             dirs[:] = filtered_dirs
 
             for file in files:
                 abs_file_path = root.joinpath(file)
-                if any(include_patterns) and not match_path_with_patterns(
-                    abs_file_path, include_patterns
-                ):
+                if include and not include.match(abs_file_path):
                     continue
-                if any(exclude_patterns) and match_path_with_patterns(
-                    abs_file_path, exclude_patterns
-                ):
+                if exclude and exclude.match(abs_file_path):
                     continue
                 paths.add(abs_file_path)
 
             if not recursive:
                 break
-    paths = set(p.resolve() for p in paths if is_file_text_encoded(p))
+    paths = set(p.resolve() for p in paths if not text_only or is_file_text_encoded(p))
     relative_paths = set(p.relative_to(path.resolve()) for p in paths)
 
     return relative_paths
@@ -4,6 +4,9 @@ from typing import Any, cast, TypedDict, Literal, Optional
 import networkx as nx
 from networkx.readwrite import json_graph
 
+from ragdaemon.line_ranges import LineIndex, LineRanges
+from ragdaemon.utils import parse_path_ref
+
 
 class NodeMetadata(TypedDict):
     id: Optional[str]  # Human-readable path, e.g. `path/to/file:class.method`
@@ -38,11 +41,66 @@ class GraphMetadata(TypedDict):
     files_checksum: str  # Hash of all active files in cwd
 
 
+class FileChanges(TypedDict):
+    changed: set[str]  # Ids of file nodes that were added or whose checksum changed
+    removed: set[str]  # Ids of file nodes that were removed
+
+
+def get_file_checksums(graph: nx.MultiDiGraph) -> dict[str, str]:
+    return {
+        node: data.get("checksum")
+        for node, data in graph.nodes(data=True)
+        if data and data.get("type") == "file"
+    }
+
+
+def diff_file_checksums(before: dict[str, str], after: dict[str, str]) -> FileChanges:
+    return FileChanges(
+        changed={
+            node for node, checksum in after.items() if before.get(node) != checksum
+        },
+        removed=set(before) - set(after),
+    )
+
+
+def get_hierarchy_children(graph: nx.MultiDiGraph, node: str) -> set[str]:
+    return {
+        target
+        for _, target, type in graph.out_edges(node, data="type")
+        if type == "hierarchy"
+    }
+
+
+def get_hierarchy_descendants(graph: nx.MultiDiGraph, node: str) -> set[str]:
+    """All nodes below node in the hierarchy, e.g. the chunks of a file."""
+    descendants = set[str]()
+    stack = [node]
+    while stack:
+        for child in get_hierarchy_children(graph, stack.pop()):
+            if child not in descendants:
+                descendants.add(child)
+                stack.append(child)
+    return descendants
+
+
 class KnowledgeGraph(nx.MultiDiGraph):
     graph: GraphMetadata
 
+    def __init__(self, *args, **kwargs):
+        # {file: {chunk: lines}}, collected on first use and then kept up to date as
+        # chunk nodes are added and removed. A file's LineIndex is built from it on
+        # first use and dropped whenever one of its chunks changes.
+        self._chunk_lines: Optional[dict[str, dict[str, LineRanges]]] = None
+        self._line_indexes = dict[str, LineIndex]()
+        super().__init__(*args, **kwargs)
+
     @classmethod
     def load(cls, path: str):
+        """Load a graph saved by Daemon.save.
+
+        Saved nodes hold checksums, not documents, so load_document reads them from
+        the document store; it raises RagdaemonError for documents pruned since.
+        """
         with open(path, "r") as f:
             data = json.load(f)
             graph = json_graph.node_link_graph(data)
@@ -53,7 +111,75 @@ class KnowledgeGraph(nx.MultiDiGraph):
 
     def add_node(self, node_for_adding: str, **attrs):
         validate_attrs(attrs, "node")
-        return super().add_node(node_for_adding, **attrs)
+        self._unindex_node(node_for_adding)
+        super().add_node(node_for_adding, **attrs)
+        self._index_node(node_for_adding)
+
+    def add_nodes_from(self, nodes_for_adding, **attr):
+        nodes_for_adding = list(nodes_for_adding)  # e.g. a generator, from copy()
+        nodes = [
+            item[0] if isinstance(item, tuple) and len(item) == 2 else item
+            for item in nodes_for_adding
+        ]
+        for node in nodes:
+            self._unindex_node(node)
+        super().add_nodes_from(nodes_for_adding, **attr)
+        for node in nodes:
+            self._index_node(node)
+
+    def remove_node(self, n: str):
+        self._unindex_node(n)
+        super().remove_node(n)
+
+    def remove_nodes_from(self, nodes):
+        nodes = list(nodes)
+        for node in nodes:
+            self._unindex_node(node)
+        super().remove_nodes_from(nodes)
+
+    def clear(self):
+        super().clear()
+        self._chunk_lines = None
+        self._line_indexes.clear()
+
+    def _get_chunk_file_lines(self, node: str) -> Optional[tuple[str, LineRanges]]:
+        data = self._node.get(node)
+        if not data or data.get("type") != "chunk" or not data.get("ref"):
+            return None
+        path, lines = parse_path_ref(data["ref"])
+        if lines is None:
+            return None
+        return path.as_posix(), lines
+
+    def _index_node(self, node: str):
+        if self._chunk_lines is None:
+            return
+        file_lines = self._get_chunk_file_lines(node)
+        if file_lines is not None:
+            file, lines = file_lines
+            self._chunk_lines.setdefault(file, {})[node] = lines
+            self._line_indexes.pop(file, None)
+
+    def _unindex_node(self, node: str):
+        if self._chunk_lines is None:
+            return
+        file_lines = self._get_chunk_file_lines(node)
+        if file_lines is not None:
+            file, _ = file_lines
+            self._chunk_lines.get(file, {}).pop(node, None)
+            self._line_indexes.pop(file, None)
+
+    def get_line_index(self, file: str) -> LineIndex:
+        """The line ranges of a file's chunks, for finding which chunks cover lines."""
+        if self._chunk_lines is None:
+            self._chunk_lines = dict[str, dict[str, LineRanges]]()
+            for node in self.nodes:
+                self._index_node(node)
+        index = self._line_indexes.get(file)
+        if index is None:
+            index = LineIndex(self._chunk_lines.get(file, {}).items())
+            self._line_indexes[file] = index
+        return index
 
     def add_edge(
         self, u_for_edge: str, v_for_edge: str, key: Optional[str | int] = None, **attrs
@@ -9,8 +9,12 @@ from typing import Iterator, Optional, Set
 from docker.models.containers import Container
 
 from ragdaemon.errors import RagdaemonError
-from ragdaemon.get_paths import match_path_with_patterns
-from ragdaemon.io.file_like import FileLike
+from ragdaemon.get_paths import (
+    TEXT_SNIFF_BYTES,
+    get_path_matcher,
+    is_text_sample,
+)
+from ragdaemon.io.file_like import FileLike, FileStat
 
 
 class FileInDocker(FileLike):
@@ -78,7 +82,10 @@ class DockerIO:
         yield docker_file
 
     def get_paths_for_directory(
-        self, path: Optional[Path | str] = None, exclude_patterns: Set[Path] = set()
+        self,
+        path: Optional[Path | str] = None,
+        exclude_patterns: Set[Path] = set(),
+        text_only: bool = True,
     ) -> Set[Path]:
         root = self.cwd if path is None else self.cwd / path
         if not self.is_git_repo(path):
@@ -100,23 +107,26 @@ class DockerIO:
                 )
             )
 
+        exclude = get_path_matcher(exclude_patterns)
         files = set[Path]()
         for file in get_non_gitignored_files(root):
-            if exclude_patterns:
+            if exclude:
                 abs_path = (
                     self.container.exec_run(f"realpath {file}")
                     .output.decode("utf-8")
                     .strip()
                 )
-                if match_path_with_patterns(abs_path, exclude_patterns):
+                if exclude.match(Path(abs_path)):
                     continue
-            try:
-                with self.open(file) as f:
-                    f.read()
-            except FileNotFoundError:
-                continue  # File was deleted
-            except UnicodeDecodeError:
-                continue  # File is not text-encoded
+            if text_only:
+                # Only the start of the file leaves the container
+                result = self.container.exec_run(
+                    ["head", "-c", str(TEXT_SNIFF_BYTES), f"/{self.cwd / file}"]
+                )
+                if result.exit_code != 0:
+                    continue  # File was deleted
+                if not is_text_sample(result.output):
+                    continue  # File is not text-encoded
             files.add(file)
         return files
 
@@ -136,6 +146,14 @@ class DockerIO:
             raise FileNotFoundError(f"No such file exists: {path}")
         return float(result.output.decode("utf-8"))
 
+    def stat(self, path: Path | str) -> FileStat:
+        path = self.cwd / path
+        result = self.container.exec_run(f"stat -c '%Y %s %i' {path}")
+        if result.exit_code != 0:
+            raise FileNotFoundError(f"No such file exists: {path}")
+        mtime, size, inode = result.output.decode("utf-8").split()
+        return FileStat(mtime=float(mtime), size=int(size), inode=int(inode))
+
     def get_git_diff(self, diff_args: Optional[str] = None) -> str:
         args = ["git", "diff", "-U1"]
         if diff_args and diff_args != "DEFAULT":
@@ -145,6 +163,34 @@ class DockerIO:
             raise IOError(f"Failed to get git diff: {result.output.decode('utf-8')}")
         return result.output.decode("utf-8")
 
+    def iter_git_diff(self, diff_args: Optional[str] = None) -> Iterator[bytes]:
+        """Stream git diff output line by line, without holding all of it."""
+        args = ["git", "diff", "-U1"]
+        if diff_args and diff_args != "DEFAULT":
+            args += diff_args.split(" ")
+        api = self.container.client.api
+        exec_id = api.exec_create(
+            self.container.id, args, stderr=False, workdir=f"/{self.cwd}"
+        )["Id"]
+        buffer = b""
+        for output in api.exec_start(exec_id, stream=True):
+            *lines, buffer = (buffer + output).split(b"\n")
+            for line in lines:
+                yield line + b"\n"
+        if buffer:
+            yield buffer
+        if api.exec_inspect(exec_id)["ExitCode"] != 0:
+            raise IOError(f"Failed to get git diff {diff_args}")
+
+    def resolve_commits(self, revisions: list[str]) -> Optional[list[str]]:
+        """Return the commit SHA of each revision, or None if any isn't a commit."""
+        args = ["git", "rev-parse"] + [f"{rev}^{{commit}}" for rev in revisions]
+        result = self.container.exec_run(args, stderr=False, workdir=f"/{self.cwd}")
+        shas = result.output.decode("utf-8").split()
+        if result.exit_code != 0 or len(shas) != len(revisions):
+            return None
+        return shas
+
     def mkdir(self, path: Path | str, parents: bool = False, exist_ok: bool = False):
         result = self.container.exec_run(f"mkdir -p {self.cwd / path}")
         if result.exit_code != 0:
@@ -1,8 +1,8 @@
-from typing import Protocol
+from typing import Protocol, TypedDict
 
 
 class FileLike(Protocol):
-    def read(self) -> str:
+    def read(self, size: int = -1) -> str:
         ...
 
     def write(self, data: str) -> int:
@@ -13,3 +13,9 @@ class FileLike(Protocol):
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
         ...
+
+
+class FileStat(TypedDict):
+    mtime: float
+    size: int
+    inode: int
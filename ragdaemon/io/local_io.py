@@ -5,7 +5,7 @@ from typing import Any, Iterator, Optional, Set, Union
 from types import TracebackType
 
 from ragdaemon.get_paths import get_paths_for_directory
-from ragdaemon.io.file_like import FileLike
+from ragdaemon.io.file_like import FileLike, FileStat
 
 
 class FileWrapper:
@@ -41,10 +41,15 @@ class LocalIO:
             yield FileWrapper(file)
 
     def get_paths_for_directory(
-        self, path: Optional[Path | str] = None, exclude_patterns: Set[Path] = set()
+        self,
+        path: Optional[Path | str] = None,
+        exclude_patterns: Set[Path] = set(),
+        text_only: bool = True,
     ):
         path = self.cwd if path is None else self.cwd / path
-        return get_paths_for_directory(path, exclude_patterns=exclude_patterns)
+        return get_paths_for_directory(
+            path, exclude_patterns=exclude_patterns, text_only=text_only
+        )
 
     def is_git_repo(self, path: Optional[Path | str] = None):
         args = ["git", "ls-files", "--error-unmatch"]
@@ -59,6 +64,10 @@ class LocalIO:
     def last_modified(self, path: Path | str) -> float:
         return (self.cwd / path).stat().st_mtime
 
+    def stat(self, path: Path | str) -> FileStat:
+        st = (self.cwd / path).stat()
+        return FileStat(mtime=st.st_mtime, size=st.st_size, inode=st.st_ino)
+
     def get_git_diff(self, diff_args: Optional[str] = None) -> str:
         args = ["git", "diff", "-U1"]
         if diff_args and diff_args != "DEFAULT":
@@ -66,6 +75,29 @@ class LocalIO:
         diff = subprocess.check_output(args, cwd=self.cwd, text=True)
         return diff
 
+    def iter_git_diff(self, diff_args: Optional[str] = None) -> Iterator[bytes]:
+        """Stream git diff output line by line, without holding all of it."""
+        args = ["git", "diff", "-U1"]
+        if diff_args and diff_args != "DEFAULT":
+            args += diff_args.split(" ")
+        with subprocess.Popen(args, cwd=self.cwd, stdout=subprocess.PIPE) as process:
+            assert process.stdout is not None
+            for line in process.stdout:
+                # Translate newlines like get_git_diff's text mode does
+                line = line.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+                yield from line.splitlines(keepends=True)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
+
+    def resolve_commits(self, revisions: list[str]) -> Optional[list[str]]:
+        """Return the commit SHA of each revision, or None if any isn't a commit."""
+        args = ["git", "rev-parse"] + [f"{rev}^{{commit}}" for rev in revisions]
+        output = subprocess.run(args, cwd=self.cwd, capture_output=True, text=True)
+        shas = output.stdout.split()
+        if output.returncode != 0 or len(shas) != len(revisions):
+            return None
+        return shas
+
     def mkdir(self, path: Path | str, parents: bool = False, exist_ok: bool = False):
         (self.cwd / path).mkdir(parents=parents, exist_ok=exist_ok)
 
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+from bisect import bisect_right
+from typing import Iterable, Iterator
+
+
+class LineRanges:
+    """An immutable set of line numbers, stored as sorted inclusive (start, end) ranges.
+
+    Supports the set operations used on refs (|, -, &, in, iteration) at a cost that
+    scales with the number of ranges, not the number of lines.
+    """
+
+    __slots__ = ("ranges", "_starts")
+
+    def __init__(self, ranges: Iterable[tuple[int, int]] = ()):
+        merged = list[tuple[int, int]]()
+        for start, end in sorted(r for r in ranges if r[0] <= r[1]):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        self.ranges = tuple(merged)
+        self._starts = [start for start, _ in merged]
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[int]) -> LineRanges:
+        return cls((line, line) for line in lines)
+
+    @classmethod
+    def from_ref(cls, ref: str) -> LineRanges:
+        """Parse a lines ref, e.g. '1-3,5'."""
+        ranges = list[tuple[int, int]]()
+        for part in ref.split(","):
+            if "-" in part:
+                start, end = part.split("-")
+                ranges.append((int(start), int(end)))
+            else:
+                ranges.append((int(part), int(part)))
+        return cls(ranges)
+
+    def to_ref(self) -> str:
+        return ",".join(
+            str(start) if start == end else f"{start}-{end}"
+            for start, end in self.ranges
+        )
+
+    @property
+    def start(self) -> int:
+        """The first line, like min(lines); raises ValueError if empty."""
+        if not self.ranges:
+            raise ValueError("LineRanges is empty")
+        return self.ranges[0][0]
+
+    @property
+    def end(self) -> int:
+        """The last line, like max(lines); raises ValueError if empty."""
+        if not self.ranges:
+            raise ValueError("LineRanges is empty")
+        return self.ranges[-1][1]
+
+    def __iter__(self) -> Iterator[int]:
+        for start, end in self.ranges:
+            yield from range(start, end + 1)
+
+    def __len__(self) -> int:
+        return sum(end - start + 1 for start, end in self.ranges)
+
+    def __bool__(self) -> bool:
+        return bool(self.ranges)
+
+    def __contains__(self, line: object) -> bool:
+        if not isinstance(line, int):
+            return False
+        i = bisect_right(self._starts, line) - 1
+        return i >= 0 and line <= self.ranges[i][1]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, LineRanges):
+            return NotImplemented
+        return self.ranges == other.ranges
+
+    def __hash__(self) -> int:
+        return hash(self.ranges)
+
+    def __repr__(self) -> str:
+        return f"LineRanges({self.to_ref()!r})"
+
+    def __or__(self, other: LineRanges) -> LineRanges:
+        return LineRanges(self.ranges + other.ranges)
+
+    def __and__(self, other: LineRanges) -> LineRanges:
+        output = list[tuple[int, int]]()
+        i = j = 0
+        while i < len(self.ranges) and j < len(other.ranges):
+            start = max(self.ranges[i][0], other.ranges[j][0])
+            end = min(self.ranges[i][1], other.ranges[j][1])
+            if start <= end:
+                output.append((start, end))
+            if self.ranges[i][1] < other.ranges[j][1]:
+                i += 1
+            else:
+                j += 1
+        return LineRanges(output)
+
+    def __sub__(self, other: LineRanges) -> LineRanges:
+        output = list[tuple[int, int]]()
+        j = 0
+        for start, end in self.ranges:
+            # Skip ranges of other that end before this one starts
+            while j < len(other.ranges) and other.ranges[j][1] < start:
+                j += 1
+            k = j
+            while k < len(other.ranges) and other.ranges[k][0] <= end:
+                if other.ranges[k][0] > start:
+                    output.append((start, other.ranges[k][0] - 1))
+                start = max(start, other.ranges[k][1] + 1)
+                k += 1
+            if start <= end:
+                output.append((start, end))
+        return LineRanges(output)
+
+    def union(self, *others: LineRanges) -> LineRanges:
+        ranges = list(self.ranges)
+        for other in others:
+            ranges.extend(other.ranges)
+        return LineRanges(ranges)
+
+    def overlaps(self, other: LineRanges) -> bool:
+        """Whether any line is in both, without building the intersection."""
+        i = j = 0
+        while i < len(self.ranges) and j < len(other.ranges):
+            if max(self.ranges[i][0], other.ranges[j][0]) <= min(
+                self.ranges[i][1], other.ranges[j][1]
+            ):
+                return True
+            if self.ranges[i][1] < other.ranges[j][1]:
+                i += 1
+            else:
+                j += 1
+        return False
+
+
+class LineIndex:
+    """Maps the line ranges of a file's nodes back to node ids.
+
+    Ranges are kept sorted by start with a running max of their ends, so a query
+    walks back from the last range starting inside it and stops once no earlier
+    range can reach it: O(log n + k) when ranges don't overlap, as for chunks.
+    """
+
+    def __init__(self, nodes: Iterable[tuple[str, LineRanges]] = ()):
+        entries = sorted(
+            (start, end, node) for node, lines in nodes for start, end in lines.ranges
+        )
+        self._starts = [start for start, _, _ in entries]
+        self._ends = [end for _, end, _ in entries]
+        self._nodes = [node for _, _, node in entries]
+        self._max_ends = list[int]()
+        for end in self._ends:
+            self._max_ends.append(
+                max(end, self._max_ends[-1]) if self._max_ends else end
+            )
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def query(self, lines: LineRanges) -> set[str]:
+        """Ids of nodes covering any of the given lines."""
+        nodes = set[str]()
+        for start, end in lines.ranges:
+            i = bisect_right(self._starts, end) - 1
+            while i >= 0 and self._max_ends[i] >= start:
+                if self._ends[i] >= start:
+                    nodes.add(self._nodes[i])
+                i -= 1
+        return nodes
@@ -0,0 +1,86 @@
+import json
+from pathlib import Path
+from typing import Iterable, Optional, TypedDict
+
+from ragdaemon.io.file_like import FileStat
+
+
+class ScanRecord(TypedDict):
+    mtime: float
+    size: int
+    inode: int
+    checksum: Optional[str]  # None if the file isn't text-encoded
+
+
+# Filesystems with coarse timestamps (and `stat -c %Y` in docker) can report the same
+# mtime before and after a write. Records whose mtime falls this close to the last scan
+# are re-hashed rather than trusted, same as git's 'racy clean' check.
+RACY_MARGIN = 1.0
+
+
+class ScanIndex:
+    """Persisted {path: (mtime, size, inode, checksum)} records of the last scan.
+
+    Lets the Hierarchy annotator skip reading and hashing files whose stat hasn't
+    changed since they were last hashed.
+    """
+
+    def __init__(self, path: Optional[Path] = None, cwd: Optional[str] = None):
+        self.path = path
+        self.cwd = cwd
+        self.scanned_at = 0.0
+        self.records = dict[str, ScanRecord]()
+        self._modified = False
+        if path is not None and path.exists():
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if data.get("cwd") == cwd:
+                    self.scanned_at = data["scanned_at"]
+                    self.records = data["records"]
+            except (OSError, ValueError, KeyError):
+                pass  # Corrupt or outdated index; rebuild from scratch.
+
+    def lookup(self, path_str: str, stat: FileStat) -> Optional[ScanRecord]:
+        """Return the record for path if its stat is unchanged since it was hashed."""
+        record = self.records.get(path_str)
+        if record is None:
+            return None
+        if (
+            record["mtime"] != stat["mtime"]
+            or record["size"] != stat["size"]
+            or record["inode"] != stat["inode"]
+        ):
+            return None
+        if stat["mtime"] >= self.scanned_at - RACY_MARGIN:
+            return None
+        return record
+
+    def record(self, path_str: str, stat: FileStat, checksum: Optional[str]):
+        self.records[path_str] = ScanRecord(
+            mtime=stat["mtime"],
+            size=stat["size"],
+            inode=stat["inode"],
+            checksum=checksum,
+        )
+        self._modified = True
+
+    def prune(self, active: Iterable[str]):
+        """Drop records for paths that are no longer active."""
+        active = set(active)
+        removed = [path_str for path_str in self.records if path_str not in active]
+        for path_str in removed:
+            del self.records[path_str]
+        if removed:
+            self._modified = True
+
+    def save(self, scanned_at: float):
+        """Write the index to disk. scanned_at should be when the scan *started*."""
+        self.scanned_at = scanned_at
+        if self.path is None or not self._modified:
+            return
+        data = {"cwd": self.cwd, "scanned_at": scanned_at, "records": self.records}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(data, f)
+        self._modified = False
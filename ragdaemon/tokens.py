@@ -0,0 +1,224 @@
+import json
+from functools import lru_cache
+from threading import Lock
+from typing import Any, Optional
+
+import tiktoken
+from spice import Spice
+from spice.models import Model, UnknownModel
+from spice.providers import OPEN_AI
+from spice.spice import get_model_from_name
+
+from ragdaemon.database import Database
+from ragdaemon.document_store import document_store
+from ragdaemon.errors import RagdaemonError
+from ragdaemon.utils import hash_str
+
+# Long enough that spice's rounding doesn't skew the ratio it counts at
+TOKEN_SCALE_SAMPLE = "def add(a, b):\n    return a + b\n\n\n" * 50
+# Characters first read per token of the limit when truncating a stored document,
+# and tokens past the limit it must hold, since its last tokens can differ from the
+# whole document's where it cuts a word
+TRUNCATE_CHARS_PER_TOKEN = 8
+TRUNCATE_MARGIN_TOKENS = 64
+
+
+def get_model(model: str | Model) -> Model:
+    if isinstance(model, str):
+        model = get_model_from_name(model)
+        if isinstance(model, UnknownModel):
+            raise RagdaemonError(f"Unrecognized model: {model}")
+    return model
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model_name: str) -> tuple[tiktoken.Encoding, float]:
+    """Return the encoding spice counts a model's tokens with, loaded once per model.
+
+    Spice estimates non-OpenAI models as a multiple of an OpenAI encoding, so also
+    return that multiple (1 for OpenAI models): tokens = len(encode(text)) * scale.
+    """
+    model = get_model(model_name)
+    if model.provider == OPEN_AI:
+        try:
+            return tiktoken.encoding_for_model(model.name), 1
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base"), 1
+    encoding = tiktoken.get_encoding("cl100k_base")
+    sample_tokens = len(encoding.encode(TOKEN_SCALE_SAMPLE, disallowed_special=()))
+    return encoding, Spice().count_tokens(TOKEN_SCALE_SAMPLE, model) / sample_tokens
+
+
+class TokenCounts:
+    """Token counts of documents, addressed by document checksum and model name.
+
+    A document's count can't change, so counts are kept for the life of the process
+    and saved to the metadata of the document's DB record, where annotators load
+    them back from.
+    """
+
+    def __init__(self):
+        self.counts = dict[str, dict[str, int]]()  # {checksum: {model: tokens}}
+        self._unsaved = set[str]()  # Checksums with counts not yet in the DB
+        self._lock = Lock()  # Annotators count from thread pools
+
+    def get(self, checksum: str, model: str | Model) -> Optional[int]:
+        model_name = model if isinstance(model, str) else model.name
+        return self.counts.get(checksum, {}).get(model_name)
+
+    def put(self, checksum: str, model: str | Model, tokens: int):
+        model_name = model if isinstance(model, str) else model.name
+        with self._lock:
+            counts = self.counts.setdefault(checksum, {})
+            if counts.get(model_name) != tokens:
+                counts[model_name] = tokens
+                self._unsaved.add(checksum)
+
+    def count(
+        self, text: str, model: str | Model, checksum: Optional[str] = None
+    ) -> int:
+        """Return the tokens in text, only tokenizing it the first time it's seen.
+
+        Pass the text's checksum if it's already known, to skip hashing it.
+        """
+        model = get_model(model)
+        if checksum is None:
+            checksum = hash_str(text)
+        tokens = self.get(checksum, model)
+        if tokens is None:
+            encoding, scale = get_tokenizer(model.name)
+            tokens = int(len(encoding.encode(text, disallowed_special=())) * scale)
+            self.put(checksum, model, tokens)
+        return tokens
+
+    def load(self, checksum: str, metadata: dict[str, Any]) -> dict[str, Any]:
+        """Cache the counts saved in a DB record; return the rest of its metadata."""
+        metadata = dict(metadata)
+        tokens = metadata.pop("tokens", None)
+        if tokens:
+            with self._lock:
+                counts = self.counts.setdefault(checksum, {})
+                for model_name, model_tokens in json.loads(tokens).items():
+                    counts.setdefault(model_name, model_tokens)
+        return metadata
+
+    def save(self, db: Database):
+        """Write counts added since the last save to their documents' DB records."""
+        with self._lock:
+            checksums, self._unsaved = list(self._unsaved), set[str]()
+        if not checksums:
+            return
+        # Records are only added by annotators, so skip documents not in the DB
+        response = db.get(ids=checksums, include=["metadatas"])
+        update_db = {"ids": [], "metadatas": []}
+        for checksum, metadata in zip(response["ids"], response["metadatas"]):
+            # Keep the rest of the record, since LiteDB replaces it on update
+            metadata = self.load(checksum, metadata)
+            metadata["tokens"] = json.dumps(self.counts[checksum])
+            update_db["ids"].append(checksum)
+            update_db["metadatas"].append(metadata)
+        if len(update_db["ids"]) > 0:
+            db.update(**update_db)
+
+
+token_counts = TokenCounts()
+
+
+def count_tokens(text: str, model: str | Model, checksum: Optional[str] = None) -> int:
+    return token_counts.count(text, model, checksum)
+
+
+def count_tokens_batch(texts: list[str], model: str | Model) -> list[int]:
+    """Return the tokens in each of many texts, e.g. lines, without caching them."""
+    encoding, scale = get_tokenizer(get_model(model).name)
+    return [int(len(t) * scale) for t in encoding.encode_ordinary_batch(texts)]
+
+
+@lru_cache(maxsize=4096)
+def count_join_tokens(model_name: str, tail: str, head: str) -> int:
+    """Return the tokens that joining two texts with a newline adds to their counts."""
+    joined, *parts = count_tokens_batch([f"{tail}\n{head}", tail, head], model_name)
+    return joined - sum(parts)
+
+
+def get_token_limit(model: Model, tokens: int | None = None) -> Optional[int]:
+    max_tokens = model.context_length
+    if tokens is not None:
+        max_tokens = tokens if max_tokens is None else min(max_tokens, tokens)
+    return max_tokens
+
+
+def cut_tokens(
+    document: str, doc_tokens: list[int], model: Model, max_tokens: int
+) -> tuple[str, float]:
+    """Cut an encoded document to max_tokens, labelled, if it doesn't fit."""
+    encoding, scale = get_tokenizer(model.name)
+    keep_tokens = max(0, int(max_tokens / scale))
+    if len(doc_tokens) <= keep_tokens:
+        return document, 0
+
+    label = "\n[TRUNCATED]"
+    keep_tokens = max(0, keep_tokens - len(encoding.encode(label)))
+    _, offsets = encoding.decode_with_offsets(doc_tokens)
+    document = document[: offsets[keep_tokens]] + label
+    return document, 1 - keep_tokens / len(doc_tokens)
+
+
+def truncate(
+    document: str,
+    model: str | Model | None = None,
+    tokens: int | None = None,
+    checksum: Optional[str] = None,
+) -> tuple[str, float]:
+    """Return an embeddable document, and what fraction was removed.
+
+    The document is tokenized at most once, and cut at the start of the first token
+    that doesn't fit alongside the [TRUNCATED] label. Documents whose count is
+    cached and fit aren't tokenized at all.
+    """
+    if model is None:
+        return document, 0
+
+    model = get_model(model)
+    max_tokens = get_token_limit(model, tokens)
+    if max_tokens is None:
+        return document, 0
+
+    if checksum is None:
+        checksum = hash_str(document)
+    doc_count = token_counts.get(checksum, model)
+    if doc_count is not None and doc_count <= max_tokens:
+        return document, 0
+
+    encoding, scale = get_tokenizer(model.name)
+    doc_tokens = encoding.encode(document, disallowed_special=())
+    token_counts.put(checksum, model, int(len(doc_tokens) * scale))
+    return cut_tokens(document, doc_tokens, model, max_tokens)
+
+
+def truncate_stored(
+    checksum: str, model: str | Model | None = None, tokens: int | None = None
+) -> tuple[str, float]:
+    """Like truncate, for a document in the document store, reading no more of it
+    than is needed to fill the limit.
+
+    A document cut from a prefix is never fully counted, so the fraction removed is
+    only that of the prefix read.
+    """
+    model = None if model is None else get_model(model)
+    max_tokens = None if model is None else get_token_limit(model, tokens)
+    doc_count = None if model is None else token_counts.get(checksum, model)
+    if max_tokens is None or (doc_count is not None and doc_count <= max_tokens):
+        return truncate(document_store.get(checksum), model, tokens, checksum)
+
+    assert model is not None
+    encoding, scale = get_tokenizer(model.name)
+    size = max_tokens * TRUNCATE_CHARS_PER_TOKEN
+    while True:
+        prefix, complete = document_store.read(checksum, size)
+        if complete:
+            return truncate(prefix, model, tokens, checksum)
+        prefix_tokens = encoding.encode(prefix, disallowed_special=())
+        if (len(prefix_tokens) - TRUNCATE_MARGIN_TOKENS) * scale > max_tokens:
+            return cut_tokens(prefix, prefix_tokens, model, max_tokens)
+        size *= 2  # Fits so far, so read on
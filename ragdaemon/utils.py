@@ -3,13 +3,14 @@ import hashlib
 import re
 from base64 import b64encode
 from pathlib import Path
+from typing import Iterable, Optional
 
-from spice import Spice
-from spice.models import GPT_4o_mini, Model, UnknownModel
-from spice.spice import get_model_from_name
+from spice.models import GPT_4o_mini
 
 from ragdaemon.errors import RagdaemonError
+from ragdaemon.get_paths import TEXT_SNIFF_BYTES, is_text_sample
 from ragdaemon.io import IO
+from ragdaemon.line_ranges import LineRanges
 
 mentat_dir_path = Path.home() / ".mentat"
 
@@ -56,18 +57,12 @@ def basic_auth(username: str, password: str):
     return f"Basic {token}"
 
 
-def parse_lines_ref(ref: str) -> set[int] | None:
-    lines = set()
-    for ref in ref.split(","):
-        if "-" in ref:
-            start, end = ref.split("-")
-            lines.update(range(int(start), int(end) + 1))
-        else:
-            lines.add(int(ref))
+def parse_lines_ref(ref: str) -> LineRanges | None:
+    lines = LineRanges.from_ref(ref)
     return lines or None
 
 
-def parse_path_ref(ref: str) -> tuple[Path, set[int] | None]:
+def parse_path_ref(ref: str) -> tuple[Path, LineRanges | None]:
     match = re.match(r"^(.*?)(?::([0-9,\-]+))?$", ref)
     if not match:
         return Path(ref), None
@@ -80,7 +75,7 @@ def parse_path_ref(ref: str) -> tuple[Path, set[int] | None]:
     return Path(path_str), lines
 
 
-def parse_diff_id(id: str) -> tuple[str, Path | None, set[int] | None]:
+def parse_diff_id(id: str) -> tuple[str, Path | None, LineRanges | None]:
     if ":" in id:
         diff_ref, path_ref = id.split(":", 1)
         path, lines = parse_path_ref(path_ref)
@@ -93,20 +88,8 @@ def get_document(
     ref: str, io: IO, type: str = "file", ignore_patterns: set[Path] = set()
 ) -> str:
     if type == "diff":
-        if ":" in ref:
-            diff_ref, lines_ref = ref.split(":", 1)
-            lines = parse_lines_ref(lines_ref)
-        else:
-            diff_ref, lines = ref, None
-        diff = io.get_git_diff(diff_ref)
-        if lines:
-            text = "\n".join(
-                [line for i, line in enumerate(diff.split("\n")) if i + 1 in lines]
-            )
-        else:
-            text = diff
-        ref = f"git diff{'' if diff_ref == 'DEFAULT' else f' {diff_ref}'}"
-
+        diff_ref = ref.split(":", 1)[0]
+        return get_diff_document(ref, io.get_git_diff(diff_ref))
     elif type == "directory":
         path = None if ref == "ROOT" else Path(ref)
         paths = sorted(
@@ -125,14 +108,18 @@ def get_document(
             text = ""
             with io.open(path, "r") as f:
                 file_lines = f.read().split("\n")
-            if max(lines) > len(file_lines):
+            if lines.end > len(file_lines):
                 raise RagdaemonError(f"{type} {ref} has invalid line numbers")
-            for line in sorted(lines):
-                text += f"{file_lines[line - 1]}\n"
+            for start, end in lines.ranges:
+                text += "".join(f"{line}\n" for line in file_lines[start - 1 : end])
         else:
             try:
                 with io.open(path, "r") as f:
-                    text = f.read()
+                    # Sniff the start first so big binaries aren't read in full
+                    text = f.read(TEXT_SNIFF_BYTES)
+                    if not is_text_sample(text):
+                        raise RagdaemonError(f"Not a text file: {path}")
+                    text += f.read()
             except UnicodeDecodeError:
                 raise RagdaemonError(f"Not a text file: {path}")
     else:
@@ -141,56 +128,68 @@ def get_document(
     return f"{ref}\n{text}"
 
 
-def truncate(
-    document, model: str | Model | None = None, tokens: int | None = None
-) -> tuple[str, float]:
-    """Return an embeddable document, and what fraction was removed."""
-    if model is None:
-        return document, 0
-
-    if isinstance(model, str):
-        model = get_model_from_name(model)
-        if isinstance(model, UnknownModel):
-            raise RagdaemonError(f"Unrecognized model: {model}")
-    max_tokens = model.context_length
-    if tokens is not None:
-        max_tokens = tokens if max_tokens is None else min(max_tokens, tokens)
-    doc_tokens = Spice().count_tokens(document, model=model.name)
-    if max_tokens is None or doc_tokens <= max_tokens:
-        return document, 0
-
-    original_tokens = doc_tokens
-    while doc_tokens > max_tokens:
-        truncate_ratio = (max_tokens / doc_tokens) * 0.98  # Saw some errors with .99
-        document = document[: int(len(document) * truncate_ratio)]
-        doc_tokens = Spice().count_tokens(document, model=model.name)
-    truncate_ratio = 1 - doc_tokens / original_tokens
-    if truncate_ratio > 0:
-        label = "\n[TRUNCATED]"
-        document = document[: -len(label)] + label
-    return document, truncate_ratio
-
-
-def lines_set_to_ref(lines: set[int]) -> str:
+def get_line_offsets(text: str) -> list[int]:
+    """Return the start offset of each line in text, plus one past the end.
+
+    Line n (1-indexed) is text[offsets[n - 1] : offsets[n] - 1].
+    """
+    offsets = [0]
+    position = text.find("\n")
+    while position != -1:
+        offsets.append(position + 1)
+        position = text.find("\n", position + 1)
+    offsets.append(len(text) + 1)
+    return offsets
+
+
+def get_chunk_document(ref: str, text: str, offsets: list[int]) -> str:
+    """Build a chunk's document from its file's text, like get_document(ref, io).
+
+    Contiguous line ranges are sliced directly using the file's line offsets, so
+    chunks cost no I/O and no re-splitting of the file.
+    """
+    _, lines = parse_path_ref(ref)
     if not lines:
-        return ""
-    refs = []
-    low_to_high = sorted(lines)
-    start = end = low_to_high[0]
-    for i in low_to_high[1:]:
-        if i == end + 1:
-            end = i
-        else:
-            if start == end:
-                refs.append(str(start))
-            else:
-                refs.append(f"{start}-{end}")
-            start = end = i
-    if start == end:
-        refs.append(str(start))
+        return f"{ref}\n{text}"
+    if lines.end > len(offsets) - 1:
+        raise RagdaemonError(f"chunk {ref} has invalid line numbers")
+    segments = [
+        text[offsets[start - 1] : offsets[end] - 1] + "\n"
+        for start, end in lines.ranges
+    ]
+    return f"{ref}\n" + "".join(segments)
+
+
+def get_diff_document(ref: str, diff: str, offsets: Optional[list[int]] = None) -> str:
+    """Build a diff node's document from the diff's text, like get_document(ref, io).
+
+    Hunks are sliced from the text by line offsets, so they cost no extra git diff.
+    Pass the diff's offsets when building many hunks from the same diff.
+    """
+    if ":" in ref:
+        diff_ref, lines_ref = ref.split(":", 1)
+        lines = parse_lines_ref(lines_ref)
     else:
-        refs.append(f"{start}-{end}")
-    return ",".join(refs)
+        diff_ref, lines = ref, None
+    if lines:
+        if offsets is None:
+            offsets = get_line_offsets(diff)
+        n_lines = len(offsets) - 1
+        segments = list[str]()
+        for start, end in lines.ranges:
+            start, end = max(start, 1), min(end, n_lines)
+            if start <= end:
+                segments.append(diff[offsets[start - 1] : offsets[end] - 1])
+        text = "\n".join(segments)
+    else:
+        text = diff
+    return f"git diff{'' if diff_ref == 'DEFAULT' else f' {diff_ref}'}\n{text}"
+
+
+def lines_set_to_ref(lines: LineRanges | Iterable[int]) -> str:
+    if not isinstance(lines, LineRanges):
+        lines = LineRanges.from_lines(lines)
+    return lines.to_ref()
 
 
 def match_refresh(refresh: str | bool, target: str) -> bool:
@@ -0,0 +1,362 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import AsyncIterator, Optional, TypedDict
+
+from ragdaemon.graph import FileChanges
+from ragdaemon.io import IO, LocalIO
+from ragdaemon.io.file_like import FileStat
+
+
+class ChangeSet(TypedDict):
+    created: set[Path]
+    modified: set[Path]
+    deleted: set[Path]
+    renamed: dict[Path, Path]  # {old: new}
+
+
+def empty_change_set() -> ChangeSet:
+    return ChangeSet(created=set(), modified=set(), deleted=set(), renamed={})
+
+
+def has_changes(changes: ChangeSet) -> bool:
+    return bool(
+        changes["created"]
+        or changes["modified"]
+        or changes["deleted"]
+        or changes["renamed"]
+    )
+
+
+def get_file_changes(changes: ChangeSet) -> FileChanges:
+    """Convert a change set to the ids of file nodes that Daemon.update patches."""
+    changed = (
+        changes["created"] | changes["modified"] | set(changes["renamed"].values())
+    )
+    removed = changes["deleted"] | set(changes["renamed"])
+    return FileChanges(
+        changed={path.as_posix() for path in changed},
+        removed={path.as_posix() for path in removed},
+    )
+
+
+class Watcher:
+    """Watches the active files of an IO and yields coalesced change sets.
+
+    A change set is emitted once no further changes have been seen for `debounce`
+    seconds. Paths are relative to io.cwd, like io.get_paths_for_directory.
+    """
+
+    def __init__(self, io: IO, debounce: float = 5, verbose: int = 0):
+        self.io = io
+        self.debounce = debounce
+        self.verbose = verbose
+        self.paths = self.io.get_paths_for_directory()
+
+    def changes(self) -> AsyncIterator[ChangeSet]:
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+    """Lists and stats every active path each interval. Works with any IO."""
+
+    def __init__(
+        self, io: IO, interval: float = 2, debounce: float = 5, verbose: int = 0
+    ):
+        super().__init__(io, debounce=debounce, verbose=verbose)
+        self.interval = interval
+        self.snapshot = self.take_snapshot(self.paths)
+
+    def take_snapshot(self, paths: set[Path]) -> dict[Path, FileStat]:
+        snapshot = dict[Path, FileStat]()
+        for path in paths:
+            try:
+                snapshot[path] = self.io.stat(path)
+            except FileNotFoundError:
+                continue  # Deleted since listing
+        return snapshot
+
+    def compare(self, snapshot: dict[Path, FileStat]) -> ChangeSet:
+        changes = empty_change_set()
+        for path, stat in snapshot.items():
+            previous = self.snapshot.get(path)
+            if previous is None:
+                changes["created"].add(path)
+            elif previous != stat:
+                changes["modified"].add(path)
+        changes["deleted"] = set(self.snapshot) - set(snapshot)
+        # A deleted and a created path sharing an inode were renamed
+        created_by_inode = {snapshot[p]["inode"]: p for p in changes["created"]}
+        for path in list(changes["deleted"]):
+            new_path = created_by_inode.get(self.snapshot[path]["inode"])
+            if new_path is not None:
+                changes["renamed"][path] = new_path
+                changes["deleted"].discard(path)
+                changes["created"].discard(new_path)
+        return changes
+
+    async def changes(self) -> AsyncIterator[ChangeSet]:
+        pending = empty_change_set()
+        last_changed = 0.0
+        while True:
+            await asyncio.sleep(self.interval)
+            self.paths = self.io.get_paths_for_directory()
+            snapshot = self.take_snapshot(self.paths)
+            changes = self.compare(snapshot)
+            self.snapshot = snapshot
+            if has_changes(changes):
+                merge_changes(pending, changes)
+                last_changed = time.time()
+            if has_changes(pending) and time.time() - last_changed >= self.debounce:
+                yield pending
+                pending = empty_change_set()
+
+
+def merge_changes(changes: ChangeSet, new: ChangeSet) -> ChangeSet:
+    """Fold a later change set into an earlier one (in place)."""
+    renamed_to = {new_path: old for old, new_path in changes["renamed"].items()}
+    for old, new_path in new["renamed"].items():
+        if old in changes["created"]:
+            changes["created"].discard(old)
+            changes["created"].add(new_path)
+        elif old in renamed_to:
+            changes["renamed"][renamed_to.pop(old)] = new_path
+        else:
+            changes["renamed"][old] = new_path
+            if old in changes["modified"]:
+                changes["modified"].discard(old)
+                changes["modified"].add(new_path)
+    renamed_to = {new_path: old for old, new_path in changes["renamed"].items()}
+    for path in new["deleted"]:
+        if path in changes["created"]:
+            changes["created"].discard(path)  # Created and deleted: no change
+            continue
+        changes["modified"].discard(path)
+        if path in renamed_to:
+            del changes["renamed"][renamed_to[path]]
+            path = renamed_to[path]
+        changes["deleted"].add(path)
+    for path in new["created"]:
+        if path in changes["deleted"]:
+            changes["deleted"].discard(path)  # Deleted and re-created: modified
+            changes["modified"].add(path)
+        else:
+            changes["created"].add(path)
+    for path in new["modified"]:
+        if path not in changes["created"]:
+            changes["modified"].add(path)
+    return changes
+
+
+"""
+Linux inotify, called through libc with ctypes. Watches are added to every directory
+that holds an active file (and their parents up to cwd), so edits to ignored
+directories like node_modules or .git never wake us up. Raw events only mark paths as
+touched; once things go quiet the active paths are re-listed (cheap, see get_paths)
+and compared against the previous listing to build the change set.
+"""
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def load_inotify() -> Optional[ctypes.CDLL]:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1  # Raises AttributeError if unavailable
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class InotifyWatcher(Watcher):
+    """Event-driven watcher for LocalIO on Linux; idles without polling."""
+
+    def __init__(self, *args, libc: ctypes.CDLL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = dict[int, Path]()  # {wd: directory relative to cwd}
+        self.watched = set[Path]()
+        self.touched = set[Path]()
+        self.moves = dict[int, Path]()  # {cookie: moved-from path}
+        self.renamed = dict[Path, Path]()
+        self.overflowed = False
+        self.event = asyncio.Event()
+        self.watch_directories(self.paths)
+        if self.overflowed:  # Some directories couldn't be watched
+            self.close()
+            raise OSError("inotify_add_watch failed")
+
+    def add_watch(self, directory: Path) -> bool:
+        """Watch a directory, returning whether a new watch was added.
+
+        If the watch can't be added (e.g. out of watches), changes to the directory
+        would be missed, so the next collect treats every file as modified.
+        """
+        if directory in self.watched:
+            return False
+        abs_path = os.fsencode(self.io.cwd / directory)
+        wd = self.libc.inotify_add_watch(self.fd, abs_path, WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno not in (2, 20):  # ENOENT, ENOTDIR: gone before we got to it
+                if self.verbose > 0:
+                    error = OSError(errno, os.strerror(errno))
+                    print(f"Failed to watch {directory}: {error}")
+                self.overflowed = True
+            return False
+        self.watches[wd] = directory
+        self.watched.add(directory)
+        return True
+
+    def watch_directories(self, paths: set[Path]) -> bool:
+        """Watch the directories holding paths, returning whether any were new."""
+        directories = {Path(".")}
+        for path in paths:
+            directories.update(path.parents)
+        added = False
+        for directory in sorted(directories):
+            added = self.add_watch(directory) or added
+        return added
+
+    def read_events(self):
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset : offset + length].rstrip(b"\0")
+                offset += length
+                self.handle_event(wd, mask, cookie, os.fsdecode(name))
+        self.event.set()
+
+    def handle_event(self, wd: int, mask: int, cookie: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            self.watched.discard(directory)
+            return
+        if not name:
+            return  # Event on the watched directory itself
+        path = directory / name
+        if mask & IN_ISDIR:
+            # New directories are watched by collect, once listing shows they hold
+            # active files; until then, their files are found by that listing.
+            self.touched.add(path)
+            return
+        if mask & IN_MOVED_FROM:
+            self.moves[cookie] = path
+        elif mask & IN_MOVED_TO and cookie in self.moves:
+            self.renamed[self.moves.pop(cookie)] = path
+        self.touched.add(path)
+
+    def collect(self) -> ChangeSet:
+        """Re-list active paths and turn touched paths into a change set."""
+        paths = self.io.get_paths_for_directory()
+        overflowed, self.overflowed = self.overflowed, False
+        changes = empty_change_set()
+        changes["created"] = paths - self.paths
+        changes["deleted"] = self.paths - paths
+        if overflowed:  # Events were dropped, so anything may have changed
+            if self.verbose > 0:
+                print("inotify queue overflowed, treating all files as modified")
+            changes["modified"] = paths & self.paths
+        else:
+            changes["modified"] = self.touched & paths & self.paths
+        for old, new in self.renamed.items():
+            if old in changes["deleted"] and new in changes["created"]:
+                changes["renamed"][old] = new
+                changes["deleted"].discard(old)
+                changes["created"].discard(new)
+        self.paths = paths
+        self.touched = set()
+        self.moves = dict()
+        self.renamed = dict()
+        # After an overflow, also retry directories whose watches failed
+        if self.watch_directories(paths if overflowed else changes["created"]):
+            # Files written to a new directory before its watch was added were only
+            # seen if they were listed, so list once more
+            self.event.set()
+        return changes
+
+    async def changes(self) -> AsyncIterator[ChangeSet]:
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.fd, self.read_events)
+        try:
+            while True:
+                await self.event.wait()
+                self.event.clear()
+                # Wait for things to go quiet before collecting
+                while True:
+                    try:
+                        await asyncio.wait_for(self.event.wait(), self.debounce)
+                        self.event.clear()
+                    except asyncio.TimeoutError:
+                        break
+                changes = self.collect()
+                if has_changes(changes):
+                    yield changes
+        finally:
+            loop.remove_reader(self.fd)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def get_watcher(
+    io: IO, interval: float = 2, debounce: float = 5, verbose: int = 0
+) -> Watcher:
+    """Return an inotify watcher where supported, otherwise a polling watcher."""
+    libc = load_inotify() if isinstance(io, LocalIO) else None
+    if libc is not None:
+        try:
+            return InotifyWatcher(io, debounce=debounce, verbose=verbose, libc=libc)
+        except OSError as e:  # e.g. out of inotify watches
+            if verbose > 0:
+                print(f"Failed to start inotify watcher: {e}. Falling back to polling.")
+    return PollingWatcher(io, interval=interval, debounce=debounce, verbose=verbose)
@@ -1,12 +1,22 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import pytest
 
 from ragdaemon.annotators import Chunker
+from ragdaemon.annotators.chunker.chunk_line import chunk_document as chunk_line
 from ragdaemon.annotators.chunker.chunk_llm import chunk_document as chunk_llm
+from ragdaemon.annotators.chunker.chunk_ast import chunk_document as chunk_ast
 from ragdaemon.annotators.chunker.chunk_astroid import chunk_document as chunk_astroid
+from ragdaemon.annotators.chunker.chunk_structural import (
+    chunk_document as chunk_structural,
+)
+from ragdaemon.annotators.chunker.utils import resolve_chunk_parent
 from ragdaemon.daemon import Daemon
+from ragdaemon.errors import RagdaemonError
 from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.io import LocalIO
+from ragdaemon.utils import get_chunk_document, get_document, get_line_offsets
 
 
 def test_chunker_is_complete(io, mock_db):
@@ -106,3 +116,172 @@ async def test_chunk_llm(cwd, expected_chunks):
     expected_chunks = sorted(expected_chunks, key=lambda x: x["ref"])
     for actual, expected in zip(actual_chunks, expected_chunks):
         assert actual == expected
+
+
+@pytest.mark.asyncio
+async def test_chunk_documents_sliced_from_file(expected_chunks, tmp_path):
+    text = Path("tests/data/hard_to_chunk.txt").read_text()
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "calculator.py").write_text(text)
+    io = LocalIO(tmp_path)
+
+    offsets = get_line_offsets(text)
+    extra_chunks = [
+        {"id": "", "ref": "src/calculator.py:45"},
+        {"id": "", "ref": "src/calculator.py"},
+    ]
+    for chunk in expected_chunks + extra_chunks:
+        expected = get_document(chunk["ref"], io, type="chunk")
+        assert get_chunk_document(chunk["ref"], text, offsets) == expected
+    with pytest.raises(RagdaemonError):
+        get_chunk_document("src/calculator.py:100", text, offsets)
+
+
+def test_resolve_chunk_parent():
+    chunk_ids = {"a.py:BASE", "a.py:A", "a.py:A.b"}
+    assert resolve_chunk_parent("a.py:BASE", chunk_ids) == "a.py"
+    assert resolve_chunk_parent("a.py:A", chunk_ids) == "a.py:BASE"
+    assert resolve_chunk_parent("a.py:A.b.c", chunk_ids) == "a.py:A.b"
+    assert resolve_chunk_parent("a.py:A.x.y", chunk_ids) == "a.py:A"  # Skips A.x
+    assert resolve_chunk_parent("a.py:B.x", chunk_ids) is None
+
+
+@pytest.mark.asyncio
+async def test_chunker_ast_matches_astroid(cwd):
+    text = Path("tests/data/hard_to_chunk.txt").read_text()
+    documents = [f"src/calculator.py\n{text}"]
+    for path in sorted(cwd.rglob("*.py")):
+        relative = path.relative_to(cwd).as_posix()
+        documents.append(f"{relative}\n{path.read_text()}")
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        for document in documents:
+            actual = await chunk_ast(document, executor=executor)
+            assert actual == await chunk_astroid(document)
+
+        with pytest.raises(SyntaxError):
+            await chunk_ast("broken.py\ndef broken(:\n", executor=executor)
+
+
+@pytest.mark.asyncio
+async def test_chunker_ast_decorators():
+    document = """decorated.py
+import functools
+
+
+@functools.cache
+def cached(a):
+    return a
+
+
+class A:
+    @staticmethod
+    @functools.cache
+    def method():
+        pass
+
+
+@functools.total_ordering
+class B:
+    pass
+"""
+    chunks = {chunk["id"]: chunk["ref"] for chunk in await chunk_ast(document)}
+    assert chunks["decorated.py:cached"] == "decorated.py:4-6"
+    assert chunks["decorated.py:A.method"] == "decorated.py:10-13"
+    # Class decorators stay in the enclosing chunk, as astroid leaves them
+    assert chunks["decorated.py:B"] == "decorated.py:17-18"
+    assert chunks["decorated.py:BASE"] == "decorated.py:1-3,7-8,14-16,19"
+    assert await chunk_ast(document) == await chunk_astroid(document)
+
+
+@pytest.mark.asyncio
+async def test_chunker_python_trailing_class_attributes():
+    document = """a.py
+class A:
+    def method(self):
+        pass
+
+    attribute = 1
+"""
+    # A python parent ends at its last child; later lines go to the enclosing chunk
+    expected = [
+        {"id": "a.py:BASE", "ref": "a.py:4-6"},
+        {"id": "a.py:A", "ref": "a.py:1"},
+        {"id": "a.py:A.method", "ref": "a.py:2-3"},
+    ]
+    assert await chunk_ast(document) == expected
+    assert await chunk_astroid(document) == expected
+
+
+@pytest.mark.asyncio
+async def test_chunker_python_fallback(io):
+    chunker = Chunker(io, max_workers=1)
+    python_chunk_fn = chunker.chunk_extensions_map[".py"]
+    # Null bytes and code nested too deeply to parse fall back to line chunks
+    for code in ["x = 1\x00\n", "x = " + "-" * 100_000 + "1\n"]:
+        assert await python_chunk_fn(f"a.py\n{code}") == await chunk_line(
+            f"a.py\n{code}"
+        )
+
+
+@pytest.mark.asyncio
+async def test_chunker_executor_shutdown(io):
+    chunker = Chunker(io, max_workers=2)
+    executor = chunker.get_executor()
+    assert executor is not None
+    chunker.shutdown_executor()
+    assert chunker._executor is None
+    with pytest.raises(RuntimeError):  # Can't schedule new futures after shutdown
+        executor.submit(print)
+
+
+@pytest.mark.asyncio
+async def test_chunk_structural():
+    text = """import { api } from "./api";
+
+export class Store {
+  items = [];
+
+  async load(id) {
+    if (id) {
+      return api.get("{" + id);
+    }
+  }
+}
+
+export const Item = ({ name }) => {
+  useEffect(() => {
+    api.track(name)
+  }, [name])
+  return <li>{name}</li>
+}
+"""
+    actual = await chunk_structural(f"src/store.js\n{text}")
+    assert actual == [
+        {"id": "src/store.js:BASE", "ref": "src/store.js:1-2,12,19"},
+        {"id": "src/store.js:Store.load", "ref": "src/store.js:6-10"},
+        {"id": "src/store.js:Store", "ref": "src/store.js:3-5,11"},
+        {"id": "src/store.js:Item", "ref": "src/store.js:13-18"},
+    ]
+
+    text = """module Shapes
+  class Square
+    def initialize(side)
+      @side = side
+    end
+
+    def area = @side * @side
+  end
+end
+"""
+    actual = await chunk_structural(f"shapes.rb\n{text}")
+    assert {chunk["id"]: chunk["ref"] for chunk in actual} == {
+        "shapes.rb:BASE": "shapes.rb:10",
+        "shapes.rb:Shapes": "shapes.rb:1,9",
+        "shapes.rb:Shapes.Square": "shapes.rb:2,6,8",
+        "shapes.rb:Shapes.Square.initialize": "shapes.rb:3-5",
+        "shapes.rb:Shapes.Square.area": "shapes.rb:7",
+    }
+
+    with pytest.raises(RagdaemonError):
+        await chunk_structural("broken.go\nfunc main() {\n")
@@ -1,13 +1,25 @@
 import json
+import subprocess
+from unittest.mock import patch
 
 import pytest
 from networkx.readwrite import json_graph
 
-from ragdaemon.annotators.diff import Diff, get_chunks_from_diff, parse_diff_id
+from ragdaemon.annotators.diff import (
+    Diff,
+    DiffOutput,
+    get_chunks_from_diff,
+    get_commit_revisions,
+    iter_diff_hunks,
+    parse_diff_id,
+)
 from ragdaemon.context import ContextBuilder
 from ragdaemon.daemon import Daemon
+from ragdaemon.document_store import document_store
 from ragdaemon.graph import KnowledgeGraph
 from ragdaemon.io import LocalIO
+from ragdaemon.line_ranges import LineRanges
+from ragdaemon.utils import get_diff_document, get_document, hash_str
 
 
 def test_diff_get_chunks_from_diff(cwd_git_diff):
@@ -26,7 +38,12 @@ def test_diff_parse_diff_id():
     tests = [
         ("HEAD", "HEAD", "None", None),
         ("DEFAULT:main.py", "DEFAULT", "main.py", None),
-        ("HEAD HEAD~1:path/to/file:1-2", "HEAD HEAD~1", "path/to/file", {1, 2}),
+        (
+            "HEAD HEAD~1:path/to/file:1-2",
+            "HEAD HEAD~1",
+            "path/to/file",
+            LineRanges([(1, 2)]),
+        ),
     ]
     for id, expected_ref, expected_path, expected_lines in tests:
         actual_ref, actual_path, actual_lines = parse_diff_id(id)
@@ -55,6 +72,73 @@ async def test_diff_annotate(cwd_git_diff, mock_db):
     assert actual_nodes == expected_nodes
 
 
+def test_iter_diff_hunks(cwd_git_diff):
+    io = LocalIO(cwd_git_diff)
+    diff = io.get_git_diff("HEAD")
+    hunks = list(iter_diff_hunks("HEAD", io.iter_git_diff("HEAD"), first_line=1))
+    assert [hunk["id"] for hunk in hunks] == list(get_chunks_from_diff("HEAD", diff))
+    for hunk in hunks:
+        # Byte offsets select the same text as the hunk's line ref
+        text = diff.encode()[hunk["start"] : hunk["end"]].decode()
+        assert f"git diff HEAD\n{text}" == get_diff_document(hunk["ref"], diff)
+
+
+@pytest.mark.asyncio
+async def test_diff_runs_git_diff_once(cwd_git_diff, mock_db):
+    graph = KnowledgeGraph.load("tests/data/hierarchy_graph.json")
+    graph.graph["cwd"] = cwd_git_diff.as_posix()
+    io = LocalIO(cwd_git_diff)
+    annotator = Diff(io)
+    with patch.object(io, "iter_git_diff", wraps=io.iter_git_diff) as iter_git_diff:
+        assert not annotator.is_complete(graph, mock_db)
+        graph = await annotator.annotate(graph, mock_db)
+        assert iter_git_diff.call_count == 1
+
+    # A complete diff closes what it fetched instead of keeping it for annotate
+    with patch.object(DiffOutput, "close", autospec=True) as close:
+        assert annotator.is_complete(graph, mock_db)
+        assert close.call_count == 1
+        assert annotator._diff is None
+
+    # Hunk documents are sliced from the diff, same as fetching them one by one
+    for chunk_id, chunk_ref in graph.nodes["DEFAULT"]["chunks"].items():
+        document = get_document(chunk_ref, io, type="diff")
+        assert graph.nodes[chunk_id]["checksum"] == hash_str(document)
+
+
+@pytest.mark.asyncio
+async def test_diff_commit_range_cache(cwd_git_diff, mock_db):
+    assert get_commit_revisions("") is None
+    assert get_commit_revisions("HEAD") is None
+    assert get_commit_revisions("--cached HEAD~1 HEAD") is None
+    assert get_commit_revisions("main..") == ("..", ["main", "HEAD"])
+    assert get_commit_revisions("a...b") == ("...", ["a", "b"])
+    assert get_commit_revisions("a b") == (" ", ["a", "b"])
+
+    subprocess.run(["git", "add", "."], cwd=cwd_git_diff, check=True)
+    subprocess.run(["git", "commit", "-m", "Modify"], cwd=cwd_git_diff, check=True)
+    io = LocalIO(cwd_git_diff)
+    annotator = Diff(io, diff="HEAD~1..HEAD")
+    assert annotator.resolve_commits() is not None
+    graph = KnowledgeGraph.load("tests/data/hierarchy_graph.json")
+    graph.graph["cwd"] = cwd_git_diff.as_posix()
+    assert not annotator.is_complete(graph, mock_db)
+    graph = await annotator.annotate(graph, mock_db)
+    expected = {n: d for n, d in graph.nodes(data=True) if d["type"] == "diff"}
+    assert len(expected) > 1
+
+    # Same commits, so no more git diffs: not to check, nor to rebuild the nodes
+    with patch.object(io, "iter_git_diff", wraps=io.iter_git_diff) as iter_git_diff:
+        assert annotator.is_complete(graph, mock_db)
+        graph.remove_nodes_from(list(expected))
+        assert not annotator.is_complete(graph, mock_db)
+        graph = await annotator.annotate(graph, mock_db)
+        assert iter_git_diff.call_count == 0
+    actual = {n: d for n, d in graph.nodes(data=True) if d["type"] == "diff"}
+    assert actual == expected
+    assert annotator.is_complete(graph, mock_db)
+
+
 @pytest.mark.asyncio
 async def test_diff_render(cwd_git_diff, mock_db):
     daemon = Daemon(cwd=cwd_git_diff)
@@ -165,3 +249,25 @@ src/operations.py (diff, user-included)
 
 """
     )
+
+
+@pytest.mark.asyncio
+async def test_diff_crlf(cwd_git, mock_db):
+    path = cwd_git / "crlf.txt"
+    path.write_bytes(b"one\r\ntwo\r\nthree\r\n")
+    subprocess.run(["git", "add", "."], cwd=cwd_git, check=True)
+    subprocess.run(["git", "commit", "-m", "CRLF"], cwd=cwd_git, check=True)
+    path.write_bytes(b"one\r\n2\r\nthree\r\n")
+
+    # Newlines are translated as when the diff is read as text
+    graph = KnowledgeGraph.load("tests/data/hierarchy_graph.json")
+    graph.graph["cwd"] = cwd_git.as_posix()
+    io = LocalIO(cwd_git)
+    annotator = Diff(io)
+    graph = await annotator.annotate(graph, mock_db)
+    assert len(graph.nodes[annotator.id]["chunks"]) == 1
+    for node in [annotator.id, *graph.nodes[annotator.id]["chunks"]]:
+        document = get_document(graph.nodes[node]["ref"], io, type="diff")
+        assert "\r" not in document
+        assert graph.nodes[node]["checksum"] == hash_str(document)
+        assert document_store.get(graph.nodes[node]["checksum"]) == document
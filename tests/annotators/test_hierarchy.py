@@ -1,4 +1,5 @@
 import json
+from unittest.mock import patch
 
 from networkx.readwrite import json_graph
 import pytest
@@ -40,3 +41,19 @@ async def test_hierarchy_annotate(cwd, io, mock_db):
 
     assert set(actual.nodes) == set(expected.nodes), "Nodes are not equal"
     assert set(actual.edges) == set(expected.edges), "Edges are not equal"
+
+
+@pytest.mark.asyncio
+async def test_hierarchy_scan_index(cwd, io, mock_db, tmp_path):
+    graph = KnowledgeGraph()
+    graph.graph["cwd"] = cwd.as_posix()
+    scan_index_path = tmp_path / "scan.json"
+    hierarchy = Hierarchy(io, scan_index_path=scan_index_path)
+    graph = await hierarchy.annotate(graph, mock_db)
+    assert scan_index_path.exists()
+
+    # Unchanged files are skipped without being read
+    reloaded = Hierarchy(io, scan_index_path=scan_index_path)
+    with patch.object(io, "open", side_effect=AssertionError("File was read")):
+        actual = await reloaded.annotate(graph, mock_db)
+    assert actual is graph
@@ -6,14 +6,17 @@ import subprocess
 import tarfile
 import tempfile
 from pathlib import Path
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, patch
 
 import docker
 from docker.errors import DockerException
 import pytest
+import tiktoken
 
 from ragdaemon.database import get_db
+from ragdaemon.document_store import document_store
 from ragdaemon.io import LocalIO
+from ragdaemon.tokens import count_join_tokens, get_tokenizer, token_counts
 from ragdaemon.utils import DEFAULT_EMBEDDING_MODEL
 
 
@@ -73,12 +76,36 @@ def cwd_git_diff(cwd_git):
     yield cwd_git
 
 
+@pytest.fixture(autouse=True)
+def mock_document_store(tmp_path_factory, monkeypatch):
+    """Keep documents written by tests out of the real store in the home directory."""
+    monkeypatch.setattr(document_store, "path", tmp_path_factory.mktemp("documents"))
+
+
 # We have to set the key since counting tokens with an openai model loads the openai client
 @pytest.fixture(autouse=True)
 def mock_openai_api_key():
     os.environ["OPENAI_API_KEY"] = "fake_key"
 
 
+@pytest.fixture
+def mock_encoding():
+    """A small byte-level encoding for openai models, since the real ones are
+    downloaded on first use."""
+    ranks = {bytes([i]): i for i in range(256)}
+    for i, merge in enumerate([b"  ", b"    ", b"re", b"ret", b"retu", b"return"]):
+        ranks[merge] = 256 + i
+    encoding = tiktoken.Encoding(
+        name="test", pat_str=r"\s+|\S+", mergeable_ranks=ranks, special_tokens={}
+    )
+    get_tokenizer.cache_clear()
+    with patch("tiktoken.encoding_for_model", return_value=encoding):
+        yield encoding
+    get_tokenizer.cache_clear()
+    count_join_tokens.cache_clear()
+    token_counts.counts.clear()  # Counted with the wrong encoding
+
+
 """
 GithubActions for Linux comes with Docker pre-installed.
 Setting up a Docker environment for MacOS and Windows in Github Actions is tedious.
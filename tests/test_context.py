@@ -1,10 +1,12 @@
 from pathlib import Path
+from unittest.mock import patch
 
 import pytest
 
 from ragdaemon.context import ContextBuilder
 from ragdaemon.daemon import Daemon
 from ragdaemon.graph import KnowledgeGraph
+from ragdaemon.line_ranges import LineRanges
 from ragdaemon.utils import get_document
 
 
@@ -16,7 +18,7 @@ def test_daemon_render_context(io):
     context = ContextBuilder(KnowledgeGraph(), io)
     context.context = {
         path_str: {
-            "lines": set([1, 2, 3, 4, 15]),
+            "lines": LineRanges.from_lines([1, 2, 3, 4, 15]),
             "tags": ["test-flag"],
             "document": get_document(ref, io),
             "diffs": set(),
@@ -41,7 +43,7 @@ src/interface.py (test-flag)
     # Function Chunk
     context.context = {
         path_str: {
-            "lines": set([5, 6, 7, 8, 9, 10, 11, 12, 13, 14]),
+            "lines": LineRanges([(5, 14)]),
             "tags": ["test-flag"],
             "document": get_document(ref, io),
             "diffs": set(),
@@ -80,9 +82,9 @@ async def test_context_builder_methods(cwd, mock_db):
     copied_context = context.copy()
     copied_context.add_ref("src/interface.py:7-9")
 
-    assert context.context["src/interface.py"]["lines"] == set([3, 4, 5])
-    assert copied_context.context["src/interface.py"]["lines"] == set(
-        [3, 4, 5, 7, 8, 9]
+    assert context.context["src/interface.py"]["lines"] == LineRanges([(3, 5)])
+    assert copied_context.context["src/interface.py"]["lines"] == LineRanges(
+        [(3, 5), (7, 9)]
     )
 
     different_context = daemon.get_context("")
@@ -90,8 +92,174 @@ async def test_context_builder_methods(cwd, mock_db):
     different_context.add_ref("src/operations.py")
     combined_context = context + different_context
 
-    assert combined_context.context["src/interface.py"]["lines"] == set([3, 4, 5, 17])
-    assert combined_context.context["src/operations.py"]["lines"] == set(range(1, 23))
+    assert combined_context.context["src/interface.py"]["lines"] == LineRanges(
+        [(3, 5), (17, 17)]
+    )
+    assert combined_context.context["src/operations.py"]["lines"] == LineRanges(
+        [(1, 22)]
+    )
+
+
+def test_context_builder_count_tokens(io, mock_encoding):
+    model = "gpt-4o-mini"
+    context = ContextBuilder(KnowledgeGraph(), io)
+    assert context.count_tokens(model) == 0
+    context.add_ref("src/interface.py:3-5", tags=["user-included"])
+    context.add_ref("src/operations.py")
+    context.add_comment("src/operations.py", "A comment", line=4)
+
+    def expected(**options) -> int:
+        return len(mock_encoding.encode(context.render(**options)))
+
+    assert context.count_tokens(model) == expected()
+    assert context.count_tokens(model, exact=True) == expected()
+    # The newline between files counts too
+    segments = [context.render_path(path) for path in context.context]
+    assert expected() == sum(len(mock_encoding.encode(s)) for s in segments) + 1
+
+    # Changing one path only re-renders and re-counts its segment and joins
+    encode = mock_encoding.encode_ordinary_batch
+    with patch.object(context, "_render_path", wraps=context._render_path) as render:
+        with patch.object(mock_encoding, "encode_ordinary_batch", wraps=encode) as e:
+            context.add_ref("src/interface.py:11-12")
+            assert context.count_tokens(model) == expected()
+            assert render.call_count == 1
+            encoded = [text for call in e.call_args_list for text in call.args[0]]
+            assert context.render_path("src/operations.py") not in encoded
+        context.remove_ref("src/operations.py")
+        assert context.count_tokens(model) == expected()
+        assert render.call_count == 1
+    # Counted once per path, join and set of render options
+    with patch.object(mock_encoding, "encode_ordinary_batch") as e:
+        assert context.count_tokens(model) == expected()
+        assert e.call_count == 0
+    assert context.count_tokens(model, use_tags=True) == expected(use_tags=True)
+    assert context.count_tokens(model, use_tags=True) > context.count_tokens(model)
+    assert context.copy().count_tokens(model) == context.count_tokens(model)
+
+
+def test_context_builder_render_cache(io):
+    context = ContextBuilder(KnowledgeGraph(), io)
+    context.add_ref("src/interface.py:3-5")
+    context.add_ref("src/operations.py:1-2")
+    rendered = context.render(remove_whitespace=True)
+    with patch.object(context, "_render_path", wraps=context._render_path) as render:
+        assert context.render(remove_whitespace=True) == rendered
+        assert render.call_count == 0
+        context.add_comment("src/operations.py", "A comment", line=2)
+        updated = context.render(remove_whitespace=True)
+        assert render.call_count == 1
+    assert updated == rendered.replace("2:\n", "2:\nA comment\n")
+
+    # Forgets what it cached for a replaced context
+    context.context = ContextBuilder(KnowledgeGraph(), io).context
+    assert context.render() == ""
+
+
+def test_context_builder_copy_on_write(io):
+    context = ContextBuilder(KnowledgeGraph(), io)
+    context.add_ref("src/interface.py:3-5")
+    context.add_ref("src/operations.py:1-2")
+    copied = context.copy()
+    assert copied.context is context.context
+
+    # Only the changed record is copied, and never its document
+    copied.add_ref("src/interface.py:7-9")
+    copied.add_comment("src/interface.py", "A comment", line=8)
+    original, changed = context.context, copied.context
+    assert original["src/interface.py"]["lines"] == LineRanges([(3, 5)])
+    assert not original["src/interface.py"]["comments"]
+    assert changed["src/interface.py"]["lines"] == LineRanges([(3, 5), (7, 9)])
+    assert changed["src/operations.py"] is original["src/operations.py"]
+    document = original["src/interface.py"]["document"]
+    assert changed["src/interface.py"]["document"] is document
+
+    # Merges share the records of paths only one side has
+    other = ContextBuilder(KnowledgeGraph(), io)
+    other.add_ref("main.py:1-2")
+    combined = context + other
+    assert combined.context["main.py"] is other.context["main.py"]
+    other.add_ref("main.py:5")
+    assert combined.context["main.py"]["lines"] == LineRanges([(1, 2)])
+
+
+def test_context_builder_pack(io, mock_encoding):
+    model = "gpt-4o-mini"
+    candidates = [
+        {"type": "file", "ref": "main.py", "distance": 0.1},
+        {"type": "chunk", "ref": "src/interface.py:5-14", "distance": 0.3},
+        {"type": "chunk", "ref": "src/interface.py:11-12", "distance": 0.5},
+        {"type": "chunk", "ref": "src/operations.py:4-5", "distance": 0.6},
+    ]
+    costs = list[int]()
+    for candidate in candidates:
+        context = ContextBuilder(KnowledgeGraph(), io)
+        context.add_ref(candidate["ref"])
+        costs.append(context.count_tokens(model))
+
+    # Picks by relevance per token, and keeps going past candidates that don't fit.
+    # Estimates allow for the newline between files, so they're a token over here.
+    context = ContextBuilder(KnowledgeGraph(), io)
+    budget = costs[2] + costs[3] + 2
+    picked = context.pack(candidates, budget, model, tags=["search"])
+    assert picked == [candidates[3], candidates[2]]
+    assert context.count_tokens(model, exact=True) == budget - 1
+    assert context.context["src/interface.py"]["tags"] == {"search"}
+    context = ContextBuilder(KnowledgeGraph(), io)
+    assert context.pack(candidates, budget - 1, model) == [candidates[3]]
+
+    # Lines already included cost nothing more, besides the estimates' allowance
+    # for "..." lines that aren't rendered
+    context = ContextBuilder(KnowledgeGraph(), io)
+    total = costs[0] + costs[1] + costs[3] + 2
+    assert len(context.pack(candidates, total + costs[2] // 2, model)) == 4
+    assert context.count_tokens(model, exact=True) == total
+
+    # If estimates fall short, picks are dropped by estimated cost in one step
+    context = ContextBuilder(KnowledgeGraph(), io)
+    line_tokens = context._get_line_tokens
+
+    def underestimate(*args) -> list[int]:
+        return [tokens // 2 for tokens in line_tokens(*args)]
+
+    with (
+        patch.object(context, "_get_line_tokens", side_effect=underestimate),
+        patch.object(context, "count_tokens", wraps=context.count_tokens) as count,
+    ):
+        picked = context.pack(candidates, costs[0] + costs[3] + 2, model)
+        assert count.call_count <= 3  # Before, once picked, and once dropped
+    assert picked and len(picked) < 4
+    assert context.count_tokens(model, exact=True) <= costs[0] + costs[3] + 2
+
+
+@pytest.mark.asyncio
+async def test_context_builder_reconcile(cwd_git):
+    daemon = Daemon(cwd=cwd_git)
+    await daemon.update(refresh=True)
+    context = ContextBuilder(daemon.graph, daemon.io)
+    context.add_ref("src/operations.py:8-9", tags=["user-included"])
+    context.add_comment("src/operations.py", "Square root", line=20)
+    context.add_ref("src/interface.py:1-3")
+    context.add_ref("main.py")
+    unchanged = context.context["src/interface.py"]
+
+    # Two lines added above subtract, which is edited, and main.py deleted
+    path = cwd_git / "src" / "operations.py"
+    text = path.read_text().replace("return a - b", "return -(b - a)")
+    path.write_text("# One\n# Two\n" + text)
+    (cwd_git / "main.py").unlink()
+    await daemon.update()
+    context.reconcile(daemon.graph)
+
+    assert context.graph is daemon.graph
+    assert context.context["src/interface.py"] is unchanged
+    record = context.context["src/operations.py"]
+    assert record["document"] == get_document("src/operations.py", daemon.io)
+    assert record["lines"] == LineRanges([(10, 11)])
+    assert list(record["comments"]) == [22]
+    assert record["tags"] == {"user-included"}
+    assert "main.py" not in context.context
+    assert "11:    return -(b - a)" in context.render()
 
 
 def test_to_refs(io, mock_db):
@@ -102,7 +270,7 @@ def test_to_refs(io, mock_db):
     context = ContextBuilder(KnowledgeGraph(), io)
     context.context = {
         path_str: {
-            "lines": set([1, 2, 3, 4, 15]),
+            "lines": LineRanges.from_lines([1, 2, 3, 4, 15]),
             "tags": ["test-flag"],
             "document": get_document(ref, io),
             "diffs": set(),
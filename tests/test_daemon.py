@@ -1,6 +1,9 @@
+from unittest.mock import patch
+
 import pytest
 
 from ragdaemon.daemon import Daemon, default_annotators
+from ragdaemon.graph import FileChanges, get_file_checksums
 
 
 def get_message_chunk_set(message):  # Because order can vary
@@ -74,3 +77,58 @@ async def test_daemon_refresh(cwd_git):
     await daemon.update()
     files5 = set(daemon.graph.nodes)
     assert files4 != files5
+
+
+def graph_summary(graph):
+    nodes = {node: data.get("checksum") for node, data in graph.nodes(data=True)}
+    edges = sorted((u, v, type) for u, v, type in graph.edges(data="type"))
+    return nodes, edges
+
+
+@pytest.mark.asyncio
+async def test_daemon_update_incremental(cwd_git):
+    daemon = Daemon(cwd_git.resolve())
+    await daemon.update()
+
+    # Modify one file, add another and remove a third
+    with open(cwd_git / "src" / "operations.py", "a") as f:
+        f.write("\ndef modulo(a, b):\n    return a % b\n")
+    with open(cwd_git / "hello.py", "w") as f:
+        f.write("print('Hello, world!')\n")
+    (cwd_git / "main.py").unlink()
+    chunker = daemon.pipeline["chunker"]
+    with patch.object(
+        chunker, "get_file_chunk_data", wraps=chunker.get_file_chunk_data
+    ) as mock:
+        await daemon.update()
+    assert {call.args[0] for call in mock.call_args_list} == {
+        "src/operations.py",
+        "hello.py",
+    }
+
+    # Patched graph matches one built from scratch
+    fresh = Daemon(cwd_git.resolve())
+    await fresh.update(refresh=True)
+    assert graph_summary(daemon.graph) == graph_summary(fresh.graph)
+
+
+@pytest.mark.asyncio
+async def test_daemon_update_changes(cwd_git):
+    daemon = Daemon(cwd=cwd_git)
+    await daemon.update()
+
+    (cwd_git / "src" / "operations.py").write_text("def add(a, b):\n    return a+b\n")
+    (cwd_git / "main.py").unlink()
+    (cwd_git / "hello.py").write_text("print('Hello, world!')\n")
+    changes = FileChanges(
+        changed={"src/operations.py", "hello.py"}, removed={"main.py"}
+    )
+    # Only the changed files are scanned, without listing the tree
+    with patch.object(
+        daemon.io, "get_paths_for_directory", side_effect=AssertionError("Listed")
+    ):
+        await daemon.update(changes=changes)
+    expected = Daemon(cwd=cwd_git)
+    await expected.update(refresh=True)
+    assert get_file_checksums(daemon.graph) == get_file_checksums(expected.graph)
+    assert set(daemon.graph.nodes) == set(expected.graph.nodes)
@@ -1,9 +1,37 @@
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, patch
 
 from ragdaemon.database import LiteDB, get_db
+from ragdaemon.database.lite_database import BM25Index, tokenize
 from ragdaemon.utils import DEFAULT_EMBEDDING_MODEL
 
 
 def test_mock_database():
     db = get_db(AsyncMock(), embedding_model=DEFAULT_EMBEDDING_MODEL)
     assert isinstance(db, LiteDB)
+
+
+def test_lite_database_bm25_index():
+    db = LiteDB()
+    db.add(["a", "b"], ["def add(a, b)", "def subtract(a, b)"])
+    with patch(
+        "ragdaemon.database.lite_database.tokenize", wraps=tokenize
+    ) as mock_tokenize:
+        db.add(["b", "c"], ["def subtract(a, b)", "return a * b"])
+        assert mock_tokenize.call_count == 1  # Only the new document
+
+    # Same scores as indexing every document at once
+    index = BM25Index()
+    for id, data in db.data.items():
+        index.add(id, tokenize(data["document"]))
+    assert db.bm25.get_scores(["def", "add(a,"]) == index.get_scores(["def", "add(a,"])
+
+    results = db.query("subtract(a, b)", {"a", "b", "c"})
+    assert [result["checksum"] for result in results] == ["b", "a", "c"]
+    assert results[0]["distance"] == 0
+    assert db.query("subtract(a, b)", {"a", "c"})[0]["checksum"] == "a"
+
+    # A changed document's old terms are removed
+    db.add(["b"], ["def multiply(a, b)"])
+    assert "subtract(a," not in db.bm25.postings
+    assert db.bm25.postings["def"] == {"a": 1, "b": 1}
+    assert db.bm25.total_len == sum(db.bm25.doc_lens.values()) == 10
@@ -0,0 +1,87 @@
+import json
+import os
+import time
+
+import pytest
+
+from ragdaemon.daemon import Daemon
+from ragdaemon.document_store import (
+    DocumentStore,
+    document_store,
+    get_saved_checksums,
+    load_document,
+    prune_document_store,
+)
+from ragdaemon.errors import RagdaemonError
+from ragdaemon.utils import hash_str
+
+
+def test_document_store(tmp_path):
+    store = DocumentStore(tmp_path, cache_bytes=10)
+    documents = ["first document", "second document"]
+    for document in documents:
+        store.put(hash_str(document), document)
+
+    # The first document was evicted from the cache but is still on disk
+    assert list(store.cache) == [hash_str(documents[1])]
+    for document in documents:
+        assert hash_str(document) in store
+        assert store.get(hash_str(document)) == document
+    assert DocumentStore(tmp_path).get(hash_str(documents[0])) == documents[0]
+
+    with pytest.raises(RagdaemonError):
+        store.get(hash_str("missing"))
+
+    # Large documents are written in parts and read back in prefixes, uncached
+    document = "".join(documents)
+    store.put_parts(hash_str(document), documents)
+    assert hash_str(document) not in store.cache
+    assert store.read(hash_str(document), 5) == ("first", False)
+    assert store.read(hash_str(document), len(document)) == (document, True)
+    assert store.get(hash_str(document)) == document
+
+
+@pytest.mark.asyncio
+async def test_graph_nodes_hold_checksums(cwd):
+    daemon = Daemon(cwd.resolve(), annotators={"hierarchy": {}, "chunker": {}})
+    await daemon.update(refresh=True)
+    for _, data in daemon.graph.nodes(data=True):
+        assert "document" not in data
+    assert daemon.get_document("main.py").startswith("main.py\n")
+    chunk = daemon.graph.nodes["src/interface.py:parse_arguments"]
+    assert load_document(chunk).startswith("src/interface.py:5-14\n")
+
+
+def test_document_store_prune(tmp_path):
+    store = DocumentStore(tmp_path / "documents")
+    old, used, new = "old document", "used document", "new document"
+    for document in [old, used, new]:
+        store.put(hash_str(document), document)
+    past = time.time() - 2 * 24 * 60 * 60
+    for document in [old, used]:
+        os.utime(store._blob_path(hash_str(document)), (past, past))
+
+    # Only old documents no graph uses are deleted
+    assert store.prune({hash_str(used)}) == 1
+    assert hash_str(old) not in store
+    assert hash_str(used) in store and hash_str(new) in store
+
+    # Putting a stored document again keeps it from being pruned
+    os.utime(store._blob_path(hash_str(used)), (past, past))
+    store.cache.clear()
+    store.put(hash_str(used), used)
+    assert store.prune(set()) == 0
+
+
+def test_prune_document_store(tmp_path):
+    graph = {"nodes": [{"id": "a.py", "checksum": "abc"}, {"id": "ROOT"}]}
+    (tmp_path / "ragdaemon-test.json").write_text(json.dumps(graph))
+    (tmp_path / "ragdaemon-test-scan.json").write_text("{}")
+    assert get_saved_checksums(tmp_path) == {"abc"}
+
+    document = "unused document"
+    document_store.put(hash_str(document), document)
+    assert prune_document_store(tmp_path, interval=0) == 1
+    assert hash_str(document) not in document_store
+    # At most once per interval
+    assert prune_document_store(tmp_path) == 0
@@ -2,9 +2,22 @@ import gc
 import os
 import stat
 import shutil
+import time
 from pathlib import Path
+from unittest.mock import patch
 
-from ragdaemon.get_paths import get_paths_for_directory, get_git_root_for_path
+import pytest
+
+from ragdaemon import get_paths
+from ragdaemon.errors import RagdaemonError
+from ragdaemon.get_paths import (
+    get_git_root_for_path,
+    get_paths_for_directory,
+    is_file_text_encoded,
+    match_path_with_patterns,
+)
+from ragdaemon.io import LocalIO
+from ragdaemon.utils import get_document
 
 
 def test_get_paths_for_directory_git(cwd):
@@ -64,3 +77,85 @@ def test_get_paths_for_directory_without_git(cwd_git_diff):
         Path("src/interface.py"),
         Path("src/operations.py"),
     }, "Paths are not equal"
+
+
+def test_is_file_text_encoded(tmp_path):
+    text = tmp_path / "text.txt"
+    # A multi-byte character straddling the sniffed prefix is still text
+    text.write_bytes(b"a" * 8191 + "\u00e9".encode("utf-8") + b"b" * 10)
+    assert is_file_text_encoded(text)
+
+    # The sniff is advisory: bad bytes past it are caught when the file is read
+    late_binary = tmp_path / "late_binary.txt"
+    late_binary.write_bytes(b"a" * 8192 + b"\xff" * 10)
+    with pytest.raises(RagdaemonError):
+        get_document("late_binary.txt", LocalIO(tmp_path))
+
+    binary = tmp_path / "binary.bin"
+    binary.write_bytes(b"\x89PNG\r\n\x1a\n\x00\x00")
+    assert not is_file_text_encoded(binary)
+
+
+def test_get_paths_for_directory_cached(cwd_git):
+    cwd_git = cwd_git.resolve()
+    (cwd_git / "lib" / "pkg").mkdir(parents=True)
+    (cwd_git / "lib" / "pkg" / "a.py").write_text("a = 1\n")
+
+    def backdate():
+        """Backdate everything so the listing isn't considered racy"""
+        past = time.time() - 60
+        for root, dirs, files in os.walk(cwd_git):
+            for name in dirs + files:
+                os.utime(os.path.join(root, name), (past, past))
+        os.utime(cwd_git, (past, past))
+
+    backdate()
+    expected = get_paths_for_directory(cwd_git)
+
+    # An unchanged tree is listed without spawning git
+    with patch("subprocess.check_output", side_effect=AssertionError("Spawned git")):
+        assert get_paths_for_directory(cwd_git) == expected
+
+    # A new file changes its directory's mtime, so the listing is refreshed
+    (cwd_git / "src" / "new.py").write_text("print('new')\n")
+    expected |= {Path("src/new.py")}
+    assert get_paths_for_directory(cwd_git) == expected
+
+    # A new sibling package only changes the mtime of a directory holding no files
+    backdate()
+    assert get_paths_for_directory(cwd_git) == expected
+    (cwd_git / "lib" / "newpkg").mkdir()
+    (cwd_git / "lib" / "newpkg" / "b.py").write_text("b = 2\n")
+    assert get_paths_for_directory(cwd_git) == expected | {Path("lib/newpkg/b.py")}
+
+
+def test_ls_files_cache_size(cwd_git, monkeypatch):
+    monkeypatch.setattr(get_paths, "_ls_files_cache", {})
+    monkeypatch.setattr(get_paths, "_LS_FILES_CACHE_SIZE", 2)
+    past = time.time() - 60
+    roots = list[Path]()
+    for name in ["a", "b", "c"]:
+        root = cwd_git.resolve() / name
+        root.mkdir()
+        (root / "file.py").write_text("x = 1\n")
+        for path in [root / "file.py", root]:
+            os.utime(path, (past, past))
+        roots.append(root)
+    for path in [cwd_git / ".git" / "index", cwd_git / ".git" / "info" / "exclude"]:
+        os.utime(path, (past, past))
+    for root in roots:
+        get_paths._ls_files(root, cwd_git.resolve())
+    assert list(get_paths._ls_files_cache) == roots[1:]
+
+
+def test_match_path_with_patterns(cwd):
+    patterns = {cwd / "src", cwd / "*.md", cwd / "**/interface.py"}
+    assert match_path_with_patterns(cwd / "src", patterns)
+    assert match_path_with_patterns(cwd / "src" / "operations.py", patterns)
+    assert match_path_with_patterns(cwd / "README.md", patterns)
+    assert match_path_with_patterns(cwd / "lib" / "interface.py", patterns)
+    assert not match_path_with_patterns(cwd / "main.py", patterns)
+    assert not match_path_with_patterns(cwd / "srcs" / "main.py", patterns)
+
+    paths = get_paths_for_directory(cwd, exclude_patterns=patterns)
+    assert paths == {Path(".gitignore"), Path("main.py")}
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from ragdaemon.context import ContextBuilder
+from ragdaemon.daemon import Daemon
+from ragdaemon.line_ranges import LineIndex, LineRanges
+from ragdaemon.utils import lines_set_to_ref, parse_lines_ref, parse_path_ref
+
+
+def test_line_ranges():
+    lines = LineRanges.from_ref("5-7,1-2,3-4,10")
+    assert lines.ranges == ((1, 7), (10, 10))
+    assert lines.to_ref() == "1-7,10"
+    assert (lines.start, lines.end, len(lines)) == (1, 10, 8)
+    assert list(lines) == [1, 2, 3, 4, 5, 6, 7, 10]
+    assert 7 in lines and 8 not in lines and 0 not in lines
+
+    other = LineRanges([(3, 4), (6, 12)])
+    assert (lines | other).to_ref() == "1-12"
+    assert (lines & other).to_ref() == "3-4,6-7,10"
+    assert (lines - other).to_ref() == "1-2,5"
+    assert lines.overlaps(other)
+    assert not lines.overlaps(LineRanges([(8, 9), (11, 20)]))
+    assert not LineRanges() and parse_lines_ref("4-3") is None
+
+    # Matches the same operations on sets of ints
+    rng = random.Random(0)
+    for _ in range(200):
+        a = {rng.randint(1, 30) for _ in range(rng.randint(0, 20))}
+        b = {rng.randint(1, 30) for _ in range(rng.randint(0, 20))}
+        ranges_a, ranges_b = LineRanges.from_lines(a), LineRanges.from_lines(b)
+        assert list(ranges_a | ranges_b) == sorted(a | b)
+        assert list(ranges_a & ranges_b) == sorted(a & b)
+        assert list(ranges_a - ranges_b) == sorted(a - b)
+        assert ranges_a.overlaps(ranges_b) == bool(a & b)
+        assert lines_set_to_ref(a) == ranges_a.to_ref()
+
+
+def test_line_index():
+    index = LineIndex(
+        [
+            ("a", LineRanges([(1, 3), (10, 12)])),
+            ("b", LineRanges([(4, 9)])),
+            ("c", LineRanges([(2, 20)])),  # Overlapping ranges still work
+        ]
+    )
+    assert index.query(LineRanges([(1, 1)])) == {"a"}
+    assert index.query(LineRanges([(5, 5)])) == {"b", "c"}
+    assert index.query(LineRanges([(3, 4), (12, 12)])) == {"a", "b", "c"}
+    assert index.query(LineRanges([(21, 30)])) == set()
+
+
+@pytest.mark.asyncio
+async def test_graph_line_index(cwd):
+    daemon = Daemon(cwd, annotators={"hierarchy": {}, "chunker": {}})
+    await daemon.update(refresh=True)
+    graph = daemon.graph
+    file = "src/operations.py"
+    chunks = {
+        node: parse_path_ref(data["ref"])[1]
+        for node, data in graph.nodes(data=True)
+        if data["type"] == "chunk" and node.startswith(f"{file}:")
+    }
+    for line in range(1, 25):
+        expected = {node for node, lines in chunks.items() if line in lines}
+        assert graph.get_line_index(file).query(LineRanges([(line, line)])) == expected
+
+    # Kept up to date as chunk nodes are removed and added
+    node = next(node for node in chunks if not node.endswith(":BASE"))
+    data = graph.nodes[node]
+    graph.remove_node(node)
+    assert node not in graph.get_line_index(file).query(chunks[node])
+    graph.add_node(node, **data)
+    assert node in graph.get_line_index(file).query(chunks[node])
+    assert node in graph.copy().get_line_index(file).query(chunks[node])
+
+    context = ContextBuilder(graph, daemon.io)
+    context.add_ref(f"{file}:{chunks[node].start}")
+    assert context.to_ids() == [node]
@@ -0,0 +1,60 @@
+from unittest.mock import patch
+
+from ragdaemon.database import LiteDB
+from ragdaemon.document_store import document_store
+from ragdaemon.tokens import TokenCounts, truncate, truncate_stored
+from ragdaemon.utils import hash_str
+
+
+def test_truncate(mock_encoding):
+    document = "def add(a, b):\n    return a + b\n" * 100
+    assert truncate(document, "text-embedding-3-large", tokens=10_000) == (document, 0)
+    truncated, ratio = truncate(document, "text-embedding-3-large", tokens=500)
+
+    label = "\n[TRUNCATED]"
+    assert truncated.endswith(label)
+    kept = truncated[: -len(label)]
+    assert document.startswith(kept)
+    assert len(mock_encoding.encode(truncated)) <= 500
+    kept_tokens = len(mock_encoding.encode(kept))
+    assert ratio == 1 - kept_tokens / len(mock_encoding.encode(document))
+
+
+def test_truncate_stored(mock_encoding):
+    model = "text-embedding-3-large"
+    document = "def add(a, b):\n    return a + b\n" * 2_000
+    checksum = hash_str(document)
+    document_store.put_parts(checksum, [document])
+
+    # Cut from a prefix, the same as from the whole document
+    with patch.object(document_store, "read", wraps=document_store.read) as read:
+        truncated, _ = truncate_stored(checksum, model, tokens=100)
+        assert truncated == truncate(document, model, tokens=100)[0]
+        assert read.call_count > 0
+        assert all(call.args[1] < len(document) for call in read.call_args_list)
+    # Documents that fit are read whole
+    small = "def add(a, b):\n    return a + b\n"
+    document_store.put(hash_str(small), small)
+    assert truncate_stored(hash_str(small), model) == (small, 0)
+
+
+def test_token_counts(mock_encoding):
+    model = "text-embedding-3-large"
+    document = "def add(a, b):\n    return a + b\n"
+    checksum = hash_str(document)
+    doc_tokens = len(mock_encoding.encode(document))
+    token_counts = TokenCounts()
+    with patch.object(mock_encoding, "encode", wraps=mock_encoding.encode) as encode:
+        assert token_counts.count(document, model) == doc_tokens
+        assert token_counts.count(document, model) == doc_tokens
+        assert encode.call_count == 1
+    assert token_counts.get(checksum, model) == doc_tokens
+
+    # Saved to the document's DB record, and loaded back from it
+    db = LiteDB()
+    db.add(ids=[checksum], documents=[document], metadatas=[{"summary": "add"}])
+    token_counts.save(db)
+    metadata = db.get(ids=[checksum])["metadatas"][0]
+    loaded = TokenCounts()
+    assert loaded.load(checksum, metadata) == {"summary": "add"}
+    assert loaded.get(checksum, model) == doc_tokens
@@ -0,0 +1,115 @@
+import asyncio
+import ctypes
+from pathlib import Path
+
+import pytest
+
+from ragdaemon.io import LocalIO
+from ragdaemon.watcher import (
+    InotifyWatcher,
+    PollingWatcher,
+    empty_change_set,
+    get_file_changes,
+    load_inotify,
+    merge_changes,
+)
+
+
+def test_merge_changes():
+    changes = empty_change_set()
+    changes["created"].add(Path("new.py"))
+    changes["modified"].add(Path("main.py"))
+
+    later = empty_change_set()
+    later["deleted"] = {Path("new.py"), Path("main.py")}
+    later["renamed"] = {Path("src/a.py"): Path("src/b.py")}
+    merge_changes(changes, later)
+
+    assert changes["created"] == set()
+    assert changes["modified"] == set()
+    assert changes["deleted"] == {Path("main.py")}
+    assert changes["renamed"] == {Path("src/a.py"): Path("src/b.py")}
+
+
+def test_get_file_changes():
+    changes = empty_change_set()
+    changes["created"].add(Path("new.py"))
+    changes["modified"].add(Path("src/operations.py"))
+    changes["deleted"].add(Path("main.py"))
+    changes["renamed"][Path("src/a.py")] = Path("src/b.py")
+    assert get_file_changes(changes) == {
+        "changed": {"new.py", "src/operations.py", "src/b.py"},
+        "removed": {"main.py", "src/a.py"},
+    }
+
+
+def make_changes(cwd: Path):
+    (cwd / "hello.py").write_text("print('Hello, world!')\n")  # Create
+    with open(cwd / "src" / "operations.py", "a") as f:  # Modify
+        f.write("# modified\n")
+    (cwd / "main.py").unlink()  # Delete
+    (cwd / "src" / "interface.py").rename(cwd / "src" / "ui.py")  # Rename
+
+
+def assert_expected_changes(changes):
+    assert changes["created"] == {Path("hello.py")}
+    assert changes["modified"] == {Path("src/operations.py")}
+    assert changes["deleted"] == {Path("main.py")}
+    assert changes["renamed"] == {Path("src/interface.py"): Path("src/ui.py")}
+
+
+def test_polling_watcher(cwd_git):
+    watcher = PollingWatcher(LocalIO(cwd_git))
+    make_changes(cwd_git)
+    paths = watcher.io.get_paths_for_directory()
+    assert_expected_changes(watcher.compare(watcher.take_snapshot(paths)))
+
+
+@pytest.mark.asyncio
+async def test_inotify_watcher(cwd_git):
+    libc = load_inotify()
+    if libc is None:
+        pytest.skip("inotify is only available on Linux")
+    watcher = InotifyWatcher(LocalIO(cwd_git), debounce=0.2, libc=libc)
+    try:
+        changes = watcher.changes()
+        next_changes = asyncio.ensure_future(changes.__anext__())
+        await asyncio.sleep(0.1)
+        make_changes(cwd_git)
+        assert_expected_changes(await asyncio.wait_for(next_changes, 5))
+        await changes.aclose()
+    finally:
+        watcher.close()
+
+
+@pytest.mark.asyncio
+async def test_inotify_watcher_new_directories(cwd_git):
+    libc = load_inotify()
+    if libc is None:
+        pytest.skip("inotify is only available on Linux")
+    watcher = InotifyWatcher(LocalIO(cwd_git), debounce=0.2, libc=libc)
+    try:
+        # Ignored directories aren't walked or watched, only those with active files
+        (cwd_git / ".venv" / "lib" / "site").mkdir(parents=True)
+        (cwd_git / "pkg" / "sub").mkdir(parents=True)
+        (cwd_git / "pkg" / "sub" / "new.py").write_text("print('new')\n")
+        await asyncio.sleep(0.1)
+        watcher.read_events()
+        assert watcher.watched == {Path("."), Path("src")}
+        changes = watcher.collect()
+        assert changes["created"] == {Path("pkg/sub/new.py")}
+        assert watcher.watched == {Path("."), Path("src"), Path("pkg"), Path("pkg/sub")}
+        assert watcher.event.is_set()  # Lists once more, for files written meanwhile
+
+        # Failing to add a watch treats everything as modified, instead of raising
+        class NoWatchesLibc:
+            def inotify_add_watch(self, fd, path, mask):
+                ctypes.set_errno(28)  # ENOSPC
+                return -1
+
+        watcher.libc = NoWatchesLibc()  # type: ignore
+        assert not watcher.add_watch(Path("pkg/other"))
+        assert watcher.overflowed
+        assert watcher.collect()["modified"] == watcher.paths
+    finally:
+        watcher.close()